@@ -1,28 +1,13 @@
 import streamlit as st
-# Import functions from your scripts here
-# Example: from run_budget_scenario import run_budget_scenario
+import time
+import uuid
+from jobs import get_queue
+import utils as ut
 
-# Placeholder function definitions (replace these with actual imports and function calls)
-def generate_books(input_data):
-    # Your existing logic from generate_books.py
-    return "Books Generated Successfully"
-
-# Placeholder function definitions (replace these with actual imports and function calls)
-def run_budget_scenario(input_data):
-    # Your existing logic from run_budget_scenario.py
-    return "Budget Scenario Result"
-
-def run_coverage_scenario(input_data):
-    # Your existing logic from run_coverage_scenario.py
-    return "Coverage Scenario Result"
-
-def run_optimization(input_data):
-    # Your existing logic from run_optimization.py
-    return "Optimization Result"
-
-def run_program_checks(input_data):
-    # Your existing logic from run_program_checks.py
-    return "Program Checks Result"
+# Job queue shared by every session of this Streamlit server (see jobs.py)
+queue = get_queue('results/jobs')
+if 'owner' not in st.session_state:
+    st.session_state['owner'] = uuid.uuid4().hex[:8] # identifies the jobs of this browser session
 
 # Streamlit app starts here
 st.title('Carbon Optimization Tool')
@@ -31,22 +16,68 @@ st.title('Carbon Optimization Tool')
 uploaded_file = st.file_uploader("Upload your data file", type=["xlsx"])
 
 # Dropdown to select the scenario
-scenario = st.selectbox("Choose a Scenario", ["Budget", "Coverage", "Optimization", "Program Checks"])
-
-# Button to run the selected scenario
-if st.button('Run Scenario') and uploaded_file is not None:
-    if scenario == "Budget":
-        result = run_budget_scenario(uploaded_file)
-    elif scenario == "Coverage":
-        result = run_coverage_scenario(uploaded_file)
-    elif scenario == "Optimization":
-        result = run_optimization(uploaded_file)
-    else: # Program Checks
-        result = run_program_checks(uploaded_file)
-
-    # Display results
-    st.write(result)
-else:
-    st.write("Please upload a data file and select a scenario to proceed.")
+scenario = st.selectbox("Choose a Scenario", ["Generate books", "Coverage", "Budget", "Optimization", "Program Checks"])
+start_year, end_year = st.columns(2)
+start_year = start_year.number_input("Start year", value=2024, step=1)
+end_year = end_year.number_input("End year", value=2029, step=1)
+params = {}
+budgets_valid = True
+if scenario == "Budget":
+    params['spending'] = st.number_input("Spending on each intervention", value=10000, step=1000)
+elif scenario == "Optimization":
+    budgets = [budget.strip() for budget in st.text_input("Budgets (comma separated)", "20000, 50000, 100000").split(',')]
+    try:
+        params['budgets'] = [float(budget) for budget in budgets if budget]
+    except ValueError:
+        st.error("Budgets must be numbers separated by commas, without thousands separators (e.g. 20000, 50000).")
+        budgets_valid = False
+    else:
+        if not params['budgets']:
+            st.error("Enter at least one budget.")
+            budgets_valid = False
+    params['method'] = st.selectbox("Optimization method", ['pso-asd', 'surrogate', 'swarm', 'mac'])
+
+# Button to submit the selected scenario as a background job
+if st.button('Run Scenario'):
+    if uploaded_file is None:
+        st.write("Please upload a data file and select a scenario to proceed.")
+    elif budgets_valid:
+        kind = {"Generate books": 'generate_books', "Coverage": 'coverage', "Budget": 'budget', "Optimization": 'optimization', "Program Checks": 'program_checks'}[scenario]
+        queue.submit(kind, uploaded_file, int(start_year), int(end_year), owner=st.session_state['owner'], **params)
+
+# Jobs of this session, or of any session with "Show all jobs" (to reattach to a job after a rerun)
+st.header("Jobs")
+show_all = st.checkbox("Show all jobs", value=False)
+df_jobs = queue.jobs(None if show_all else st.session_state['owner'])
+for _, job in df_jobs.iterrows():
+    progress = job['progress'] or {}
+    with st.expander('{} {} ({})'.format(job['kind'], job['id'], job['status']), expanded=job['status'] in ['queued', 'running']):
+        if job['status'] == 'running':
+            st.progress(min(progress.get('done', 0)/max(progress.get('total', 1), 1), 1.0),
+                        text='{} - {} simulations, {} optimizer evaluations{}'.format(progress.get('stage'), progress.get('simulations', 0), progress.get('evaluations', 0),
+                                                                                    '' if progress.get('objective') is None else ', best objective {:0,.1f}'.format(progress['objective'])))
+        if job['status'] in ['queued', 'running'] and st.button('Cancel', key='cancel_{}'.format(job['id'])):
+            queue.cancel(job['id'])
+        if job['status'] == 'failed':
+            st.error(queue.status(job['id']).get('error'))
+        if job['status'] == 'done':
+            result = queue.result(job['id'])
+            st.write('Facility: {}'.format(result['facility_code']))
+            show_plots = st.checkbox('Plot', key='plot_{}'.format(job['id']))
+            if 'emissions' in result:
+                st.dataframe(result['emissions'])
+                if show_plots:
+                    ut.render_figure(ut.plot_emissions(result['emissions']), to_streamlit=True)
+            if 'allocation' in result:
+                st.dataframe(result['allocation'])
+                if show_plots:
+                    ut.render_figure(ut.plot_spending(result['allocation']), to_streamlit=True)
+            if 'checks' in result:
+                st.dataframe(result['checks'])
+
+# Refresh while jobs are running, to stream their progress
+if (df_jobs['status'].isin(['queued', 'running'])).any():
+    time.sleep(1)
+    st.rerun()
 
 # To run the app, use `streamlit run app.py` from your command line
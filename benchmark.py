@@ -0,0 +1,215 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+'''
+Benchmark suite for book generation, simulation, scenarios and optimization.
+
+    python -m benchmark run [--quick] [--repeat N] [--output FILE]
+    python -m benchmark compare OLD.json NEW.json [--threshold 0.1]
+
+Every step is timed on the bundled input_data_example.xlsx and on synthetic input data sheets scaled in
+facilities, interventions and years (see synthetic_sheets), then run once more under tracemalloc for its
+peak memory. Results are saved as JSON, tagged with the git commit, so that runs can be compared between
+commits.
+'''
+
+EXAMPLE = 'input_data_example.xlsx'
+START_YEAR = 2024
+
+# (name, input data sheet or synthetic sizes (n_facilities, n_interventions, n_sources), n_years)
+CASES = [('example', EXAMPLE, 5),
+         ('facilities', (16, 9, 10), 5),
+         ('interventions', (1, 36, 20), 5),
+         ('years', (1, 9, 10), 50)]
+QUICK_CASES = [('example', EXAMPLE, 5),
+               ('synthetic', (4, 12, 10), 10)]
+SWEEP_POINTS = 2**16 # allocations evaluated per facility in the sweep steps
+
+def synthetic_sheets(n_facilities=1, n_interventions=9, n_sources=10, seed=0):
+    '''
+    Random input data sheet with the layout of input_data_example.xlsx.
+    Every intervention targets one to three emission sources.
+    :param n_facilities: Number of facilities.
+    :param n_interventions: Number of interventions.
+    :param n_sources: Number of emission sources.
+    :param seed: Random seed.
+    :return: dict of DataFrames keyed by sheet name (see engine.read_input_data).
+    '''
+    rng = np.random.default_rng(seed)
+    facilities = ['facility_{}'.format(i + 1) for i in range(n_facilities)]
+    sources = ['emission_{}'.format(i + 1) for i in range(n_sources)]
+    programs = ['intervention_{}'.format(i + 1) for i in range(n_interventions)]
+    targets = np.zeros((n_interventions, n_sources), dtype=bool)
+    for i in range(n_interventions):
+        targets[i, rng.choice(n_sources, size=rng.integers(1, min(3, n_sources) + 1), replace=False)] = True
+    implementation = rng.lognormal(np.log(2e4), 1, (n_facilities, n_interventions))
+
+    def per_facility(values, columns):
+        df = pd.DataFrame(values, columns=columns)
+        df.insert(0, 'facilities', facilities)
+        return df
+
+    return {'facility': pd.DataFrame({'Code Name': facilities, 'Display Name': [code.replace('_', ' ').title() for code in facilities]}),
+            'emission sources': pd.DataFrame({'Code Name': sources, 'Display Name': [code.replace('_', ' ').title() for code in sources]}),
+            'emission data': per_facility(rng.lognormal(np.log(4e4), 1, (n_facilities, n_sources)).round(), sources),
+            'interventions': pd.DataFrame({'Code Name': programs, 'Display Name': [code.replace('_', ' ').title() for code in programs]}),
+            'emission targets': pd.DataFrame(np.where(targets, 'y', None), columns=sources).assign(interventions=programs)[['interventions'] + sources],
+            'effect sizes': per_facility(rng.uniform(0.1, 1, (n_facilities, n_interventions)), [prog + '_effect' for prog in programs]),
+            'implementation costs': per_facility(implementation, [prog + '_cost' for prog in programs]),
+            'maintenance costs': per_facility(implementation*rng.uniform(0.05, 0.2, (n_facilities, n_interventions)), [prog + '_cost' for prog in programs])}
+
+def _measure(step, repeat):
+    '''
+    Wall times of repeat calls of step, then the peak traced memory of one more call.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        step()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    step()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'times': times, 'min': min(times), 'median': float(np.median(times)), 'peak_memory_mb': peak/2**20}
+
+def _steps(sheets, start_year, end_year, budgets, methods, folder):
+    '''
+    Benchmarked steps of one input data sheet, as (name, callable) pairs. Scenario steps use the
+    simulation functions of scenarios.py (without plotting) on the project of the first facility, built
+    once. With several facilities, building the project of every facility is benchmarked too. The bundle
+    step enumerates every bundle of interventions (up to mac._MAX_EXACT interventions). The sweep
+    steps evaluate random allocations of every facility on one worker and on every CPU. With several
+    facilities, the first budget per facility is also split across every facility as one shared budget.
+    '''
+    from books import build_books, build_project, export_books
+    from scenarios import run_status_quo, run_coverage_scenario, run_budget_scenario, run_optimization
+
+    P, progset, facility_code = build_project(sheets, start_year, end_year)
+    status_quo = run_status_quo(P)
+
+    yield 'generate_books', lambda: export_books(*build_books(sheets, start_year, end_year), folder=folder)
+    yield 'run_sim', lambda: run_status_quo(P)
+    yield 'coverage_scenario', lambda: run_coverage_scenario(P, progset, start_year, status_quo)
+    yield 'budget_scenario', lambda: run_budget_scenario(P, progset, start_year, 1e4, status_quo)
+    for method in methods:
+        yield 'optimization ({})'.format(method), lambda method=method: run_optimization(P, progset, start_year, facility_code, budgets, status_quo, method=method)
+    if len(sheets['facility']) > 1:
+        from portfolio import build_projects
+        yield 'build_projects', lambda: build_projects(sheets, start_year, end_year)
+
+    from bundles import bundle_table
+    from engine import compile_project
+    from mac import _MAX_EXACT
+    compiled = compile_project(P, progset, start_year, facility_code)
+    if len(compiled.programs) <= _MAX_EXACT: # every bundle is enumerated
+        yield 'bundles', lambda: bundle_table(compiled)
+
+    # Sweep of random allocations over every facility, serially and on every CPU (see sweep.py)
+    from portfolio import build_models
+    from sweep import SweepExecutor
+    models = build_models(sheets, start_year, end_year)
+    spending = np.random.default_rng(0).uniform(0, 1, (SWEEP_POINTS, len(models[0].programs)))
+    def sweep(workers):
+        with SweepExecutor(models, workers=workers, chunk_size=SWEEP_POINTS//16) as executor:
+            return [executor.emissions_from_spending(model.facility_code, spending*model.unit_cost) for model in models]
+    for workers in sorted({1, os.cpu_count()}):
+        yield 'sweep ({} workers)'.format(workers), lambda workers=workers: sweep(workers)
+
+    if len(models) > 1: # budget shared across facilities (see portfolio.optimize_portfolio)
+        from portfolio import optimize_portfolio
+        yield 'portfolio', lambda: optimize_portfolio(models, budgets[0]*len(models))
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(cases=None, repeat=3, budgets=(20e3,), methods=('mac', 'swarm', 'surrogate', 'pso-asd'), pso_asd_cases=('example',), output=None):
+    '''
+    Run the benchmark suite.
+    :param cases: list of (name, input data sheet or (n_facilities, n_interventions, n_sources), n_years) (defaults to CASES).
+    :param repeat: Number of timed calls of each step.
+    :param budgets: Budgets optimized in the optimization step.
+    :param methods: Optimization methods to benchmark.
+    :param pso_asd_cases: Names of the cases where the (slow) PSO -> ASD optimization is benchmarked.
+    :param output: JSON file name for saving (defaults to results/benchmarks/benchmark_<commit>.json).
+    :return: dict of benchmark results.
+    '''
+    import atomica as at
+    from engine import read_input_data
+
+    commit = _git_commit()
+    report = {'commit': commit, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'platform': platform.platform(), 'python': platform.python_version(),
+              'numpy': np.__version__, 'atomica': at.__version__, 'repeat': repeat, 'benchmarks': []}
+    # Cold start of a headless worker: a fresh interpreter importing the simulation and plotting modules
+    startup = lambda: subprocess.run([sys.executable, '-c', 'import scenarios, utils, cache, jobs'], check=True)
+    report['benchmarks'].append(dict(case='startup', step='import', **_measure(startup, repeat)))
+    print('{:<15} {:<25} {:>9.3f} s'.format('startup', 'import', report['benchmarks'][-1]['median']))
+    for name, source, n_years in CASES if cases is None else cases:
+        sheets = read_input_data(source) if isinstance(source, str) else synthetic_sheets(*source)
+        sizes = {'n_facilities': len(sheets['facility']), 'n_interventions': len(sheets['interventions']),
+                 'n_sources': len(sheets['emission sources']), 'n_years': n_years}
+        case_methods = [method for method in methods if method != 'pso-asd' or name in pso_asd_cases]
+        with tempfile.TemporaryDirectory(prefix='carbomica_benchmark_') as folder: # books exported by generate_books
+            for step, call in _steps(sheets, START_YEAR, START_YEAR + n_years, list(budgets), case_methods, folder):
+                report['benchmarks'].append(dict(case=name, step=step, **sizes, **_measure(call, repeat)))
+                print('{:<15} {:<25} {:>9.3f} s {:>9.1f} MB'.format(name, step, report['benchmarks'][-1]['median'], report['benchmarks'][-1]['peak_memory_mb']))
+
+    output = output or os.path.join('results', 'benchmarks', 'benchmark_{}.json'.format(commit or time.strftime('%Y%m%d%H%M%S')))
+    if not os.path.exists(os.path.dirname(output) or '.'): os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Benchmark results saved: {}'.format(output))
+    return report
+
+def compare(old_file, new_file, threshold=0.1):
+    '''
+    Compare two benchmark JSON files step by step.
+    :param old_file: JSON file of the reference run.
+    :param new_file: JSON file of the new run.
+    :param threshold: Relative slowdown (of the minimum time) or memory increase reported as a regression.
+    :return: DataFrame with one row per (case, step) found in both files.
+    '''
+    frames = []
+    for file in [old_file, new_file]:
+        with open(file) as f:
+            frames.append(pd.DataFrame(json.load(f)['benchmarks']).set_index(['case', 'step'])[['min', 'peak_memory_mb']])
+    df = frames[0].join(frames[1], how='inner', lsuffix=' (old)', rsuffix=' (new)')
+    df['Time ratio'] = df['min (new)']/df['min (old)']
+    df['Memory ratio'] = df['peak_memory_mb (new)']/df['peak_memory_mb (old)']
+    df['Regression'] = (df['Time ratio'] > 1 + threshold) | (df['Memory ratio'] > 1 + threshold)
+    return df
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='benchmark', description='CARBOMICA benchmark suite')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='Run the benchmark suite')
+    run_parser.add_argument('--quick', action='store_true', help='Only the example and one small synthetic case, one call per step')
+    run_parser.add_argument('--repeat', type=int, default=None, help='Number of timed calls of each step (default 3, 1 with --quick)')
+    run_parser.add_argument('--output', default=None, help='JSON file name (default results/benchmarks/benchmark_<commit>.json)')
+    compare_parser = subparsers.add_parser('compare', help='Compare two benchmark JSON files')
+    compare_parser.add_argument('old', help='JSON file of the reference run')
+    compare_parser.add_argument('new', help='JSON file of the new run')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown reported as a regression')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        run_benchmarks(QUICK_CASES if args.quick else CASES, repeat=args.repeat or (1 if args.quick else 3), output=args.output)
+    elif args.command == 'compare':
+        df = compare(args.old, args.new, args.threshold)
+        print(df.to_string(float_format='{:.3f}'.format))
+        if df['Regression'].any():
+            raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
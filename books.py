@@ -1,51 +1,56 @@
-import atomica as at
 import pandas as pd
+import io
 import os
 import numpy as np
-if not os.path.exists('books'): os.makedirs('books')
+from engine import read_input_data, _drop_unnamed
+import tracing
 '''
-Function to generate a framework, databook and progbook.
+Functions to generate a framework, databook and progbook.
 '''
 
-def generate_books(input_data_sheet, start_year, end_year):
+@tracing.traced()
+def build_books(input_data_sheet, start_year, end_year, facility_code=None):
     '''
-    Generate framework, databook and progbook based on input data sheet.
-    Results on emission reductions are saved in an excel sheet.
-    :param input_data_sheet: file name of input data sheet.
+    Build framework, databook and program set in memory from the input data sheet.
+    The input data sheet is read once, and nothing is written to disk (see export_books).
+    :param input_data_sheet: file name of input data sheet (or a dict of DataFrames from engine.read_input_data).
     :param start_year: Start year of simulations.
-    :param facility_code: Code of the facility.
-    :return: 
+    :param end_year: End year of simulations.
+    :param facility_code: Code of the facility (defaults to the first facility in the sheet).
+    :return: Atomica ProjectFramework, Atomica ProjectData, Atomica ProgramSet, facility code.
     '''
-    facility_code = pd.read_excel(input_data_sheet, sheet_name='facility', index_col='Code Name')
+    import atomica as at
+    import sciris as sc
+    sheets = read_input_data(input_data_sheet)
+    facilities = sheets['facility'].set_index('Code Name')
+    facility_code = facilities.index[0] if facility_code is None else facility_code
     facility = {}
-    facility[facility_code.index[0]] = {'label': facility_code.loc[facility_code.index[0],'Display Name'], 'type': 'facilities'}
-    
-    facility_code = facility_code.index[0]
-    
-    interventions_list = pd.read_excel(input_data_sheet, sheet_name='interventions', index_col='Code Name')
+    facility[facility_code] = {'label': facilities.loc[facility_code,'Display Name'], 'type': 'facilities'}
+
+    interventions_list = sheets['interventions'].set_index('Code Name')
     interventions = {}
     for intervention in interventions_list.index:
         interventions[intervention] = interventions_list.loc[intervention,'Display Name']
-    
-    ## Step 1: read in base framework, and generate intervention-specific parameters 
+
+    ## Step 1: read in base framework, and generate intervention-specific parameters
     # read framework base from template
     df_fw = pd.read_excel(pd.ExcelFile('templates/carbomica_framework_template.xlsx'), sheet_name=None)
-    emissions_list = pd.read_excel(input_data_sheet, sheet_name='emission sources', index_col='Code Name')
-    
+    emissions_list = sheets['emission sources'].set_index('Code Name')
+
     # define intervention-specific parameters and add to the Parameters sheet as a new row
     for i, emission in enumerate(emissions_list.index):
-        emission_par = {'Code Name': emission+'_baseline', 
+        emission_par = {'Code Name': emission+'_baseline',
                     'Display Name': emissions_list.loc[emission,'Display Name'] + ' - baseline',
                     'Targetable': 'n',
                     'Databook Page': 'emission_sources'} # define coverage of intervention as a new row in framework
-        emission_mult = {'Code Name': emission+'_mult', 
+        emission_mult = {'Code Name': emission+'_mult',
                     'Display Name': emissions_list.loc[emission,'Display Name'] + ' - multiplier',
                     'Targetable': 'y',
                     'Default Value': 0,
                     'Minimum Value': 0,
                     'Maximum Value': 1,
                     'Databook Page': 'targeted_pars'}
-        emission_actual = {'Code Name': emission, 
+        emission_actual = {'Code Name': emission,
                 'Display Name': emissions_list.loc[emission,'Display Name'],
                 'Targetable': 'n',
                 'Population type': 'facilities',
@@ -58,72 +63,105 @@ def generate_books(input_data_sheet, start_year, end_year):
             df_fw['Parameters'].loc[df_fw['Parameters']['Code Name']=='co2e_emissions','Function'] = emission_actual['Code Name']
         else:
             df_fw['Parameters'].loc[df_fw['Parameters']['Code Name']=='co2e_emissions','Function'] += '+'+emission_actual['Code Name']
-        
-    with pd.ExcelWriter('books/carbomica_framework_{}.xlsx'.format(facility_code)) as writer:
+
+    # write the framework to an in-memory workbook for Atomica to parse
+    framework_file = io.BytesIO()
+    with pd.ExcelWriter(framework_file) as writer:
         for sheet_name, df in df_fw.items():
             df.to_excel(writer, sheet_name=sheet_name, index=False)
-    
-    ## Step 2: generate and populate the databook (saved in "books/")
-    F = at.ProjectFramework('books/carbomica_framework_{}.xlsx'.format(facility_code))  # load framework
+    framework_file.seek(0)
+
+    ## Step 2: generate and populate the databook
+    F = at.ProjectFramework(sc.Spreadsheet(framework_file))  # load framework
     data_years = np.arange(start_year, end_year) # years for input data
-    
+
     D = at.ProjectData.new(framework=F, tvec=data_years, pops=facility, transfers=0)
-    db_data = pd.read_excel(input_data_sheet, sheet_name='emission data', index_col='facilities')
-    cols_to_drop = [col for col in db_data.columns if 'Unnamed' in col]
-    db_data.drop(columns=cols_to_drop,inplace=True)
+    db_data = _drop_unnamed(sheets['emission data'].set_index('facilities'))
 
-    D.tdve['facilities_number'].ts[facility_code] = at.TimeSeries(data_years, 1, units='Number')
+    D.tdve['facilities_number'].ts[facility_code] = at.TimeSeries(data_years, np.ones(len(data_years)), units='Number')
     D.tdve['facilities_number'].write_assumption = True
     for parameter in db_data.columns:
-        D.tdve[parameter+'_baseline'].ts[facility_code] = at.TimeSeries(data_years, db_data.loc[facility_code,parameter])
+        D.tdve[parameter+'_baseline'].ts[facility_code] = at.TimeSeries(data_years, np.full(len(data_years), db_data.loc[facility_code,parameter]), units=D.tdve[parameter+'_baseline'].allowed_units[0])
         D.tdve[parameter+'_baseline'].write_assumption = True
-            
-    D.save('books/carbomica_databook_{}.xlsx'.format(facility_code))
-        
-    ## Step 3: generate empty progbooks in folder "templates/"
-    databook_name = 'books/carbomica_databook_{}.xlsx'.format(facility_code)
-    P = at.Project(framework=F,databook=databook_name, do_run=False)
-    progbook_path = 'books/carbomica_progbook_{}.xlsx'.format(facility_code)
-    data_years = np.arange(start_year, end_year) # years for program data (offset by 1 year compared to databook)
-    P.make_progbook(progbook_path,progs=interventions,data_start=data_years[0],data_end=data_years[-1])
-        
-    target_pars_overall = pd.read_excel(input_data_sheet, sheet_name='emission targets', index_col='interventions')
-    cols_to_drop = [col for col in target_pars_overall.columns if 'Unnamed' in col]
-    target_pars_overall.drop(columns=cols_to_drop,inplace=True)
-    
-    effects = pd.read_excel(input_data_sheet, sheet_name='effect sizes', index_col='facilities')
-    cols_to_drop = [col for col in effects.columns if 'Unnamed' in col]
-    effects.drop(columns=cols_to_drop,inplace=True)
-    
-    # Populate the progbooks that were just created and save the files to "books/"
-    D = at.ProjectData.from_spreadsheet(databook_name,framework=F) 
-    pb_costs_maintain = pd.read_excel(input_data_sheet, sheet_name='maintenance costs', index_col='facilities') 
-    cols_to_drop = [col for col in pb_costs_maintain.columns if 'Unnamed' in col]
-    pb_costs_maintain.drop(columns=cols_to_drop,inplace=True) 
-    pb_costs_implement = pd.read_excel(input_data_sheet, sheet_name='implementation costs', index_col='facilities') 
-    cols_to_drop = [col for col in pb_costs_implement.columns if 'Unnamed' in col]
-    pb_costs_implement.drop(columns=cols_to_drop,inplace=True) 
-    P = at.ProgramSet.from_spreadsheet(spreadsheet='books/carbomica_progbook_{}.xlsx'.format(facility_code), framework=F, data=D, _allow_missing_data=True)
+
+    ## Step 3: generate and populate the program set
+    target_pars_overall = _drop_unnamed(sheets['emission targets'].set_index('interventions'))
+    effects = _drop_unnamed(sheets['effect sizes'].set_index('facilities'))
+    pb_costs_maintain = _drop_unnamed(sheets['maintenance costs'].set_index('facilities'))
+    pb_costs_implement = _drop_unnamed(sheets['implementation costs'].set_index('facilities'))
+
+    progset = at.ProgramSet.new(tvec=data_years, progs=interventions, framework=F, data=D)
     for intervention in interventions:
         # Write in 'Program targeting' sheet
-        P.programs[intervention].target_pops = [facility_code]
-        P.programs[intervention].target_comps = ['facilities_number']
-        
+        progset.programs[intervention].target_pops = [facility_code]
+        progset.programs[intervention].target_comps = ['facilities_number']
+
         # Write in 'Spending data' sheet
-        P.programs[intervention].unit_cost = at.TimeSeries(assumption=pb_costs_implement.loc[facility_code,intervention+'_cost']/len(data_years)+pb_costs_maintain.loc[facility_code,intervention+'_cost'], units='$/person/year')
-        P.programs[intervention].spend_data = at.TimeSeries(data_years,0, units='$/year')
-        P.programs[intervention].capacity_constraint = at.TimeSeries(units='people')
-        P.programs[intervention].coverage = at.TimeSeries(units='people')
-            
-        # Write in 'Program effects' sheet
-        target_pars_overall_t = target_pars_overall.transpose()
-        for par in target_pars_overall_t.index:
-            target_interventions = target_pars_overall_t.columns[target_pars_overall_t.loc[par]=='y'].tolist()
-            progs = {}
-            for intervention in target_interventions:
-                effect = effects.loc[facility_code,intervention+'_effect']
-                progs[intervention] = effect
-            P.covouts[(par+'_mult', facility_code)] = at.programs.Covout(par=par+'_mult',pop=facility_code,cov_interaction='random',baseline=0,progs=progs)
-        P.programs[intervention].spend_data = at.TimeSeries(data_years,0, units='$/year') # make initial spending a small, negligible but non-zero number for optimisation initialisation
-    P.save('books/carbomica_progbook_{}.xlsx'.format(facility_code))  
-        
\ No newline at end of file
+        progset.programs[intervention].unit_cost = at.TimeSeries(assumption=pb_costs_implement.loc[facility_code,intervention+'_cost']/len(data_years)+pb_costs_maintain.loc[facility_code,intervention+'_cost'], units='$/person/year')
+        progset.programs[intervention].spend_data = at.TimeSeries(data_years,np.zeros(len(data_years)), units='$/year')
+        progset.programs[intervention].capacity_constraint = at.TimeSeries(units='people')
+        progset.programs[intervention].coverage = at.TimeSeries(units='people')
+
+    # Write in 'Program effects' sheet
+    target_pars_overall_t = target_pars_overall.transpose()
+    for par in target_pars_overall_t.index:
+        target_interventions = target_pars_overall_t.columns[target_pars_overall_t.loc[par]=='y'].tolist()
+        progs = {}
+        for intervention in target_interventions:
+            effect = effects.loc[facility_code,intervention+'_effect']
+            progs[intervention] = effect
+        progset.covouts[(par+'_mult', facility_code)] = at.programs.Covout(par=par+'_mult',pop=facility_code,cov_interaction='random',baseline=0,progs=progs)
+    return F, D, progset, facility_code
+
+def build_project(input_data_sheet, start_year, end_year, facility_code=None):
+    '''
+    Build the Atomica project for the input data sheet in memory.
+    :param input_data_sheet: file name of input data sheet (or a dict of DataFrames from engine.read_input_data).
+    :param start_year: Start year of simulations.
+    :param end_year: End year of simulations.
+    :param facility_code: Code of the facility (defaults to the first facility in the sheet).
+    :return: Atomica project, Atomica program set, facility code.
+    '''
+    import atomica as at
+    F, D, progset, facility_code = build_books(input_data_sheet, start_year, end_year, facility_code)
+
+    # Atomica project definition
+    with tracing.span('create project'):
+        P = at.Project(framework=F, databook=D, do_run=False)
+
+    # Projection settings
+    P.settings.sim_dt    = 1 # simulation timestep
+    P.settings.sim_start = start_year # simulation start year
+    P.settings.sim_end   = end_year # simulation end year
+
+    # Add program set for program runs
+    progset.name = 'default'
+    P.progsets.append(progset)
+    return P, progset, facility_code
+
+def export_books(F, D, progset, facility_code, folder='books'):
+    '''
+    Save the framework, databook and progbook to Excel.
+    :param F: Atomica ProjectFramework.
+    :param D: Atomica ProjectData.
+    :param progset: Atomica ProgramSet.
+    :param facility_code: Code of the facility.
+    :param folder: Folder to save the books in.
+    :return:
+    '''
+    if not os.path.exists(folder): os.makedirs(folder)
+    for book, save in [('framework', F.spreadsheet.save), ('databook', D.save), ('progbook', progset.save)]:
+        with tracing.span('write book', book=book):
+            save(os.path.join(folder, 'carbomica_{}_{}.xlsx'.format(book, facility_code)))
+
+def generate_books(input_data_sheet, start_year, end_year):
+    '''
+    Generate framework, databook and progbook based on input data sheet and save them to "books/".
+    :param input_data_sheet: file name of input data sheet.
+    :param start_year: Start year of simulations.
+    :param end_year: End year of simulations.
+    :return: facility code.
+    '''
+    F, D, progset, facility_code = build_books(input_data_sheet, start_year, end_year)
+    export_books(F, D, progset, facility_code)
+    return facility_code
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import os
+from engine import compile_model
+from mac import _MAX_EXACT, _subsets, _set_emissions
+'''
+Exhaustive analysis of intervention bundles at full coverage.
+
+The coverage scenario covers one intervention at a time, but interventions targeting the same emission
+source overlap: with the 'random' interaction each source only gets the largest effect of the bundle, so
+the abatement of a bundle is less than the sum of the abatements of its interventions. Every one of the
+2^N bundles is evaluated in one batched pass (see mac._set_emissions), with its annual cost, and the
+bundles that no cheaper bundle beats are flagged as cost-efficient. Pairwise interactions compare the
+abatement of each pair of interventions with the sum of their individual abatements.
+'''
+
+def bundle_table(model):
+    '''
+    Emissions and cost of every bundle of fully covered interventions.
+    :param model: CompiledModel (see engine.py).
+    :return: DataFrame with one row per bundle (2^N rows, the empty bundle first), sorted by cost. The
+             interaction is the abatement of the bundle minus the sum of the abatements of its
+             interventions (negative when they overlap on shared emission sources).
+    '''
+    n = len(model.programs)
+    if n > _MAX_EXACT:
+        raise ValueError('Too many interventions to enumerate every bundle ({} > {})'.format(n, _MAX_EXACT))
+    sets = _subsets(n)
+    emissions = _set_emissions(model.baseline, model.effects, model.targets)
+    abatement = emissions[0] - emissions
+    single = abatement[1 << np.arange(n)] # bundle of intervention j alone is the set 2**j
+    cost = sets @ model.unit_cost
+    labels = np.array(model.program_labels, dtype=object)
+    df_bundles = pd.DataFrame({'Bundle': [' + '.join(labels[s]) if s.any() else 'Status-quo' for s in sets],
+                               'Size': sets.sum(axis=1),
+                               'Cost': cost,
+                               'Emissions (CO2e)': emissions,
+                               'Abatement (CO2e)': abatement,
+                               'Abatement per $': np.divide(abatement, cost, out=np.zeros(len(cost)), where=cost > 0),
+                               'Additive abatement (CO2e)': sets @ single,
+                               'Interaction (CO2e)': abatement - sets @ single})
+    df_bundles = df_bundles.sort_values(['Cost', 'Emissions (CO2e)'], kind='stable')
+    df_bundles['Cost-efficient'] = df_bundles['Emissions (CO2e)'] < df_bundles['Emissions (CO2e)'].cummin().shift(fill_value=np.inf)
+    return df_bundles.reset_index(drop=True)
+
+def pairwise_interactions(model):
+    '''
+    Interaction of every pair of interventions at full coverage.
+    :param model: CompiledModel (see engine.py).
+    :return: DataFrame with one row per pair, strongest overlap first. The overlap is the share of the
+             smaller individual abatement lost when both interventions are combined.
+    '''
+    n = len(model.programs)
+    i, j = np.triu_indices(n, 1)
+    coverage = np.vstack([np.zeros(n), np.eye(n), np.eye(n)[i] + np.eye(n)[j]])
+    emissions = model.emissions(coverage)
+    single = emissions[0] - emissions[1:n + 1]
+    joint = emissions[0] - emissions[n + 1:]
+    interaction = joint - single[i] - single[j]
+    smaller = np.minimum(single[i], single[j])
+    labels = np.array(model.program_labels, dtype=object)
+    df_pairs = pd.DataFrame({'Intervention A': labels[i],
+                             'Intervention B': labels[j],
+                             'Shared sources': (model.targets[:, i] & model.targets[:, j]).sum(axis=0),
+                             'Abatement A (CO2e)': single[i],
+                             'Abatement B (CO2e)': single[j],
+                             'Joint abatement (CO2e)': joint,
+                             'Interaction (CO2e)': interaction,
+                             'Overlap': np.divide(-interaction, smaller, out=np.zeros(len(i)), where=smaller > 0)})
+    return df_pairs.sort_values('Interaction (CO2e)', kind='stable').reset_index(drop=True)
+
+def bundle_analysis(input_data_sheet, start_year, end_year, facility_code=None, file_name=None):
+    '''
+    Run the bundle analysis for a facility of the input data sheet.
+    Every bundle, the cost-efficient bundles and the pairwise interactions are saved in an excel sheet.
+    :param input_data_sheet: file name of input data sheet (or a dict of DataFrames from engine.read_input_data).
+    :param start_year: Start year of simulations.
+    :param end_year: End year of simulations.
+    :param facility_code: Code of the facility (defaults to the first facility in the sheet).
+    :param file_name: Excel file name for saving (no file is written if None).
+    :return: DataFrame of every bundle, DataFrame of pairwise interactions.
+    '''
+    model = compile_model(input_data_sheet, start_year, end_year, facility_code)
+    df_bundles = bundle_table(model)
+    df_pairs = pairwise_interactions(model)
+
+    if file_name is not None:
+        if not os.path.exists(os.path.dirname(file_name) or '.'): os.makedirs(os.path.dirname(file_name))
+        with pd.ExcelWriter(file_name, engine='xlsxwriter') as writer:
+            df_bundles[df_bundles['Cost-efficient']].to_excel(writer, sheet_name='Cost-efficient bundles', index=False)
+            df_bundles.to_excel(writer, sheet_name='Bundles', index=False)
+            df_pairs.to_excel(writer, sheet_name='Interactions', index=False)
+        print('Excel file saved: {}'.format(file_name))
+    return df_bundles, df_pairs
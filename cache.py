@@ -0,0 +1,82 @@
+import hashlib
+import os
+import shutil
+import tracing
+from engine import read_input_data
+'''
+Content-addressed cache of Atomica projects built from input data sheets.
+
+Entries are keyed on a hash of the input data sheet contents, the simulation years and the framework
+template. Input data sheets reach load_project either as files (jobs.py, program_checks.py) or as
+DataFrames built in memory by the UI (project.py, through incremental.Session), so there are no stable
+file bytes to key on: the parsed sheet contents are hashed instead, and the same inputs map to the same
+entry whichever way they arrive.
+'''
+
+FRAMEWORK_TEMPLATE = 'templates/carbomica_framework_template.xlsx'
+
+def input_hash(input_data_sheet, start_year, end_year, template=FRAMEWORK_TEMPLATE):
+    '''
+    Hash the contents of the input data sheet together with the simulation years and framework template.
+    :param input_data_sheet: file name of input data sheet (or a dict of DataFrames from engine.read_input_data).
+    :param start_year: Start year of simulations.
+    :param end_year: End year of simulations.
+    :param template: file name of framework template.
+    :return: hex digest.
+    '''
+    digest = hashlib.sha256()
+    for sheet_name, df in sorted(read_input_data(input_data_sheet).items()):
+        digest.update(sheet_name.encode())
+        digest.update(df.to_csv(index=False).encode())
+    with open(template, 'rb') as f:
+        digest.update(f.read())
+    digest.update('{}-{}'.format(start_year, end_year).encode())
+    return digest.hexdigest()
+
+def _evict(cache_dir, max_entries):
+    '''
+    Remove the least recently used entries beyond max_entries.
+    '''
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)]
+    entries = sorted([entry for entry in entries if os.path.isdir(entry)], key=os.path.getmtime, reverse=True)
+    for entry in entries[max_entries:]:
+        shutil.rmtree(entry, ignore_errors=True)
+
+def load_project(input_data_sheet, start_year, end_year, cache_dir='books/cache', max_entries=10, export=False):
+    '''
+    Return the Atomica project and program set for an input data sheet. The input data sheet is read once;
+    the project is built in memory only when no cached entry exists for the same inputs, otherwise the
+    pickled project is loaded.
+    :param input_data_sheet: file name of input data sheet.
+    :param start_year: Start year of simulations.
+    :param end_year: End year of simulations.
+    :param cache_dir: Directory holding the cache entries.
+    :param max_entries: Maximum number of entries kept (least recently used entries are evicted).
+    :param export: If True, also save the framework, databook and progbook to "books/".
+    :return: Atomica project, Atomica program set, facility code.
+    '''
+    import atomica as at
+    from books import build_project, export_books
+    sheets = read_input_data(input_data_sheet)
+    facility_code = sheets['facility'].set_index('Code Name').index[0]
+    entry = os.path.join(cache_dir, input_hash(sheets, start_year, end_year))
+    project_file = os.path.join(entry, 'project.prj')
+
+    if os.path.exists(project_file):
+        tracing.count('cache hits')
+        with tracing.span('load project', file=project_file):
+            P = at.Project.load(project_file)
+        os.utime(entry) # mark as most recently used
+        print('Project loaded from cache: {}'.format(entry))
+    else:
+        tracing.count('cache misses')
+        P, _, facility_code = build_project(sheets, start_year, end_year)
+        os.makedirs(entry, exist_ok=True)
+        with tracing.span('save project', file=project_file):
+            temporary_file = P.save(os.path.join(entry, 'project.{}.tmp.prj'.format(os.getpid())))
+            os.replace(temporary_file, project_file) # atomic, for concurrent builds of the same entry
+        _evict(cache_dir, max_entries)
+
+    if export:
+        export_books(P.framework, P.data, P.progsets[0], facility_code)
+    return P, P.progsets[0], facility_code
@@ -0,0 +1,161 @@
+import argparse
+import json
+import os
+from inputs import InputData
+import tracing
+'''
+Headless runner for CARBOMICA scenarios, driven by a declarative spec (YAML or JSON).
+
+    python -m carbomica run spec.yaml [--workers N] [--output-dir DIR] [--trace FILE]
+
+The spec lists input data sheets with their years, scenarios and optimization budgets (see
+spec_example.yaml). Scenarios run through the functions in scenarios.py and portfolio.py without
+Streamlit or matplotlib, and every table is written as CSV alongside a manifest.json.
+'''
+
+def load_spec(spec_file):
+    '''
+    Load a run spec from a YAML or JSON file.
+    :param spec_file: file name of the spec.
+    :return: dict
+    '''
+    with open(spec_file) as f:
+        if spec_file.endswith('.json'):
+            return json.load(f)
+        import yaml
+        return yaml.safe_load(f)
+
+def _write_table(df, output_dir, file_name, manifest, **entry):
+    '''
+    Write a table to CSV and record it in the manifest.
+    '''
+    path = os.path.join(output_dir, file_name + '.csv')
+    df.to_csv(path)
+    manifest.append(dict(entry, file=os.path.relpath(path, output_dir)))
+
+def run_spec(spec, workers=None, output_dir=None):
+    '''
+    Run every scenario listed in a spec.
+    :param spec: dict (see load_spec).
+    :param workers: Number of workers, overriding the spec.
+    :param output_dir: Output directory, overriding the spec.
+    :return: list of manifest entries.
+    '''
+    from books import build_project
+    from portfolio import facility_codes, portfolio_optimization
+    from results import emissions_table, allocation_table
+    from scenarios import run_status_quo, run_coverage_scenario, run_budget_scenario, run_optimization
+    from uncertainty import uncertainty_analysis
+    from sensitivity import sensitivity_analysis
+    from phasing import multi_year_optimization
+    from bundles import bundle_analysis
+    from store import ResultsStore
+
+    output_dir = output_dir or spec.get('output_dir', 'results/batch')
+    if not os.path.exists(output_dir): os.makedirs(output_dir)
+    workers = workers or spec.get('workers', 1)
+    store = ResultsStore(spec['store']) if spec.get('store') else None # every Atomica run is also appended to the results store
+    manifest = []
+    inputs = [InputData.from_sheets(run['input']).validate().to_sheets() for run in spec['runs']] # fail before any run on inconsistent input data
+    for run, sheets in zip(spec['runs'], inputs):
+        start_year, end_year = run['start_year'], run['end_year']
+        name = run.get('name', os.path.splitext(os.path.basename(run['input']))[0])
+        facilities = run.get('facilities') or facility_codes(sheets)
+        entry = dict(run=name, start_year=start_year, end_year=end_year)
+
+        for facility in facilities:
+            if run.get('uncertainty'):
+                unc = run['uncertainty']
+                budgets = unc.get('budgets', (run.get('optimization') or {}).get('budgets', []))
+                df_bands, df_optimal = uncertainty_analysis(sheets, start_year, end_year, budgets, unc.get('spending'), facility,
+                                                            **{key: unc[key] for key in ['n_samples', 'distributions', 'spread', 'seed', 'percentiles'] if key in unc})
+                _write_table(df_bands, output_dir, '{}_uncertainty_Emissions_{}'.format(name, facility), manifest,
+                             facility=facility, scenario='uncertainty', table='emissions', **entry)
+                _write_table(df_optimal, output_dir, '{}_uncertainty_Optimality_{}'.format(name, facility), manifest,
+                             facility=facility, scenario='uncertainty', budgets=budgets, table='optimality', **entry)
+
+            if run.get('sensitivity'):
+                sens = run['sensitivity']
+                df_tornado, df_sobol = sensitivity_analysis(sheets, start_year, end_year, sens['budget'], facility,
+                                                            **{key: sens[key] for key in ['spread', 'bounds', 'n_base', 'seed'] if key in sens})
+                _write_table(df_tornado, output_dir, '{}_sensitivity_Tornado_{}'.format(name, facility), manifest,
+                             facility=facility, scenario='sensitivity', budget=sens['budget'], table='tornado', **entry)
+                if df_sobol is not None:
+                    _write_table(df_sobol, output_dir, '{}_sensitivity_Sobol_{}'.format(name, facility), manifest,
+                                 facility=facility, scenario='sensitivity', budget=sens['budget'], table='sobol', **entry)
+
+            if run.get('multi_year'):
+                budgets = run['multi_year']['budgets']
+                df_summary, df_spending, df_coverage = multi_year_optimization(sheets, start_year, end_year, budgets, facility)
+                for table, df in [('emissions', df_summary), ('allocation', df_spending), ('coverage', df_coverage)]:
+                    _write_table(df, output_dir, '{}_multi_year_{}_{}'.format(name, table.capitalize(), facility), manifest,
+                                 facility=facility, scenario='multi_year', budgets=budgets, table=table, **entry)
+
+            if run.get('bundles'):
+                df_bundles, df_pairs = bundle_analysis(sheets, start_year, end_year, facility)
+                for table, df in [('bundles', df_bundles), ('interactions', df_pairs)]:
+                    _write_table(df, output_dir, '{}_bundles_{}_{}'.format(name, table.capitalize(), facility), manifest,
+                                 facility=facility, scenario='bundles', table=table, **entry)
+
+            if not any(key in run for key in ['coverage_scenario', 'budget_scenario', 'optimization']):
+                continue
+            P, progset, _ = build_project(sheets, start_year, end_year, facility)
+            status_quo = run_status_quo(P)
+            if store is not None:
+                store.append(status_quo, 'status-quo', facility, spec_run=name, start_year=start_year, end_year=end_year)
+
+            if run.get('coverage_scenario'):
+                results = run_coverage_scenario(P, progset, start_year, status_quo, workers)
+                if store is not None:
+                    store.append(results[1:], 'coverage', facility, programs=list(progset.programs.keys()), spec_run=name, start_year=start_year, end_year=end_year)
+                _write_table(emissions_table(results, start_year, facility), output_dir, '{}_coverage_scenario_Emissions_{}'.format(name, facility), manifest,
+                             facility=facility, scenario='coverage', table='emissions', **entry)
+
+            for spending in run.get('budget_scenario') or []:
+                results = run_budget_scenario(P, progset, start_year, spending, status_quo, workers)
+                if store is not None:
+                    store.append(results[1:], 'budget', facility, budgets=spending, programs=list(progset.programs.keys()), spec_run=name, start_year=start_year, end_year=end_year)
+                _write_table(emissions_table(results, start_year, facility), output_dir, '{}_budget_scenario_{:.0f}_Emissions_{}'.format(name, spending, facility), manifest,
+                             facility=facility, scenario='budget', spending=spending, table='emissions', **entry)
+
+            if run.get('optimization'):
+                opt = run['optimization']
+                results = run_optimization(P, progset, start_year, facility, opt['budgets'], status_quo, workers, method=opt.get('method', 'pso-asd'), options=opt.get('options'))
+                if store is not None:
+                    store.append(results[1:], 'optimization', facility, budgets=list(opt['budgets']), spec_run=name, start_year=start_year, end_year=end_year)
+                _write_table(emissions_table(results, start_year, facility), output_dir, '{}_optimization_Emissions_{}'.format(name, facility), manifest,
+                             facility=facility, scenario='optimization', budgets=opt['budgets'], table='emissions', **entry)
+                _write_table(allocation_table(results[1:], start_year), output_dir, '{}_optimization_Budget_Allocation_{}'.format(name, facility), manifest,
+                             facility=facility, scenario='optimization', budgets=opt['budgets'], table='allocation', **entry)
+
+        if run.get('portfolio'):
+            budget = run['portfolio']['budget']
+            df_emissions, df_allocation = portfolio_optimization(sheets, start_year, end_year, budget, facilities)
+            _write_table(df_emissions, output_dir, '{}_portfolio_Emissions'.format(name), manifest, scenario='portfolio', budget=budget, table='emissions', **entry)
+            _write_table(df_allocation, output_dir, '{}_portfolio_Budget_Allocation'.format(name), manifest, scenario='portfolio', budget=budget, table='allocation', **entry)
+
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print('Manifest saved: {}'.format(os.path.join(output_dir, 'manifest.json')))
+    return manifest
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='carbomica', description='Headless CARBOMICA runner')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='Run the scenarios listed in a spec file')
+    run_parser.add_argument('spec', help='YAML or JSON spec file')
+    run_parser.add_argument('--workers', type=int, default=None, help='Number of workers (overrides the spec)')
+    run_parser.add_argument('--output-dir', default=None, help='Output directory (overrides the spec)')
+    run_parser.add_argument('--trace', default=None, help='Save a Chrome trace of the run to this JSON file (see tracing.py)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        if args.trace:
+            tracing.enable()
+        run_spec(load_spec(args.spec), workers=args.workers, output_dir=args.output_dir)
+        if args.trace:
+            tracing.export_chrome_trace(args.trace)
+            print(tracing.summary().to_string())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+import numpy as np
+import pandas as pd
+import tracing
+'''
+Closed-form evaluation of the CARBOMICA model.
+
+The framework built by books.generate_books is purely algebraic: every emission source is
+<source>_baseline*(1-<source>_mult), co2e_emissions is their sum, and every <source>_mult is a
+Covout with 'random' coverage interaction (and the default 'best' impact interaction) over the
+effect sizes of the interventions targeting that source. This module compiles the input data
+sheet into arrays so that any number of coverage or spending vectors can be evaluated in one
+batched NumPy operation instead of one P.run_sim per point.
+'''
+
+def _drop_unnamed(df):
+    '''
+    Drop the 'Unnamed' columns that pandas creates for blank header cells in the input data sheet.
+    '''
+    return df.drop(columns=[col for col in df.columns if 'Unnamed' in str(col)])
+
+class CompiledModel:
+    '''
+    Array representation of a single facility.
+    :param facility_code: Code of the facility.
+    :param facility_label: Display name of the facility.
+    :param sources: Code names of the emission sources.
+    :param source_labels: Display names of the emission sources.
+    :param programs: Code names of the interventions.
+    :param program_labels: Display names of the interventions.
+    :param years: Data years (start_year to end_year-1), as used for the databook and progbook.
+    :param baseline: Baseline emissions per source, shape (n_sources,).
+    :param targets: Boolean matrix of interventions targeting each source, shape (n_sources, n_programs).
+    :param effects: Effect size of each intervention, shape (n_programs,).
+    :param implementation_cost: Implementation cost of each intervention, shape (n_programs,).
+    :param maintenance_cost: Annual maintenance cost of each intervention, shape (n_programs,).
+    '''
+    def __init__(self, facility_code, facility_label, sources, source_labels, programs, program_labels,
+                 years, baseline, targets, effects, implementation_cost, maintenance_cost):
+        self.facility_code = facility_code
+        self.facility_label = facility_label
+        self.sources = list(sources)
+        self.source_labels = list(source_labels)
+        self.programs = list(programs)
+        self.program_labels = list(program_labels)
+        self.years = np.asarray(years)
+        self.baseline = np.asarray(baseline, dtype=float)
+        self.targets = np.asarray(targets, dtype=bool)
+        self.effects = np.asarray(effects, dtype=float)
+        self.implementation_cost = np.asarray(implementation_cost, dtype=float)
+        self.maintenance_cost = np.asarray(maintenance_cost, dtype=float)
+        self.update()
+
+    @property
+    def unit_cost(self):
+        '''
+        Annual unit cost of each intervention, as set in books.generate_books (implementation cost
+        spread evenly over the data years plus maintenance cost).
+        '''
+        return self.implementation_cost/len(self.years) + self.maintenance_cost
+
+    def update(self):
+        '''
+        Recompute the per-source ordering of interventions. Must be called after targets or effects change.
+
+        Atomica's 'random' interaction gives every subset of interventions the largest effect in the
+        subset. Sorting the interventions targeting a source by decreasing effect, this reduces to
+        mult = sum_k effect_k * cov_k * prod_{j<k} (1-cov_j).
+        '''
+        n_sources = len(self.sources)
+        max_progs = max(1, int(self.targets.sum(axis=1).max())) if n_sources else 1
+        self._order = np.zeros((n_sources, max_progs), dtype=int)
+        self._mask = np.zeros((n_sources, max_progs), dtype=bool)
+        for i in range(n_sources):
+            idx = np.flatnonzero(self.targets[i])
+            idx = idx[np.argsort(-np.abs(self.effects[idx]), kind='stable')]
+            self._order[i, :len(idx)] = idx
+            self._mask[i, :len(idx)] = True
+        self._sorted_effects = np.where(self._mask, self.effects[self._order], 0.0)
+
+    def coverage_from_spending(self, spending):
+        '''
+        Convert annual spending on each intervention to fractional coverage.
+        :param spending: Array of spending with last dimension n_programs.
+        :return: Array of coverage in [0, 1] with the same shape.
+        '''
+        spending = np.asarray(spending, dtype=float)
+        return np.clip(spending/self.unit_cost, 0.0, 1.0)
+
+    def multipliers(self, coverage):
+        '''
+        Evaluate the <source>_mult parameters.
+        :param coverage: Array of fractional coverage with last dimension n_programs.
+        :return: Array of multipliers with last dimension n_sources.
+        '''
+        coverage = np.clip(np.asarray(coverage, dtype=float), 0.0, 1.0)
+        cov = np.where(self._mask, coverage[..., self._order], 0.0) # (..., n_sources, max_progs)
+        uncovered = np.cumprod(1 - cov, axis=-1)
+        uncovered = np.concatenate([np.ones_like(uncovered[..., :1]), uncovered[..., :-1]], axis=-1)
+        mult = np.sum(self._sorted_effects*cov*uncovered, axis=-1)
+        return np.clip(mult, 0.0, 1.0)
+
+    def source_emissions(self, coverage):
+        '''
+        Evaluate emissions per source.
+        :param coverage: Array of fractional coverage with last dimension n_programs.
+        :return: Array of emissions with last dimension n_sources.
+        '''
+        return self.baseline*(1 - self.multipliers(coverage))
+
+    def emissions(self, coverage):
+        '''
+        Evaluate total co2e_emissions.
+        :param coverage: Array of fractional coverage with last dimension n_programs.
+        :return: Array of total emissions with the batch shape of coverage.
+        '''
+        return self.source_emissions(coverage).sum(axis=-1)
+
+    def emissions_from_spending(self, spending):
+        '''
+        Evaluate total co2e_emissions for annual spending on each intervention.
+        :param spending: Array of spending with last dimension n_programs.
+        :return: Array of total emissions with the batch shape of spending.
+        '''
+        return self.emissions(self.coverage_from_spending(spending))
+
+# Facility inputs of the input data sheet: sheet name -> (CompiledModel attribute, column suffix)
+INPUT_SHEETS = {'emission data': ('baseline', ''),
+                'effect sizes': ('effects', '_effect'),
+                'implementation costs': ('implementation_cost', '_cost'),
+                'maintenance costs': ('maintenance_cost', '_cost')}
+
+def model_inputs(model):
+    '''
+    List the facility inputs of the input data sheet that a CompiledModel is built from.
+    :param model: CompiledModel
+    :return: DataFrame with one row per input: sheet and column in the input data sheet, CompiledModel
+             attribute and position in that attribute, and nominal value.
+    '''
+    rows = []
+    for sheet, (attribute, suffix) in INPUT_SHEETS.items():
+        names = model.sources if attribute == 'baseline' else model.programs
+        values = getattr(model, attribute)
+        for i, name in enumerate(names):
+            rows.append({'Sheet': sheet, 'Column': name+suffix, 'Attribute': attribute, 'Index': i, 'Value': values[i]})
+    return pd.DataFrame(rows)
+
+def read_input_data(input_data_sheet):
+    '''
+    Read every sheet of the input data sheet in a single pass.
+    :param input_data_sheet: file name of input data sheet (or a dict of DataFrames already read, or an inputs.InputData).
+    :return: dict of DataFrames keyed by sheet name.
+    '''
+    if isinstance(input_data_sheet, dict):
+        return input_data_sheet
+    from inputs import InputData
+    if isinstance(input_data_sheet, InputData):
+        return input_data_sheet.validate().to_sheets()
+    with tracing.span('read_input_data', file=str(input_data_sheet)):
+        return pd.read_excel(input_data_sheet, sheet_name=None)
+
+def compile_model(input_data_sheet, start_year, end_year, facility_code=None):
+    '''
+    Compile the input data sheet into a CompiledModel.
+    :param input_data_sheet: file name of input data sheet (or a dict of DataFrames from read_input_data).
+    :param start_year: Start year of simulations.
+    :param end_year: End year of simulations.
+    :param facility_code: Code of the facility (defaults to the first facility in the sheet).
+    :return: CompiledModel
+    '''
+    sheets = read_input_data(input_data_sheet)
+    facilities = sheets['facility'].set_index('Code Name')
+    facility_code = facilities.index[0] if facility_code is None else facility_code
+
+    interventions = sheets['interventions'].set_index('Code Name')
+    programs = list(interventions.index)
+    emission_sources = sheets['emission sources'].set_index('Code Name')
+    sources = list(emission_sources.index)
+
+    emission_data = _drop_unnamed(sheets['emission data'].set_index('facilities'))
+    targets = _drop_unnamed(sheets['emission targets'].set_index('interventions'))
+    effects = _drop_unnamed(sheets['effect sizes'].set_index('facilities'))
+    costs_implement = _drop_unnamed(sheets['implementation costs'].set_index('facilities'))
+    costs_maintain = _drop_unnamed(sheets['maintenance costs'].set_index('facilities'))
+
+    targets = targets.reindex(index=programs, columns=sources)
+    target_matrix = (targets == 'y').to_numpy().T
+
+    return CompiledModel(facility_code=facility_code,
+                         facility_label=facilities.loc[facility_code, 'Display Name'],
+                         sources=sources,
+                         source_labels=[emission_sources.loc[source, 'Display Name'] for source in sources],
+                         programs=programs,
+                         program_labels=[interventions.loc[prog, 'Display Name'] for prog in programs],
+                         years=np.arange(start_year, end_year),
+                         baseline=[emission_data.loc[facility_code, source] for source in sources],
+                         targets=target_matrix,
+                         effects=[effects.loc[facility_code, prog+'_effect'] for prog in programs],
+                         implementation_cost=[costs_implement.loc[facility_code, prog+'_cost'] for prog in programs],
+                         maintenance_cost=[costs_maintain.loc[facility_code, prog+'_cost'] for prog in programs])
+
+def compile_project(P, progset, start_year, facility_code):
+    '''
+    Compile an Atomica project and program set into a CompiledModel.
+    The progbook only stores the combined annual unit cost of each intervention, so it is returned as
+    maintenance_cost with a zero implementation_cost.
+    :param P: Atomica project.
+    :param progset: Atomica program set.
+    :param start_year: Start year of simulations.
+    :param facility_code: Code of the facility.
+    :raises ValueError: if an intervention has different effect sizes on different emission sources, which a
+                        CompiledModel (one effect size per intervention) cannot represent.
+    :return: CompiledModel
+    '''
+    programs = list(progset.programs.keys())
+    # Every emission source of the framework, including sources that no intervention targets
+    sources = [par[:-len('_baseline')] for par in P.framework.pars.index if par.endswith('_baseline')]
+    covouts = {covout.par[:-len('_mult')]: covout for covout in progset.covouts.values() if covout.pop == facility_code and covout.par.endswith('_mult')}
+
+    effects = {}
+    for source, covout in covouts.items():
+        for prog, effect in covout.progs.items():
+            effects.setdefault(prog, {})[source] = effect
+    differing = {prog: values for prog, values in effects.items() if len(set(values.values())) > 1}
+    if differing:
+        raise ValueError('Interventions with different effect sizes on different emission sources: {}'.format(
+            '; '.join('{} ({})'.format(prog, ', '.join('{}: {:g}'.format(source, effect) for source, effect in values.items())) for prog, values in differing.items())))
+
+    return CompiledModel(facility_code=facility_code,
+                         facility_label=P.data.pops[facility_code]['label'],
+                         sources=sources,
+                         source_labels=[P.framework.pars.at[source, 'display name'] for source in sources],
+                         programs=programs,
+                         program_labels=[progset.programs[prog].label for prog in programs],
+                         years=np.arange(start_year, P.settings.sim_end),
+                         baseline=[P.data.tdve[source+'_baseline'].ts[facility_code].interpolate(start_year)[0] for source in sources],
+                         targets=[[source in covouts and prog in covouts[source].progs for prog in programs] for source in sources],
+                         effects=[next(iter(effects[prog].values())) if prog in effects else 0.0 for prog in programs],
+                         implementation_cost=np.zeros(len(programs)),
+                         maintenance_cost=[progset.programs[prog].unit_cost.interpolate(start_year)[0] for prog in programs])
+
+def check_against_sim(P, model, coverages, start_year, rtol=1e-6):
+    '''
+    Check the closed-form evaluation against Atomica simulations.
+    :param P: Atomica project (with progbook loaded).
+    :param model: CompiledModel of the same facility.
+    :param coverages: Array of coverage vectors, shape (n_points, n_programs).
+    :param start_year: Start year of simulations.
+    :param rtol: Relative tolerance on co2e_emissions.
+    :return: Maximum relative difference between the two evaluations.
+    '''
+    import atomica as at
+    coverages = np.atleast_2d(coverages)
+    expected = model.emissions(coverages)
+    max_diff = 0
+    for coverage, value in zip(coverages, expected):
+        instructions = at.ProgramInstructions(start_year=start_year, coverage=dict(zip(model.programs, coverage)))
+        result = P.run_sim(parset='default', progset=P.progsets[0], progset_instructions=instructions)
+        simulated = result.get_variable('co2e_emissions', model.facility_code)[0].vals[list(result.t).index(start_year)]
+        max_diff = max(max_diff, abs(simulated - value)/max(abs(simulated), 1))
+    if max_diff > rtol:
+        raise ValueError('Closed-form emissions differ from run_sim by {:.3g} (tolerance {:.3g})'.format(max_diff, rtol))
+    return max_diff
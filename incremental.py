@@ -0,0 +1,166 @@
+import numpy as np
+from cache import load_project
+from engine import compile_model, model_inputs, read_input_data
+from mac import solve_allocation
+from results import summarize
+from scenarios import run_status_quo, run_coverage_scenario, run_budget_scenario, _optimize_budget, _optimize_budget_surrogate, _optimize_budget_swarm, _run_sim
+'''
+Incremental recomputation of the scenarios when inputs of the input data sheet change.
+
+Every input affects a known part of the books and of the scenario results (see dependencies). When the
+input data sheet is edited, a Session patches the Atomica project in place (databook and parameter set,
+Covout or program unit cost) instead of rebuilding it, and reruns only the results that depend on the
+changed inputs. Optimizations are warm-started from the previous optimal allocation.
+'''
+
+def dependencies(model):
+    '''
+    Map every input of the input data sheet to the parts of the books and the scenario results it affects.
+    Results are keyed ('status-quo', None), ('coverage', prog), ('budget', prog) and ('optimization', None)
+    for every optimized budget.
+    :param model: CompiledModel
+    :return: dict {(sheet, column): {'books': list, 'results': list}}
+    '''
+    everything = [('status-quo', None)] + [(scenario, prog) for scenario in ['coverage', 'budget'] for prog in model.programs] + [('optimization', None)]
+    graph = {}
+    for _, row in model_inputs(model).iterrows():
+        if row['Attribute'] == 'baseline':
+            source = model.sources[row['Index']]
+            books, results = [('databook', source+'_baseline')], everything
+        elif row['Attribute'] == 'effects':
+            prog = model.programs[row['Index']]
+            books = [('covout', source+'_mult') for source in np.array(model.sources)[model.targets[:, row['Index']]]]
+            results = [('coverage', prog), ('budget', prog), ('optimization', None)]
+        else:
+            prog = model.programs[row['Index']]
+            books, results = [('program', prog)], [('budget', prog), ('optimization', None)]
+        graph[(row['Sheet'], row['Column'])] = {'books': books, 'results': results}
+    return graph
+
+class Session:
+    '''
+    Atomica project, compiled model and scenario results of one facility, kept up to date incrementally.
+    :param input_data_sheet: file name of input data sheet (or a dict of DataFrames from engine.read_input_data).
+    :param start_year: Start year of simulations.
+    :param end_year: End year of simulations.
+    :param spending: Spending on individual interventions for the budget scenario.
+    :param budgets: List of budgets to optimize.
+    :param method: 'pso-asd', 'surrogate', 'swarm' or 'mac' (see scenarios.run_optimization).
+    :param workers: Number of workers for the per-intervention simulations.
+    '''
+    def __init__(self, input_data_sheet, start_year, end_year, spending, budgets, method='pso-asd', workers=1):
+        self.start_year = start_year
+        self.end_year = end_year
+        self.spending = spending
+        self.budgets = list(budgets)
+        self.method = method
+        self.workers = workers
+        self.results = {}
+        self.allocations = {} # optimal spending per budget, {budget: {prog: spending}}
+        self._build(read_input_data(input_data_sheet))
+
+    def _build(self, sheets):
+        self.P, self.progset, self.facility_code = load_project(sheets, self.start_year, self.end_year)
+        self.model = compile_model(sheets, self.start_year, self.end_year, self.facility_code)
+        self.graph = dependencies(self.model)
+        self.results, self.allocations = {}, {}
+        self.run(list(self._keys()))
+
+    def _keys(self):
+        yield ('status-quo', None)
+        for scenario in ['coverage', 'budget']:
+            for prog in self.model.programs:
+                yield (scenario, prog)
+        yield ('optimization', None)
+
+    def _patch(self, sheet, column, value):
+        '''
+        Write a new input value into the Atomica project and the compiled model.
+        '''
+        import atomica as at
+        row = model_inputs(self.model).set_index(['Sheet', 'Column']).loc[(sheet, column)]
+        getattr(self.model, row['Attribute'])[row['Index']] = value
+        for book, name in self.graph[(sheet, column)]['books']:
+            if book == 'databook':
+                for ts in [self.P.data.tdve[name].ts[self.facility_code], self.P.parsets[0].pars[name].ts[self.facility_code]]:
+                    ts.vals = [value]*len(ts.t)
+            elif book == 'covout':
+                covout = self.progset.covouts[(name, self.facility_code)]
+                covout.progs[self.model.programs[row['Index']]] = value
+                covout.update_outcomes()
+        if row['Attribute'] in ['implementation_cost', 'maintenance_cost']:
+            prog = self.model.programs[row['Index']]
+            self.progset.programs[prog].unit_cost = at.TimeSeries(assumption=self.model.unit_cost[row['Index']], units='$/person/year')
+
+    def update(self, input_data_sheet):
+        '''
+        Bring the project and results up to date with an edited input data sheet.
+        The project is rebuilt only if the facility, interventions, emission sources or targets changed.
+        :param input_data_sheet: file name of input data sheet (or a dict of DataFrames from engine.read_input_data).
+        :return: list of changed inputs (sheet, column), list of recomputed result keys.
+        '''
+        sheets = read_input_data(input_data_sheet)
+        model = compile_model(sheets, self.start_year, self.end_year)
+        if (model.facility_code, model.programs, model.sources) != (self.facility_code, self.model.programs, self.model.sources) or np.any(model.targets != self.model.targets):
+            self._build(sheets)
+            return list(self.graph), list(self._keys())
+
+        old, new = model_inputs(self.model), model_inputs(model)
+        changed = [(sheet, column) for sheet, column, a, b in zip(old['Sheet'], old['Column'], old['Value'], new['Value']) if a != b]
+        stale = []
+        for sheet, column in changed:
+            self._patch(sheet, column, new.set_index(['Sheet', 'Column']).loc[(sheet, column), 'Value'])
+            stale += [key for key in self.graph[(sheet, column)]['results'] if key not in stale]
+        if changed:
+            self.model.update()
+            self.run(stale)
+        return changed, stale
+
+    def run(self, keys):
+        '''
+        Run the simulations (or optimizations) of the given result keys.
+        :param keys: list of result keys (see dependencies).
+        '''
+        import atomica as at
+        if ('status-quo', None) in keys:
+            self.results[('status-quo', None)] = run_status_quo(self.P)
+        status_quo = self.results[('status-quo', None)]
+        for scenario, run_scenario, args in [('coverage', run_coverage_scenario, ()), ('budget', run_budget_scenario, (self.spending,))]:
+            programs = [prog for key, prog in keys if key == scenario]
+            if programs:
+                results = run_scenario(self.P, self.progset, self.start_year, *args, status_quo=status_quo, workers=self.workers, programs=programs)
+                self.results.update({(scenario, prog): result for prog, result in zip(programs, results[1:])})
+        if ('optimization', None) in keys:
+            for budget in self.budgets:
+                name = '${:0,.0f}'.format(budget)
+                if self.method == 'mac':
+                    allocation = dict(zip(self.model.programs, solve_allocation(self.model, budget)))
+                    instructions = at.ProgramInstructions(start_year=self.start_year, alloc=allocation)
+                    result = summarize(_run_sim(self.P, instructions, name))
+                elif self.method in ['surrogate', 'swarm']:
+                    optimize_budget = _optimize_budget_surrogate if self.method == 'surrogate' else _optimize_budget_swarm
+                    result = summarize(optimize_budget(self.P, self.model.programs, self.start_year, budget, name))
+                    allocation = dict(zip(result.programs, result.spending[:, 0]))
+                else:
+                    result = summarize(_optimize_budget(self.P, self.model.programs, self.start_year, budget, name, initial=self.allocations.get(budget)))
+                    allocation = dict(zip(result.programs, result.spending[:, 0]))
+                self.results[('optimization', budget)] = result
+                self.allocations[budget] = allocation
+
+    def coverage_results(self):
+        '''
+        :return: list of ResultSummary, as returned by scenarios.run_coverage_scenario.
+        '''
+        return [self.results[('status-quo', None)]] + [self.results[('coverage', prog)] for prog in self.model.programs]
+
+    def budget_results(self):
+        '''
+        :return: list of ResultSummary, as returned by scenarios.run_budget_scenario.
+        '''
+        return [self.results[('status-quo', None)]] + [self.results[('budget', prog)] for prog in self.model.programs]
+
+    def optimization_results(self):
+        '''
+        :return: list of ResultSummary, as returned by scenarios.run_optimization.
+        '''
+        return [self.results[('status-quo', None)]] + [self.results[('optimization', budget)] for budget in self.budgets]
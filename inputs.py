@@ -0,0 +1,190 @@
+import numpy as np
+import pandas as pd
+from engine import read_input_data, _drop_unnamed
+'''
+Typed in-memory model of the input data sheet.
+
+InputData holds the facilities, emission sources, interventions, target matrix, effect sizes and costs as
+plain dicts keyed by code name, so that the Streamlit UI, the headless runner and the checks can populate it
+directly instead of writing cells into a workbook. validate() reports every inconsistency at once (e.g. an
+intervention without an effect size or a cost) before any book is built. Every function taking an input data
+sheet also takes an InputData (see engine.read_input_data); Excel is only read or written, in one pass, by
+from_excel and to_excel.
+'''
+
+SHEETS = ['facility', 'emission sources', 'emission data', 'interventions', 'emission targets', 'effect sizes', 'implementation costs', 'maintenance costs']
+
+class InputDataError(ValueError):
+    '''
+    Inconsistent input data.
+    :param problems: list of descriptions of every problem found.
+    '''
+    def __init__(self, problems):
+        super().__init__('Invalid input data:\n' + '\n'.join(' - ' + problem for problem in problems))
+        self.problems = problems
+
+class InputData:
+    '''
+    Input data of one or more facilities.
+    :param facilities: dict {facility code: display name}.
+    :param sources: dict {emission source code: display name}.
+    :param interventions: dict {intervention code: display name}.
+    :param targets: dict {intervention code: list of the emission source codes it targets}.
+    :param emissions: dict {facility code: {emission source code: baseline emissions}}.
+    :param effects: dict {facility code: {intervention code: effect size in [0, 1]}}.
+    :param implementation_costs: dict {facility code: {intervention code: implementation cost}}.
+    :param maintenance_costs: dict {facility code: {intervention code: annual maintenance cost}}.
+    '''
+    def __init__(self, facilities=None, sources=None, interventions=None, targets=None, emissions=None, effects=None,
+                 implementation_costs=None, maintenance_costs=None):
+        self.facilities = dict(facilities or {})
+        self.sources = dict(sources or {})
+        self.interventions = dict(interventions or {})
+        self.targets = {prog: list(targeted) for prog, targeted in (targets or {}).items()}
+        self.emissions = {facility: dict(values) for facility, values in (emissions or {}).items()}
+        self.effects = {facility: dict(values) for facility, values in (effects or {}).items()}
+        self.implementation_costs = {facility: dict(values) for facility, values in (implementation_costs or {}).items()}
+        self.maintenance_costs = {facility: dict(values) for facility, values in (maintenance_costs or {}).items()}
+
+    def add_facility(self, code, label, emissions, effects, implementation_costs, maintenance_costs):
+        '''
+        Add (or replace) a facility and its data.
+        :param code: Facility code.
+        :param label: Display name of the facility.
+        :param emissions: dict {emission source code: baseline emissions}.
+        :param effects: dict {intervention code: effect size}.
+        :param implementation_costs: dict {intervention code: implementation cost}.
+        :param maintenance_costs: dict {intervention code: annual maintenance cost}.
+        '''
+        self.facilities[code] = label
+        self.emissions[code] = dict(emissions)
+        self.effects[code] = dict(effects)
+        self.implementation_costs[code] = dict(implementation_costs)
+        self.maintenance_costs[code] = dict(maintenance_costs)
+
+    def select(self, interventions):
+        '''
+        Input data restricted to some of the interventions.
+        :param interventions: list of intervention codes, in the order of the new input data.
+        :return: InputData
+        '''
+        unknown = [prog for prog in interventions if prog not in self.interventions]
+        if unknown:
+            raise InputDataError(['Unknown intervention "{}"'.format(prog) for prog in unknown])
+        def per_facility(values):
+            return {facility: {prog: data[prog] for prog in interventions if prog in data} for facility, data in values.items()}
+        return InputData(self.facilities, self.sources, {prog: self.interventions[prog] for prog in interventions},
+                         {prog: self.targets.get(prog, []) for prog in interventions}, self.emissions, per_facility(self.effects),
+                         per_facility(self.implementation_costs), per_facility(self.maintenance_costs))
+
+    def problems(self):
+        '''
+        :return: list of descriptions of every inconsistency of the input data (empty if valid).
+        '''
+        problems = []
+        for name, values in [('facility', self.facilities), ('emission source', self.sources), ('intervention', self.interventions)]:
+            if not values:
+                problems.append('No {}'.format(name))
+        for prog, targeted in self.targets.items():
+            if prog not in self.interventions:
+                problems.append('Emission targets of unknown intervention "{}"'.format(prog))
+            problems += ['Intervention "{}" targets unknown emission source "{}"'.format(prog, source) for source in targeted if source not in self.sources]
+        problems += ['Intervention "{}" targets no emission source'.format(prog) for prog in self.interventions if not self.targets.get(prog)]
+
+        def check(table, facility, keys, name, low=0.0, high=np.inf):
+            values = table.get(facility, {})
+            for key in keys:
+                value = values.get(key)
+                if value is None or isinstance(value, str) or not np.isfinite(value):
+                    problems.append('Missing {} of "{}" for facility "{}"'.format(name, key, facility))
+                elif not low <= value <= high:
+                    problems.append('{} of "{}" for facility "{}" is {}, outside [{}, {}]'.format(name.capitalize(), key, facility, value, low, high))
+
+        for facility in self.facilities:
+            check(self.emissions, facility, self.sources, 'emissions')
+            check(self.effects, facility, self.interventions, 'effect size', high=1.0)
+            check(self.implementation_costs, facility, self.interventions, 'implementation cost')
+            check(self.maintenance_costs, facility, self.interventions, 'maintenance cost')
+        for name, table in [('emission data', self.emissions), ('effect sizes', self.effects), ('implementation costs', self.implementation_costs),
+                            ('maintenance costs', self.maintenance_costs)]:
+            problems += ['{} of unknown facility "{}"'.format(name.capitalize(), facility) for facility in table if facility not in self.facilities]
+        return problems
+
+    def validate(self):
+        '''
+        Check the consistency of the input data.
+        :raises InputDataError: listing every problem found.
+        :return: self
+        '''
+        problems = self.problems()
+        if problems:
+            raise InputDataError(problems)
+        return self
+
+    def to_sheets(self):
+        '''
+        :return: dict of DataFrames keyed by sheet name, in the layout of engine.read_input_data.
+        '''
+        facilities, sources, programs = list(self.facilities), list(self.sources), list(self.interventions)
+
+        def per_facility(table, keys, suffix=''):
+            df = pd.DataFrame([[table.get(facility, {}).get(key, np.nan) for key in keys] for facility in facilities],
+                              columns=[key + suffix for key in keys], dtype=float)
+            df.insert(0, 'facilities', facilities)
+            return df
+
+        targets = pd.DataFrame([['y' if source in self.targets.get(prog, []) else None for source in sources] for prog in programs], columns=sources, dtype=object)
+        targets.insert(0, 'interventions', programs)
+        return {'facility': pd.DataFrame({'Code Name': facilities, 'Display Name': list(self.facilities.values())}),
+                'emission sources': pd.DataFrame({'Code Name': sources, 'Display Name': list(self.sources.values())}),
+                'emission data': per_facility(self.emissions, sources),
+                'interventions': pd.DataFrame({'Code Name': programs, 'Display Name': list(self.interventions.values())}),
+                'emission targets': targets,
+                'effect sizes': per_facility(self.effects, programs, '_effect'),
+                'implementation costs': per_facility(self.implementation_costs, programs, '_cost'),
+                'maintenance costs': per_facility(self.maintenance_costs, programs, '_cost')}
+
+    @classmethod
+    def from_sheets(cls, input_data_sheet):
+        '''
+        :param input_data_sheet: file name of input data sheet (or a dict of DataFrames from engine.read_input_data).
+        :return: InputData (not validated).
+        '''
+        sheets = read_input_data(input_data_sheet)
+        missing = [sheet for sheet in SHEETS if sheet not in sheets]
+        if missing:
+            raise InputDataError(['Missing sheet "{}"'.format(sheet) for sheet in missing])
+
+        def labels(sheet):
+            return dict(zip(sheets[sheet]['Code Name'], sheets[sheet]['Display Name']))
+
+        def per_facility(sheet, suffix=''):
+            df = _drop_unnamed(sheets[sheet].set_index('facilities'))
+            return {facility: {column[:len(column) - len(suffix)]: value for column, value in row.items() if column.endswith(suffix) and pd.notna(value)}
+                    for facility, row in df.iterrows()}
+
+        targets = _drop_unnamed(sheets['emission targets'].set_index('interventions'))
+        return cls(facilities=labels('facility'), sources=labels('emission sources'), interventions=labels('interventions'),
+                   targets={prog: [source for source, value in row.items() if value == 'y'] for prog, row in targets.iterrows() if pd.notna(prog)},
+                   emissions=per_facility('emission data'), effects=per_facility('effect sizes', '_effect'),
+                   implementation_costs=per_facility('implementation costs', '_cost'), maintenance_costs=per_facility('maintenance costs', '_cost'))
+
+    @classmethod
+    def from_excel(cls, file_name):
+        '''
+        Read and validate an input data sheet (every sheet is read in one pass).
+        :param file_name: file name of input data sheet.
+        :return: InputData
+        '''
+        return cls.from_sheets(read_input_data(file_name)).validate()
+
+    def to_excel(self, file_name):
+        '''
+        Write the input data sheet in one pass.
+        :param file_name: Excel file name (or a writable binary buffer).
+        '''
+        with pd.ExcelWriter(file_name, engine='xlsxwriter') as writer:
+            for sheet_name, df in self.to_sheets().items():
+                df.to_excel(writer, sheet_name=sheet_name, index=False)
+        if isinstance(file_name, str):
+            print('Input data sheet saved: {}'.format(file_name))
@@ -0,0 +1,303 @@
+import json
+import os
+import pickle
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import tracing
+from engine import read_input_data
+'''
+Background jobs for the Streamlit front end.
+
+Book generation, scenario, optimization and program check runs are submitted to a pool of worker processes shared by
+every session of the Streamlit server, so the UI never blocks and several planners can run jobs at once.
+Every job lives in its own folder (results/jobs/<job id>/) holding a copy of its input data, its state
+(job.json), its progress events (progress.jsonl) and its result tables (result.pkl). A browser rerun, or
+another session, can therefore reattach to a job by its id. Workers report progress through tracing
+listeners (simulations run, optimizer evaluations and best objective), and check for a cancel request at
+each of these events.
+'''
+
+JOB_KINDS = ['generate_books', 'coverage', 'budget', 'optimization', 'program_checks']
+_PROGRESS_INTERVAL = 0.25 # minimum time between optimizer progress events written to disk (seconds)
+
+class JobCancelled(Exception):
+    pass
+
+def _write_json(file_name, data):
+    '''
+    Write a JSON file atomically, so that readers never see a partial file.
+    '''
+    temporary_file = '{}.{}.tmp'.format(file_name, os.getpid())
+    with open(temporary_file, 'w') as f:
+        json.dump(data, f, default=str)
+    os.replace(temporary_file, file_name)
+
+def _read_json(file_name):
+    with open(file_name) as f:
+        return json.load(f)
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+class _Reporter:
+    '''
+    Tracing listener of a running job: appends progress events (at most every _PROGRESS_INTERVAL) and
+    raises JobCancelled on a cancel request, checked at every event.
+    '''
+    def __init__(self, folder, total, by_simulations=False):
+        self.folder = folder
+        self.by_simulations = by_simulations # progress counted in simulations rather than steps
+        self.state = {'stage': None, 'done': 0, 'total': total, 'simulations': 0, 'evaluations': 0, 'objective': None}
+        self.last_write = 0.0
+        self.last_count = tracing.counters().get('simulations', 0) # counters are cumulative over the jobs of a worker
+
+    def __call__(self, event):
+        if event['name'] == 'simulations':
+            count = event['args']['simulations']
+            self.state['simulations'] += count - self.last_count if count >= self.last_count else count # a single event may count a batch of simulations
+            self.last_count = count
+            if self.by_simulations:
+                self.state['done'] = self.state['simulations']
+        elif event['name'] == 'objective':
+            self.state['evaluations'] += 1
+            value = event['args']['value']
+            self.state['objective'] = value if self.state['objective'] is None else min(self.state['objective'], value)
+            self.state['stage'] = event['args']['stage']
+        else:
+            return
+        self.check_cancel()
+        if time.time() - self.last_write >= _PROGRESS_INTERVAL:
+            self.write()
+
+    def step(self, stage=None, done=None):
+        '''
+        Record the progress of the job itself (e.g. a budget optimized).
+        '''
+        if stage is not None:
+            self.state['stage'] = stage
+        if done is not None:
+            self.state['done'] = done
+        self.write()
+
+    def check_cancel(self):
+        if os.path.exists(os.path.join(self.folder, 'cancel')):
+            raise JobCancelled()
+
+    def write(self):
+        self.check_cancel()
+        self.last_write = time.time()
+        with open(os.path.join(self.folder, 'progress.jsonl'), 'a') as f:
+            f.write(json.dumps(dict(self.state, time=self.last_write)) + '\n')
+
+def _execute(kind, sheets, start_year, end_year, params, reporter):
+    '''
+    Run the work of a job and return its result tables.
+    '''
+    from cache import load_project
+    from results import emissions_table, allocation_table
+    from scenarios import run_status_quo, run_coverage_scenario, run_budget_scenario, run_optimization
+
+    reporter.step('building project')
+    P, progset, facility_code = load_project(sheets, start_year, end_year, export=(kind == 'generate_books'))
+    if kind == 'generate_books':
+        return {'facility_code': facility_code}
+
+    reporter.step('status-quo')
+    status_quo = run_status_quo(P)
+    if kind == 'coverage':
+        reporter.step('simulations')
+        results = run_coverage_scenario(P, progset, start_year, status_quo)
+        return {'facility_code': facility_code, 'emissions': emissions_table(results, start_year, facility_code)}
+    if kind == 'budget':
+        reporter.step('simulations')
+        results = run_budget_scenario(P, progset, start_year, params['spending'], status_quo)
+        return {'facility_code': facility_code, 'emissions': emissions_table(results, start_year, facility_code)}
+    if kind == 'program_checks':
+        return _program_checks(P, progset, sheets, start_year, end_year, facility_code, status_quo, reporter)
+
+    results = [status_quo]
+    for i, budget in enumerate(params['budgets']):
+        reporter.step('budget ${:0,.0f}'.format(budget), i)
+        results += run_optimization(P, progset, start_year, facility_code, [budget], status_quo, method=params.get('method', 'pso-asd'), options=params.get('options'))[1:]
+    reporter.step('done', len(params['budgets']))
+    return {'facility_code': facility_code, 'emissions': emissions_table(results, start_year, facility_code),
+            'allocation': allocation_table(results[1:], start_year)}
+
+def _program_checks(P, progset, sheets, start_year, end_year, facility_code, status_quo, reporter):
+    '''
+    Checks of program_checks.py on an uploaded input data sheet: zero, full and single-intervention
+    coverage simulations, and the closed-form evaluator against run_sim at those and random coverages.
+    '''
+    import atomica as at
+    import numpy as np
+    from engine import compile_model, check_against_sim
+    from results import emissions_table
+    from scenarios import run_coverage_scenario, run_program_sims
+
+    reporter.step('simulations')
+    programs = list(progset.programs.keys())
+    instructions = [at.ProgramInstructions(start_year=start_year, coverage={prog: value for prog in programs}) for value in [0, 1]]
+    results = run_coverage_scenario(P, progset, start_year, status_quo) + run_program_sims(P, instructions, ['No coverage', 'Full coverage'])
+
+    reporter.step('closed-form check')
+    model = compile_model(sheets, start_year, end_year, facility_code)
+    n = len(model.programs)
+    coverages = np.vstack([np.zeros(n), np.ones(n), np.eye(n), np.random.default_rng().random((20, n))])
+    max_diff = check_against_sim(P, model, coverages, start_year) # raises if the two evaluations differ
+    df_checks = pd.DataFrame({'Check': ['Closed-form emissions vs run_sim'], 'Coverage vectors': [len(coverages)], 'Max relative difference': [max_diff]})
+    return {'facility_code': facility_code, 'emissions': emissions_table(results, start_year, facility_code), 'checks': df_checks}
+
+def _run_job(folder):
+    '''
+    Worker entry point: run the job stored in folder and record its state and result.
+    '''
+    state_file = os.path.join(folder, 'job.json')
+    job = _read_json(state_file)
+    if os.path.exists(os.path.join(folder, 'cancel')):
+        _write_json(state_file, dict(job, status='cancelled', finished=time.time()))
+        return
+    job = dict(job, status='running', started=time.time(), pid=os.getpid())
+    _write_json(state_file, job)
+    with open(os.path.join(folder, 'input.pkl'), 'rb') as f:
+        sheets = pickle.load(f)
+
+    total = {'coverage': len(sheets['interventions']) + 1, 'budget': len(sheets['interventions']) + 1,
+             'program_checks': len(sheets['interventions']) + 3, 'optimization': len(job['params'].get('budgets', []))}.get(job['kind'], 1)
+    reporter = _Reporter(folder, total, by_simulations=job['kind'] in ['coverage', 'budget', 'program_checks'])
+    tracing.add_listener(reporter)
+    try:
+        result = _execute(job['kind'], sheets, job['start_year'], job['end_year'], job['params'], reporter)
+        reporter.write() # final counts, which the throttled events may not have written
+        with open(os.path.join(folder, 'result.pkl'), 'wb') as f:
+            pickle.dump(result, f)
+        job = dict(job, status='done')
+    except JobCancelled:
+        job = dict(job, status='cancelled')
+    except Exception as e:
+        job = dict(job, status='failed', error='{}: {}'.format(type(e).__name__, e))
+    finally:
+        tracing.remove_listener(reporter)
+    _write_json(state_file, dict(job, finished=time.time()))
+
+class JobQueue:
+    '''
+    Queue of background jobs run on a local process pool, with their state persisted on disk.
+    :param root: Folder holding one subfolder per job.
+    :param workers: Number of worker processes (defaults to the number of CPUs).
+    '''
+    def __init__(self, root='results/jobs', workers=None):
+        self.root = root
+        self.workers = workers or os.cpu_count()
+        self._pool = None
+        self._futures = {}
+
+    def _folder(self, job_id):
+        return os.path.join(self.root, job_id)
+
+    def submit(self, kind, input_data_sheet, start_year, end_year, owner=None, **params):
+        '''
+        Submit a job. The input data sheet is copied into the job folder, so later edits of the file do
+        not affect the job.
+        :param kind: 'generate_books', 'coverage', 'budget' (params: spending), 'optimization' (params: budgets, method, options) or 'program_checks'.
+        :param input_data_sheet: file name of input data sheet (or a dict of DataFrames from engine.read_input_data).
+        :param start_year: Start year of simulations.
+        :param end_year: End year of simulations.
+        :param owner: Name of the planner (or session) submitting the job, for listing.
+        :param params: Parameters of the job.
+        :return: job id.
+        '''
+        if kind not in JOB_KINDS:
+            raise ValueError('Unknown job kind "{}" (expected one of {})'.format(kind, JOB_KINDS))
+        job_id = uuid.uuid4().hex[:12]
+        folder = self._folder(job_id)
+        os.makedirs(folder)
+        with open(os.path.join(folder, 'input.pkl'), 'wb') as f:
+            pickle.dump(read_input_data(input_data_sheet), f)
+        _write_json(os.path.join(folder, 'job.json'), {'id': job_id, 'kind': kind, 'owner': owner, 'start_year': start_year, 'end_year': end_year,
+                                                       'params': params, 'status': 'queued', 'submitted': time.time()})
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        self._futures[job_id] = self._pool.submit(_run_job, folder)
+        return job_id
+
+    def status(self, job_id):
+        '''
+        State of a job, with its latest progress.
+        :param job_id: job id.
+        :return: dict with 'status' ('queued', 'running', 'done', 'failed', 'cancelled' or 'lost' if its worker died) and 'progress'.
+        '''
+        job = _read_json(os.path.join(self._folder(job_id), 'job.json'))
+        if job['status'] == 'running' and not _alive(job['pid']):
+            job['status'] = 'lost'
+        elif job['status'] == 'queued' and job_id not in self._futures:
+            job['status'] = 'lost' # queued on a server that has stopped
+        progress = self.progress(job_id)
+        job['progress'] = progress[-1] if progress else None
+        return job
+
+    def progress(self, job_id, since=0):
+        '''
+        Progress events of a job.
+        :param job_id: job id.
+        :param since: Number of events already read.
+        :return: list of progress events (dicts with stage, done, total, simulations, evaluations, objective).
+        '''
+        file_name = os.path.join(self._folder(job_id), 'progress.jsonl')
+        if not os.path.exists(file_name):
+            return []
+        with open(file_name) as f:
+            return [json.loads(line) for line in f.readlines()[since:] if line.endswith('\n')]
+
+    def result(self, job_id):
+        '''
+        :param job_id: job id.
+        :return: dict of result tables (DataFrames) and facility code, or None if the job is not done.
+        '''
+        file_name = os.path.join(self._folder(job_id), 'result.pkl')
+        if not os.path.exists(file_name):
+            return None
+        with open(file_name, 'rb') as f:
+            return pickle.load(f)
+
+    def cancel(self, job_id):
+        '''
+        Cancel a job: a queued job is removed from the queue, a running job stops at its next progress event.
+        '''
+        open(os.path.join(self._folder(job_id), 'cancel'), 'w').close()
+        future = self._futures.get(job_id)
+        if future is not None and future.cancel():
+            job_file = os.path.join(self._folder(job_id), 'job.json')
+            _write_json(job_file, dict(_read_json(job_file), status='cancelled', finished=time.time()))
+
+    def jobs(self, owner=None):
+        '''
+        List the jobs, most recent first.
+        :param owner: Only list the jobs of this owner.
+        :return: DataFrame with one row per job.
+        '''
+        ids = [name for name in os.listdir(self.root) if os.path.exists(os.path.join(self.root, name, 'job.json'))] if os.path.exists(self.root) else []
+        jobs = [self.status(job_id) for job_id in ids]
+        df = pd.DataFrame([job for job in jobs if owner is None or job['owner'] == owner], columns=['id', 'kind', 'owner', 'status', 'submitted', 'progress'])
+        df['submitted'] = pd.to_datetime(df['submitted'], unit='s')
+        return df.sort_values('submitted', ascending=False).reset_index(drop=True)
+
+    def shutdown(self, wait=True):
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
+
+_queues = {}
+
+def get_queue(root='results/jobs', workers=None):
+    '''
+    Job queue shared by every session of the current process (e.g. the Streamlit server).
+    '''
+    if root not in _queues:
+        _queues[root] = JobQueue(root, workers)
+    return _queues[root]
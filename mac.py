@@ -0,0 +1,199 @@
+import numpy as np
+import pandas as pd
+'''
+Deterministic allocation solver based on the marginal abatement cost (MAC) structure of the model.
+
+Unit costs are linear and coverage is capped at 1, so an allocation is a coverage vector c with
+sum(unit_cost*c) <= budget. The 'random' interaction makes abatement the multilinear extension of a
+submodular set function, whose cross partial derivatives are nonpositive, so the cross partials of
+emissions are nonnegative. Moving budget from intervention j to intervention i changes c_i and c_j in
+opposite directions, so emissions are concave along any such direction (and linear in the coverage of
+a single intervention). A concave function on the segment between two partially funded interventions
+is minimal at one of its ends, so an optimal allocation covers a set of interventions fully and at most
+one intervention partially, which can be enumerated exactly in one batched evaluation for small
+numbers of interventions. Larger problems fall back to a greedy walk down the MAC curve.
+'''
+
+_MAX_EXACT = 16 # largest number of interventions solved by exhaustive enumeration
+_CHUNK = 4096 # number of intervention sets evaluated per batch
+_CANDIDATES = 2**22 # number of (budget, set, intervention) candidates evaluated per batch by _best_emissions
+
+def _subsets(n):
+    '''
+    Return every subset of n interventions as a boolean matrix of shape (2**n, n).
+    '''
+    return ((np.arange(2**n)[:, None] >> np.arange(n)) & 1).astype(bool)
+
+def _set_emissions(baseline, effects, targets):
+    '''
+    Emissions of every set of fully covered interventions, in the order of _subsets, shape (..., 2**n).
+    With full coverage, the 'random' interaction gives each source the largest effect in the set, which is
+    built up one intervention at a time over the sets in binary order.
+    :param baseline: Baseline emissions, shape (..., n_sources).
+    :param effects: Effect sizes, shape (..., n_programs).
+    :param targets: Boolean matrix of interventions targeting each source, shape (n_sources, n_programs).
+    '''
+    effects = effects[..., :, None]*targets.T # (..., n_programs, n_sources)
+    best_effect = np.zeros(effects.shape[:-2] + (1, targets.shape[0]))
+    for j in range(targets.shape[1]):
+        best_effect = np.concatenate([best_effect, np.maximum(best_effect, effects[..., j:j+1, :])], axis=-2)
+    return np.sum(baseline[..., None, :]*(1 - np.clip(best_effect, 0.0, 1.0)), axis=-1)
+
+def _fractional_coverage(leftover, unit_cost):
+    '''
+    Coverage bought by the leftover budget for each intervention, shape (n_sets, n_programs).
+    '''
+    return np.clip(np.divide(leftover[:, None], unit_cost[None, :], out=np.ones((len(leftover), len(unit_cost))), where=unit_cost[None, :] > 0), 0.0, 1.0)
+
+def _solve_exact(model, budget):
+    '''
+    Enumerate every set of fully covered interventions within budget, each extended with the leftover
+    budget on one further intervention, and return the coverage with the lowest emissions.
+    '''
+    unit_cost = model.unit_cost
+    n = len(unit_cost)
+    best_coverage, best_emissions = np.zeros(n), np.inf
+    all_sets = _subsets(n)
+    for start in range(0, 2**n, _CHUNK):
+        sets = all_sets[start:start + _CHUNK]
+        costs = sets @ unit_cost
+        sets, costs = sets[costs <= budget*(1 + 1e-12)], costs[costs <= budget*(1 + 1e-12)]
+        if len(sets) == 0:
+            continue
+        fractional = _fractional_coverage(np.maximum(budget - costs, 0.0), unit_cost) * ~sets
+        coverage = np.repeat(sets[:, None, :].astype(float), n + 1, axis=1) # (n_sets, n_programs+1, n_programs)
+        coverage[:, 1:, :] += fractional[:, :, None] * np.eye(n)[None]
+        emissions = model.emissions(coverage)
+        i, j = np.unravel_index(np.argmin(emissions), emissions.shape)
+        if emissions[i, j] < best_emissions:
+            best_coverage, best_emissions = coverage[i, j], emissions[i, j]
+    return best_coverage
+
+def _solve_greedy(model, budget):
+    '''
+    Repeatedly spend on the intervention with the largest abatement per dollar, buying as much
+    coverage as the remaining budget allows.
+    '''
+    unit_cost = model.unit_cost
+    n = len(unit_cost)
+    coverage = np.zeros(n)
+    leftover = budget
+    while leftover > 0 and np.any(coverage < 1):
+        remaining = np.flatnonzero(coverage < 1)
+        extra = np.clip(_fractional_coverage(np.array([leftover]), unit_cost[remaining])[0], 0.0, 1 - coverage[remaining])
+        trial = np.repeat(coverage[None], len(remaining), axis=0)
+        trial[np.arange(len(remaining)), remaining] += extra
+        abatement = model.emissions(coverage) - model.emissions(trial)
+        spent = extra*unit_cost[remaining]
+        ratio = np.divide(abatement, spent, out=np.full(len(remaining), np.inf), where=spent > 0)
+        ratio[abatement <= 0] = -np.inf
+        best = np.argmax(ratio)
+        if ratio[best] == -np.inf:
+            break
+        coverage = trial[best]
+        leftover -= spent[best]
+    return coverage
+
+def solve_allocation(model, budget, method='auto'):
+    '''
+    Find the spending allocation that minimizes emissions for a total budget.
+    :param model: CompiledModel (see engine.py).
+    :param budget: Total budget.
+    :param method: 'exact', 'greedy', or 'auto' (exact for up to 16 interventions).
+    :return: Array of spending per intervention (sums to at most the budget; any budget beyond the
+             cost of full coverage is left unallocated).
+    '''
+    if method == 'auto':
+        method = 'exact' if len(model.programs) <= _MAX_EXACT else 'greedy'
+    if method == 'exact':
+        coverage = _solve_exact(model, budget)
+    elif method == 'greedy':
+        coverage = _solve_greedy(model, budget)
+    else:
+        raise ValueError('Unknown method "{}" (expected "exact", "greedy" or "auto")'.format(method))
+    return coverage*model.unit_cost
+
+def mac_curve(model):
+    '''
+    Build the marginal abatement cost curve: interventions in the order of largest abatement per dollar,
+    where the abatement of each intervention accounts for the interventions already ahead of it on
+    shared emission sources.
+    :param model: CompiledModel (see engine.py).
+    :return: DataFrame with one row per intervention.
+    '''
+    unit_cost = model.unit_cost
+    coverage = np.zeros(len(model.programs))
+    emissions = model.emissions(coverage)
+    rows = []
+    for _ in model.programs:
+        remaining = np.flatnonzero(coverage < 1)
+        trial = np.repeat(coverage[None], len(remaining), axis=0)
+        trial[np.arange(len(remaining)), remaining] = 1
+        abatement = emissions - model.emissions(trial)
+        ratio = np.divide(abatement, unit_cost[remaining], out=np.full(len(remaining), np.inf), where=unit_cost[remaining] > 0)
+        best = np.argmax(ratio)
+        prog = remaining[best]
+        coverage = trial[best]
+        emissions = emissions - abatement[best]
+        rows.append({'Intervention': model.program_labels[prog],
+                     'Cost': unit_cost[prog],
+                     'Abatement (CO2e)': abatement[best],
+                     'Abatement per $': ratio[best],
+                     'Cost per CO2e': unit_cost[prog]/abatement[best] if abatement[best] > 0 else np.inf,
+                     'Cumulative cost': None,
+                     'Emissions (CO2e)': emissions})
+    df_mac = pd.DataFrame(rows)
+    df_mac['Cumulative cost'] = df_mac['Cost'].cumsum()
+    return df_mac
+
+def _pareto(costs, emissions, choices, budget):
+    '''
+    Keep the options within budget that no cheaper option beats, sorted by cost.
+    '''
+    keep = costs <= budget*(1 + 1e-12)
+    costs, emissions, choices = costs[keep], emissions[keep], choices[keep]
+    order = np.lexsort((emissions, costs))
+    costs, emissions, choices = costs[order], emissions[order], choices[order]
+    frontier = emissions < np.r_[np.inf, np.minimum.accumulate(emissions)[:-1]]
+    return costs[frontier], emissions[frontier], choices[frontier]
+
+def _full_sets(model, budget):
+    '''
+    Sets of fully covered interventions of one facility on the frontier of cost and emissions, within budget.
+    Above _MAX_EXACT interventions, only the nested sets of the MAC curve are considered.
+    :return: costs, emissions, coverage (n_sets, n_programs), sorted by cost.
+    '''
+    n = len(model.programs)
+    if n <= _MAX_EXACT:
+        sets = _subsets(n).astype(float)
+        emissions = _set_emissions(model.baseline, model.effects, model.targets)
+    else:
+        order = [model.program_labels.index(label) for label in mac_curve(model)['Intervention']]
+        sets = np.vstack([np.zeros(n), np.cumsum(np.eye(n)[order], axis=0)])
+        emissions = model.emissions(sets)
+    costs, emissions, index = _pareto(sets @ model.unit_cost, emissions, np.arange(len(sets)), budget)
+    return costs, emissions, sets[index]
+
+def _best_emissions(model, budgets):
+    '''
+    Lowest emissions of one facility for each budget, as found by solve_allocation: every set of
+    fully covered interventions, each extended with the leftover budget on one further intervention
+    (emissions are linear in the coverage of a single intervention).
+    :return: Array of emissions, shape (n_budgets,).
+    '''
+    n = len(model.programs)
+    if n > _MAX_EXACT:
+        return np.array([model.emissions_from_spending(solve_allocation(model, budget)) for budget in budgets])
+    unit_cost = model.unit_cost
+    sets = _subsets(n)
+    emissions = _set_emissions(model.baseline, model.effects, model.targets)
+    step = emissions[np.arange(2**n)[:, None] | (1 << np.arange(n))[None, :]] - emissions[:, None] # (n_sets, n_programs)
+    costs = sets @ unit_cost
+    best = np.empty(len(budgets))
+    chunk = max(1, _CANDIDATES//(2**n*n))
+    for start in range(0, len(budgets), chunk):
+        leftover = budgets[start:start + chunk, None]*(1 + 1e-12) - costs # (n_budgets, n_sets)
+        fractional = np.clip(np.divide(leftover[..., None], unit_cost, out=np.ones(leftover.shape + (n,)), where=unit_cost > 0), 0.0, 1.0) * ~sets
+        candidates = (emissions[:, None] + fractional*step).min(axis=-1)
+        best[start:start + chunk] = np.where(leftover >= 0, candidates, np.inf).min(axis=-1)
+    return best
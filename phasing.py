@@ -0,0 +1,164 @@
+import numpy as np
+import pandas as pd
+import os
+from engine import compile_model
+from mac import _subsets, _set_emissions
+'''
+Multi-year optimization of spending trajectories with capital/maintenance phasing.
+
+Instead of spreading implementation cost evenly over the years (as in the progbook unit cost), the
+implementation cost of an intervention is paid up-front when it is installed, and its maintenance cost
+every year it is active. The objective is the cumulative emissions over the data years, with a budget per
+year.
+
+Emissions in a year only depend on the interventions active in that year, so years are coupled only
+through the interventions already installed. The trajectory is therefore solved by dynamic programming
+over installed sets, one (installed set x active set) transition table per year, rather than by
+optimizing the spending of every intervention in every year jointly. Budget left over in a year is spent
+on partial coverage of one further intervention. Above 10 interventions, each year is instead filled
+greedily by abatement per dollar given what is already installed.
+'''
+
+_MAX_PHASED = 10 # largest number of interventions solved by dynamic programming over installed sets
+
+def _annual_budgets(budgets, n_years):
+    '''
+    Return one budget per year from a single annual budget or a list of budgets.
+    '''
+    budgets = np.atleast_1d(np.asarray(budgets, dtype=float))
+    if len(budgets) == 1:
+        return np.repeat(budgets, n_years)
+    if len(budgets) != n_years:
+        raise ValueError('Expected a single annual budget or one budget per year ({} years), got {} budgets'.format(n_years, len(budgets)))
+    return budgets
+
+def _year_cost(model, coverage, installed):
+    '''
+    Implementation (capital) and maintenance spending of each intervention in a year, given the fraction of
+    each intervention installed in previous years.
+    '''
+    return model.implementation_cost*np.maximum(coverage - installed, 0.0), model.maintenance_cost*coverage
+
+def _affordable_coverage(model, coverage, installed, leftover):
+    '''
+    Largest coverage of each intervention that the leftover budget buys on top of the current coverage,
+    holding the other interventions fixed, shape (n_programs,). Coverage up to the installed fraction only
+    costs maintenance.
+    '''
+    capital, maintenance = model.implementation_cost, model.maintenance_cost
+    available = leftover + sum(_year_cost(model, coverage, installed)) # budget for each intervention on its own
+    n = len(coverage)
+    below = np.divide(available, maintenance, out=np.ones(n), where=maintenance > 0)
+    above = installed + np.divide(available - maintenance*installed, capital + maintenance, out=np.ones(n), where=capital + maintenance > 0)
+    affordable = np.where(available <= maintenance*installed, below, above)
+    return np.clip(np.maximum(affordable, coverage), 0.0, 1.0)
+
+def _extend(model, coverage, installed, leftover, full_only=False):
+    '''
+    Raise the coverage of one intervention with the leftover budget: the largest abatement, or with
+    full_only the largest abatement per dollar among interventions that can be fully covered.
+    :return: New coverage, or None if no intervention improves emissions.
+    '''
+    affordable = _affordable_coverage(model, coverage, installed, leftover)
+    candidates = np.flatnonzero((affordable > coverage) & ((affordable >= 1) if full_only else True))
+    if len(candidates) == 0:
+        return None
+    trial = np.repeat(coverage[None], len(candidates), axis=0)
+    trial[np.arange(len(candidates)), candidates] = affordable[candidates]
+    abatement = model.emissions(coverage) - model.emissions(trial)
+    if full_only:
+        spent = np.array([sum(_year_cost(model, x, installed)).sum() for x in trial]) - sum(_year_cost(model, coverage, installed)).sum()
+        abatement = np.divide(abatement, spent, out=np.full(len(candidates), np.inf), where=spent > 0)*(abatement > 0)
+    best = np.argmax(abatement)
+    return trial[best] if abatement[best] > 0 else None
+
+def _install_schedule(model, budgets):
+    '''
+    Dynamic programming over installed sets of fully covered interventions.
+    :return: list of active sets (as indices into mac._subsets), one per year.
+    '''
+    n = len(model.programs)
+    sets = _subsets(n)
+    emissions = _set_emissions(model.baseline, model.effects, model.targets)
+    index = np.arange(2**n)
+    cost = (sets @ model.implementation_cost)[index[None, :] & ~index[:, None]] + (sets @ model.maintenance_cost)[None, :] # (installed, active)
+    after = index[:, None] | index[None, :] # installed set after each transition
+
+    value = np.zeros(2**n) # cumulative emissions from the following year onwards
+    policy = np.zeros((len(budgets), 2**n), dtype=int)
+    for t in reversed(range(len(budgets))):
+        total = np.where(cost <= budgets[t]*(1 + 1e-12), emissions[None, :] + value[after], np.inf)
+        best = total.min(axis=1)
+        policy[t] = np.argmin(np.where(total <= best[:, None]*(1 + 1e-12), cost, np.inf), axis=1) # cheapest among ties
+        value = best
+
+    installed, active = 0, []
+    for t in range(len(budgets)):
+        active.append(policy[t, installed])
+        installed |= active[-1]
+    return active
+
+def optimize_trajectory(model, budgets):
+    '''
+    Find the coverage of each intervention in each year that minimizes cumulative emissions.
+    :param model: CompiledModel (with implementation and maintenance costs, see engine.compile_model).
+    :param budgets: Annual budget, or list of budgets (one per data year).
+    :return: Arrays of coverage, implementation spending and maintenance spending, shape (n_years, n_programs).
+    '''
+    budgets = _annual_budgets(budgets, len(model.years))
+    n = len(model.programs)
+    schedule = _install_schedule(model, budgets) if n <= _MAX_PHASED else None
+
+    installed = np.zeros(n)
+    coverage, capital, maintenance = np.zeros((3, len(budgets), n))
+    for t, budget in enumerate(budgets):
+        if schedule is not None:
+            x = _subsets(n)[schedule[t]].astype(float)
+        else:
+            x = np.zeros(n)
+            while True:
+                extended = _extend(model, x, installed, budget - sum(_year_cost(model, x, installed)).sum(), full_only=True)
+                if extended is None:
+                    break
+                x = extended
+        extended = _extend(model, x, installed, budget - sum(_year_cost(model, x, installed)).sum())
+        x = x if extended is None else extended
+        coverage[t] = x
+        capital[t], maintenance[t] = _year_cost(model, x, installed)
+        installed = np.maximum(installed, x)
+    return coverage, capital, maintenance
+
+def multi_year_optimization(input_data_sheet, start_year, end_year, budgets, facility_code=None, file_name=None):
+    '''
+    Optimize the spending trajectory over the data years for a facility of the input data sheet.
+    Results on emissions, spending and coverage per year are saved in an excel sheet.
+    :param input_data_sheet: file name of input data sheet (or a dict of DataFrames from engine.read_input_data).
+    :param start_year: Start year of simulations.
+    :param end_year: End year of simulations.
+    :param budgets: Annual budget, or list of budgets (one per year from start_year to end_year-1).
+    :param facility_code: Code of the facility (defaults to the first facility in the sheet).
+    :param file_name: Excel file name for saving (no file is written if None).
+    :return: DataFrame of budget, spending and emissions per year (with a Total row), DataFrame of spending
+             per year and intervention, DataFrame of coverage per year and intervention.
+    '''
+    model = compile_model(input_data_sheet, start_year, end_year, facility_code)
+    coverage, capital, maintenance = optimize_trajectory(model, budgets)
+
+    years = pd.Index(model.years, name='Year')
+    df_summary = pd.DataFrame({'Budget': _annual_budgets(budgets, len(years)),
+                               'Implementation spending': capital.sum(axis=1),
+                               'Maintenance spending': maintenance.sum(axis=1),
+                               'Status-quo': np.repeat(model.emissions(np.zeros(len(model.programs))), len(years)),
+                               'Optimized': model.emissions(coverage)}, index=years)
+    df_summary.loc['Total'] = df_summary.sum()
+    df_spending = pd.DataFrame(capital + maintenance, index=years, columns=model.program_labels)
+    df_coverage = pd.DataFrame(coverage, index=years, columns=model.program_labels)
+
+    if file_name is not None:
+        if not os.path.exists(os.path.dirname(file_name) or '.'): os.makedirs(os.path.dirname(file_name))
+        with pd.ExcelWriter(file_name, engine='xlsxwriter') as writer:
+            df_summary.to_excel(writer, sheet_name='Emissions')
+            df_spending.to_excel(writer, sheet_name='Budgets')
+            df_coverage.to_excel(writer, sheet_name='Coverages')
+        print('Excel file saved: {}'.format(file_name))
+    return df_summary, df_spending, df_coverage
@@ -0,0 +1,180 @@
+import numpy as np
+import pandas as pd
+import os
+from concurrent.futures import ProcessPoolExecutor
+from engine import compile_model, read_input_data
+from mac import _pareto, _full_sets, _best_emissions, solve_allocation
+'''
+Multi-facility batch mode: one model per facility listed in the input data sheet, and a single total
+budget shared across facilities x interventions.
+'''
+
+_MARGINAL = 8 # facilities split exactly by optimize_portfolio (all of them up to this number, otherwise those nearest the budget cut)
+
+def facility_codes(input_data_sheet):
+    '''
+    List the facilities in the input data sheet.
+    :param input_data_sheet: file name of input data sheet (or a dict of DataFrames from engine.read_input_data).
+    :return: list of facility codes.
+    '''
+    return list(read_input_data(input_data_sheet)['facility']['Code Name'])
+
+def build_models(input_data_sheet, start_year, end_year, facilities=None):
+    '''
+    Compile one CompiledModel per facility.
+    :param input_data_sheet: file name of input data sheet (or a dict of DataFrames from engine.read_input_data).
+    :param start_year: Start year of simulations.
+    :param end_year: End year of simulations.
+    :param facilities: list of facility codes (defaults to every facility in the sheet).
+    :return: list of CompiledModel, in facility order.
+    '''
+    sheets = read_input_data(input_data_sheet)
+    facilities = facility_codes(sheets) if facilities is None else facilities
+    return [compile_model(sheets, start_year, end_year, facility_code=facility) for facility in facilities]
+
+def _build_project_task(args):
+    from books import build_project
+    P, _, _ = build_project(*args)
+    return P
+
+def build_projects(input_data_sheet, start_year, end_year, facilities=None, workers=1):
+    '''
+    Build one Atomica project per facility, optionally on a process pool.
+    :param input_data_sheet: file name of input data sheet (or a dict of DataFrames from engine.read_input_data).
+    :param start_year: Start year of simulations.
+    :param end_year: End year of simulations.
+    :param facilities: list of facility codes (defaults to every facility in the sheet).
+    :param workers: Number of worker processes. 1 builds the projects serially.
+    :return: dict of Atomica projects keyed by facility code, in facility order.
+    '''
+    sheets = read_input_data(input_data_sheet)
+    facilities = facility_codes(sheets) if facilities is None else facilities
+    tasks = [(sheets, start_year, end_year, facility) for facility in facilities]
+    if workers is None or workers <= 1 or len(tasks) <= 1:
+        projects = [_build_project_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            projects = list(pool.map(_build_project_task, tasks))
+    return dict(zip(facilities, projects))
+
+def _merge(a, b, budget):
+    '''
+    Combine the options (costs, emissions, choice of each facility) of two groups of facilities.
+    '''
+    i, j = np.divmod(np.arange(len(a[0])*len(b[0])), len(b[0]))
+    return _pareto(a[0][i] + b[0][j], a[1][i] + b[1][j], np.hstack([a[2][i], b[2][j]]), budget)
+
+def _hull(costs, emissions):
+    '''
+    Vertices of the lower convex hull of a frontier of cost and emissions sorted by cost.
+    :return: Array of indices of the vertices, cheapest first.
+    '''
+    keep = [0]
+    for k in range(1, len(costs)):
+        while len(keep) >= 2 and (emissions[keep[-1]] - emissions[keep[-2]])*(costs[k] - costs[keep[-2]]) >= (emissions[k] - emissions[keep[-2]])*(costs[keep[-1]] - costs[keep[-2]]):
+            keep.pop()
+        keep.append(k)
+    return np.array(keep)
+
+def _exact_split(models, frontiers, budget):
+    '''
+    Optimal allocation of a budget across a few facilities: for each facility holding the partial
+    intervention, the frontiers of full sets of the other facilities are combined (keeping only the
+    combinations that no cheaper one beats) and each combination leaves the rest of the budget to the
+    exact optimum of that facility. The number of combinations grows exponentially with the number of
+    facilities.
+    :return: list of spending arrays, one per facility.
+    '''
+    options = [(costs, emissions, np.arange(len(costs))[:, None]) for costs, emissions, _ in frontiers]
+    none = (np.zeros(1), np.zeros(1), np.zeros((1, 0), dtype=int))
+    prefix, suffix = [none], [none] # options of the facilities before f, and after f
+    for option in options[:-1]:
+        prefix.append(_merge(prefix[-1], option, budget))
+    for option in options[:0:-1]:
+        suffix.insert(0, _merge(option, suffix[0], budget))
+
+    best_emissions, best = np.inf, None
+    for f, model in enumerate(models):
+        costs, emissions, choices = _merge(prefix[f], suffix[f], budget) # every facility but f, in order
+        totals = emissions + _best_emissions(model, budget - costs)
+        k = int(np.argmin(totals))
+        if totals[k] < best_emissions:
+            best_emissions, best = totals[k], (f, costs[k], choices[k])
+
+    f, cost, choice = best
+    others = [g for g in range(len(models)) if g != f]
+    allocations = [None]*len(models)
+    for g, i in zip(others, choice):
+        allocations[g] = frontiers[g][2][i]*models[g].unit_cost
+    allocations[f] = solve_allocation(models[f], budget - cost)
+    return allocations
+
+def optimize_portfolio(models, budget):
+    '''
+    Allocate a single total budget across facilities x interventions to minimize total emissions.
+    Emissions are separable across facilities. Up to _MARGINAL facilities, the split is exact (see
+    _exact_split). Beyond, the full sets of every facility are reduced to the lower convex hull of their
+    cost and emissions, and the hull edges of every facility are bought in the order of largest abatement
+    per dollar while they fit in the budget: this solves the convex relaxation exactly, with a common
+    marginal abatement price across facilities (each facility sits at a hull vertex). The facilities
+    whose edges are nearest to the cut of that order are then released and re-solved exactly with their
+    budget plus the leftover, which recovers the partial intervention and the full sets between hull
+    vertices. Every other facility holds a set of fully covered interventions, so the relaxation gap is
+    bounded by the abatement of a few interventions of the released facilities.
+    :param models: list of CompiledModel, one per facility.
+    :param budget: Total budget shared across facilities.
+    :return: list of spending arrays, one per facility.
+    '''
+    frontiers = [_full_sets(model, budget) for model in models]
+    if len(models) <= _MARGINAL:
+        return _exact_split(models, frontiers, budget)
+
+    hulls = [_hull(costs, emissions) for costs, emissions, _ in frontiers]
+    edge_facility = np.concatenate([np.full(len(hull) - 1, f) for f, hull in enumerate(hulls)]).astype(int)
+    edge_cost = np.concatenate([np.diff(costs[hull]) for (costs, _, _), hull in zip(frontiers, hulls)])
+    edge_abatement = np.concatenate([-np.diff(emissions[hull]) for (_, emissions, _), hull in zip(frontiers, hulls)])
+    order = np.argsort(-edge_abatement/edge_cost, kind='stable') # edges of a facility keep their order along its hull
+    cut = int(np.searchsorted(np.cumsum(edge_cost[order]), budget*(1 + 1e-12), side='right'))
+    vertex = np.bincount(edge_facility[order[:cut]], minlength=len(models))
+    choice = [hull[v] for hull, v in zip(hulls, vertex)]
+
+    nearest = order[np.argsort(np.abs(np.arange(len(order)) - cut + 0.5), kind='stable')] # edges on either side of the cut
+    released = list(dict.fromkeys(list(edge_facility[nearest]) + list(range(len(models)))))[:_MARGINAL]
+    held = sum(frontiers[g][0][choice[g]] for g in range(len(models)) if g not in released)
+    exact = _exact_split([models[g] for g in released], [frontiers[g] for g in released], budget - held)
+
+    allocations = [frontiers[g][2][choice[g]]*models[g].unit_cost for g in range(len(models))]
+    for g, allocation in zip(released, exact):
+        allocations[g] = allocation
+    return allocations
+
+def portfolio_optimization(input_data_sheet, start_year, end_year, budget, facilities=None, file_name=None):
+    '''
+    Optimize a shared total budget across every facility in the input data sheet.
+    Results on emissions per facility and budget allocations are saved in an excel sheet.
+    :param input_data_sheet: file name of input data sheet (or a dict of DataFrames from engine.read_input_data).
+    :param start_year: Start year of simulations.
+    :param end_year: End year of simulations.
+    :param budget: Total budget shared across facilities.
+    :param facilities: list of facility codes (defaults to every facility in the sheet).
+    :param file_name: Excel file name for saving (no file is written if None).
+    :return: DataFrame of emissions per facility (status-quo and optimized), DataFrame of allocations (facility x intervention).
+    '''
+    models = build_models(input_data_sheet, start_year, end_year, facilities)
+    allocations = optimize_portfolio(models, budget)
+
+    codes = [model.facility_code for model in models]
+    df_emissions = pd.DataFrame({'Facility': [model.facility_label for model in models],
+                                 'Status-quo': [model.emissions(np.zeros(len(model.programs))) for model in models],
+                                 'Optimized': [model.emissions_from_spending(allocation) for model, allocation in zip(models, allocations)],
+                                 'Budget': [allocation.sum() for allocation in allocations]}, index=codes)
+    df_emissions.loc['Total'] = ['Total', df_emissions['Status-quo'].sum(), df_emissions['Optimized'].sum(), df_emissions['Budget'].sum()]
+    df_allocation = pd.DataFrame([allocation for allocation in allocations], index=codes, columns=models[0].program_labels)
+
+    if file_name is not None:
+        if not os.path.exists(os.path.dirname(file_name) or '.'): os.makedirs(os.path.dirname(file_name))
+        with pd.ExcelWriter(file_name, engine='xlsxwriter') as writer:
+            df_emissions.to_excel(writer, sheet_name='Emissions')
+            df_allocation.to_excel(writer, sheet_name='Budgets')
+        print('Excel file saved: {}'.format(file_name))
+    return df_emissions, df_allocation
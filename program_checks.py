@@ -1,38 +1,218 @@
 import atomica as at
-from project import P, progset, start_year
-import os
-if not os.path.exists('results'): os.makedirs('results')
-if not os.path.exists('figs'): os.makedirs('figs')
+import numpy as np
+import time
+from cache import load_project
+from engine import compile_model, compile_project, check_against_sim
+from mac import solve_allocation, _full_sets
+from scenarios import run_frontier, _optimize_budget, _optimize_budget_surrogate, _optimize_budget_swarm
+import tracing
+from uncertainty import sample_model, solve_allocations
+from phasing import optimize_trajectory
+from store import ResultsStore
+from inputs import InputData, InputDataError
+from sweep import SweepExecutor
+from bundles import bundle_table, pairwise_interactions
+from portfolio import build_models, optimize_portfolio, _hull
+from benchmark import synthetic_sheets
 '''
 Script to check output of programs under certain coverage and budget conditions.
 E.g.: It can be useful to set intervention effects to 0 (perfect effect), the same unit_cost for all interventions, and check that spending (0.5 x unit_cost) or (1 x unit_cost) produces the correct outputs (a program effect of 0.5 or 0, respectively).
 
 '''
 
+## Time frame of simulation
+start_year = 2024 # MODIFY AS NEEDED
+end_year = start_year + 5 # MODIFY AS NEEDED
+
+# Project built without the Streamlit UI of project.py (use input_data.xlsx for the sheet generated there)
+input_data_sheet = 'input_data_example.xlsx' # MODIFY AS NEEDED
+P, progset, facility_code = load_project(input_data_sheet, start_year, end_year)
+
 # Run a budget scenario and verify that outputs make sense
 investment = 1e5  # set investment
+store = ResultsStore('results/checks_store') # every run below is appended to the store instead of exported one file each
+store.clear() # only keep the runs of this execution
 
 # Scale up each prog to see impact
 for prog in progset.programs.keys():
     instructions_spending = at.ProgramInstructions(start_year=start_year, alloc={prog: investment})
     budget_res = P.run_sim(P.parsets[0],progset=P.progsets[0], progset_instructions=instructions_spending, result_name=prog)
-    budget_res.export_raw('results/budget_raw_{}'.format(prog))
+    store.append(budget_res, 'budget', facility_code, budgets=investment, programs=prog)
 
 # Run a zero- and full-coverage scenario and verify that outputs make sense
 # Zero-coverage of programs
 no_coverage = {prog: 0 for prog in progset.programs.keys()}
 instructions_cov = at.ProgramInstructions(start_year=start_year, coverage=no_coverage)
 no_coverage_res = P.run_sim(P.parsets[0], progset=P.progsets[0], progset_instructions=instructions_cov, result_name='no_coverage')
-no_coverage_res.export_raw('results/no_coverage_raw')
+store.append(no_coverage_res, 'no-coverage', facility_code)
 
 # Full coverage of all programs
 coverage = {prog: 1 for prog in progset.programs.keys()} 
 instructions_cov = at.ProgramInstructions(start_year=start_year, coverage=coverage)
 coverage_res = P.run_sim(P.parsets[0], progset=P.progsets[0], progset_instructions=instructions_cov, result_name="Full")
-coverage_res.export_raw('results/full_coverage_raw')
+store.append(coverage_res, 'full-coverage', facility_code)
 
 # Scale up each prog individually to see impact
 for prog in progset.programs.keys():
     instructions_cov = at.ProgramInstructions(start_year=start_year, coverage={prog: 1})
     coverage_prog_res = P.run_sim(P.parsets[0], progset=P.progsets[0], progset_instructions=instructions_cov, result_name=prog)
-    coverage_prog_res.export_raw('results/full_coverage_raw_{}'.format(prog))
+    store.append(coverage_prog_res, 'coverage', facility_code, programs=prog)
+
+# Optional Excel view of the checks above (start year values)
+store.to_excel('results/checks_view.xlsx', year=start_year)
+
+
+# Check the closed-form evaluator against run_sim for random coverage and the corner cases above
+model = compile_model(input_data_sheet, start_year, int(P.settings.sim_end), facility_code)
+coverages = np.vstack([np.zeros(len(model.programs)), np.ones(len(model.programs)), np.eye(len(model.programs)), np.random.rand(20, len(model.programs))])
+max_diff = check_against_sim(P, model, coverages, start_year)
+print('Closed-form emissions match run_sim (max relative difference {:.3g})'.format(max_diff))
+
+
+# Cross-check the MAC solver against the PSO -> ASD optimization: its emissions should never be higher
+model = compile_project(P, progset, start_year, facility_code)
+for budget in [20e3, 50e3, 100e3]:
+    mac_emissions = model.emissions_from_spending(solve_allocation(model, budget))
+    asd_result = _optimize_budget(P, list(progset.programs.keys()), start_year, budget, 'ASD')
+    asd_emissions = asd_result.get_variable('co2e_emissions', facility_code)[0].vals[list(asd_result.t).index(start_year)]
+    assert mac_emissions <= asd_emissions*(1 + 1e-6), 'MAC solver worse than ASD for budget {}'.format(budget)
+    print('Budget ${:0,.0f}: MAC {:0,.1f} vs ASD {:0,.1f}'.format(budget, mac_emissions, asd_emissions))
+
+
+# Check the surrogate-assisted optimization against the PSO -> ASD optimization and the MAC optimum, with simulation counts
+tracing.enable()
+for budget in [20e3, 50e3, 100e3]:
+    mac_emissions = model.emissions_from_spending(solve_allocation(model, budget))
+    simulations = []
+    for optimize, name in [(_optimize_budget, 'ASD'), (_optimize_budget_surrogate, 'surrogate')]:
+        before = tracing.counters().get('objective evaluations', 0) # every objective evaluation is a simulation
+        result = optimize(P, list(progset.programs.keys()), start_year, budget, name)
+        simulations.append((result.get_variable('co2e_emissions', facility_code)[0].vals[list(result.t).index(start_year)], tracing.counters().get('objective evaluations', 0) - before))
+    (asd_emissions, asd_simulations), (surrogate_emissions, surrogate_simulations) = simulations
+    assert surrogate_emissions <= asd_emissions*(1 + 1e-3), 'Surrogate optimization worse than ASD for budget {}'.format(budget)
+    print('Budget ${:0,.0f}: surrogate {:0,.1f} ({} simulations) vs ASD {:0,.1f} ({} simulations), MAC optimum {:0,.1f}'.format(budget, surrogate_emissions, surrogate_simulations, asd_emissions, asd_simulations, mac_emissions))
+
+
+# Check that the batched swarm reaches the MAC optimum, with the same allocation for the same seed
+for budget in [20e3, 50e3, 100e3]:
+    mac_emissions = model.emissions_from_spending(solve_allocation(model, budget))
+    before = tracing.counters().get('objective evaluations', 0)
+    result = _optimize_budget_swarm(P, list(progset.programs.keys()), start_year, budget, 'swarm')
+    evaluations = tracing.counters().get('objective evaluations', 0) - before
+    swarm_emissions = result.get_variable('co2e_emissions', facility_code)[0].vals[list(result.t).index(start_year)]
+    repeated = _optimize_budget_swarm(P, list(progset.programs.keys()), start_year, budget, 'swarm')
+    assert swarm_emissions <= mac_emissions*(1 + 1e-3), 'Swarm optimization worse than the MAC optimum for budget {}'.format(budget)
+    assert all(np.array_equal(result.get_alloc()[prog], repeated.get_alloc()[prog]) for prog in progset.programs), 'Swarm optimization not reproducible for budget {}'.format(budget)
+    print('Budget ${:0,.0f}: swarm {:0,.1f} ({} batched evaluations, 1 simulation), MAC optimum {:0,.1f}'.format(budget, swarm_emissions, evaluations, mac_emissions))
+
+# Check the batched per-sample optimum of the uncertainty analysis against the MAC solver on each sample
+sampled = sample_model(model, n_samples=50)
+for budget, coverage in zip([20e3, 50e3, 100e3], solve_allocations(sampled, [20e3, 50e3, 100e3])):
+    expected = np.array([sampled.sample(i).emissions_from_spending(solve_allocation(sampled.sample(i), budget)) for i in range(sampled.n_samples)])
+    max_diff = np.max(np.abs(sampled.emissions(coverage) - expected)/expected)
+    assert max_diff < 1e-9, 'Batched per-sample optimum differs from the MAC solver for budget {}'.format(budget)
+    print('Budget ${:0,.0f}: batched per-sample optimum matches the MAC solver (max relative difference {:.3g})'.format(budget, max_diff))
+
+
+# Check the cumulative emissions of an optimized spending trajectory against run_sim with time-varying coverage
+budgets = np.linspace(20e3, 80e3, len(model.years))
+coverage, capital, maintenance = optimize_trajectory(model, budgets)
+instructions = at.ProgramInstructions(start_year=start_year, coverage={prog: at.TimeSeries(model.years, coverage[:, i]) for i, prog in enumerate(model.programs)})
+trajectory_res = P.run_sim(P.parsets[0], progset=P.progsets[0], progset_instructions=instructions, result_name='Trajectory')
+sim_emissions = trajectory_res.get_variable('co2e_emissions', facility_code)[0].vals[[list(trajectory_res.t).index(year) for year in model.years]]
+max_diff = np.max(np.abs(sim_emissions - model.emissions(coverage))/model.emissions(coverage))
+assert max_diff < 1e-6, 'Trajectory emissions differ from run_sim'
+assert np.all(capital.sum(axis=1) + maintenance.sum(axis=1) <= budgets*(1 + 1e-9)), 'Trajectory exceeds the annual budgets'
+print('Trajectory: cumulative emissions {:0,.1f} match run_sim (max relative difference {:.3g})'.format(sim_emissions.sum(), max_diff))
+
+
+# Check that the typed input model compiles to the same model as the input data sheet, and rejects inconsistent inputs up front
+input_data = InputData.from_excel(input_data_sheet)
+typed_model = compile_model(input_data, start_year, int(P.settings.sim_end), facility_code)
+sheet_model = compile_model(input_data_sheet, start_year, int(P.settings.sim_end), facility_code)
+assert all(np.array_equal(getattr(typed_model, name), getattr(sheet_model, name)) for name in ['baseline', 'targets', 'effects', 'implementation_cost', 'maintenance_cost']), 'Typed input model differs from the input data sheet'
+prog = next(iter(input_data.interventions))
+input_data.effects[facility_code][prog] = 1.5
+del input_data.maintenance_costs[facility_code][prog]
+problems = input_data.problems()
+assert len(problems) == 2, 'Expected 2 input data problems, got {}'.format(problems)
+try:
+    compile_model(input_data, start_year, int(P.settings.sim_end), facility_code)
+    raise AssertionError('Inconsistent input data not rejected')
+except InputDataError:
+    pass
+print('Typed input model matches the input data sheet and rejects inconsistent inputs ({} problems found)'.format(len(problems)))
+
+
+# Check that a sweep on worker processes attached to the shared model matches the model of this process
+budgets = [20e3, 50e3, 100e3]
+spending = np.random.default_rng(0).uniform(0, 1, (5000, len(model.programs)))*model.unit_cost
+with SweepExecutor([model], workers=2, chunk_size=1000) as executor:
+    sweep_emissions = executor.emissions_from_spending(model.facility_code, spending)
+    sweep_optima = executor.optimize(budgets)[model.facility_code]
+assert np.allclose(sweep_emissions, model.emissions_from_spending(spending)), 'Sweep emissions differ from the compiled model'
+assert np.allclose(sweep_optima[1], [solve_allocation(model, budget) for budget in budgets]), 'Sweep optimum differs from the MAC solver'
+print('Sweep: {} allocations and {} budgets on 2 workers match the compiled model'.format(len(spending), len(budgets)))
+
+
+# Check the emissions of the cost-efficient bundles against run_sim at full coverage, and the pairwise interactions against the bundle table
+df_bundles = bundle_table(model)
+efficient = df_bundles[df_bundles['Cost-efficient']]
+coverage = np.array([[label in bundle.split(' + ') for label in model.program_labels] for bundle in efficient['Bundle']], dtype=float)
+max_diff = check_against_sim(P, model, coverage, start_year)
+assert np.allclose(model.emissions(coverage), efficient['Emissions (CO2e)']), 'Bundle emissions differ from the compiled model'
+pairs = df_bundles[df_bundles['Size'] == 2].set_index('Bundle')['Interaction (CO2e)']
+df_pairs = pairwise_interactions(model)
+assert np.allclose([pairs[a + ' + ' + b] for a, b in zip(df_pairs['Intervention A'], df_pairs['Intervention B'])], df_pairs['Interaction (CO2e)']), 'Pairwise interactions differ from the bundle table'
+print('Bundles: {} bundles, {} cost-efficient bundles match run_sim (max relative difference {:.3g})'.format(len(df_bundles), len(efficient), max_diff))
+
+
+# Check the shared-budget portfolio split against a brute-force search over the split of two synthetic facilities
+for seed in [2, 3]:
+    models = build_models(synthetic_sheets(2, 9, 10, seed=seed), start_year, end_year)
+    for budget in [20e3, 50e3]:
+        allocations = optimize_portfolio(models, budget)
+        portfolio_emissions = sum(model.emissions_from_spending(allocation) for model, allocation in zip(models, allocations))
+        shares = np.linspace(0, budget, 1001)
+        brute_emissions = min(models[0].emissions_from_spending(solve_allocation(models[0], share)) + models[1].emissions_from_spending(solve_allocation(models[1], budget - share)) for share in shares)
+        n_fractional = sum(np.sum((allocation > 1e-9) & (allocation < model.unit_cost*(1 - 1e-9))) for model, allocation in zip(models, allocations))
+        assert sum(allocation.sum() for allocation in allocations) <= budget*(1 + 1e-9), 'Portfolio exceeds the budget'
+        assert portfolio_emissions <= brute_emissions*(1 + 1e-9), 'Portfolio split worse than the brute-force split for seed {}, budget {}'.format(seed, budget)
+        assert n_fractional <= 1, 'More than one partially covered intervention in the portfolio'
+        print('Portfolio (seed {}, budget ${:0,.0f}): {:0,.1f} vs brute-force split {:0,.1f}'.format(seed, budget, portfolio_emissions, brute_emissions))
+
+# Check the split across 128 synthetic facilities against the lower bound of its convex relaxation (the hull
+# edges of every facility bought in the order of abatement per dollar, the last one fractionally)
+models = build_models(synthetic_sheets(128, 9, 10, seed=1), start_year, end_year)
+status_quo_emissions = sum(model.emissions(np.zeros(len(model.programs))) for model in models)
+for budget in [1e6, 4e6]:
+    start = time.perf_counter()
+    allocations = optimize_portfolio(models, budget)
+    elapsed = time.perf_counter() - start
+    portfolio_emissions = sum(model.emissions_from_spending(allocation) for model, allocation in zip(models, allocations))
+    ratios, edge_costs, bound = [], [], 0
+    for costs, emissions, _ in [_full_sets(facility_model, budget) for facility_model in models]:
+        hull = _hull(costs, emissions)
+        bound += emissions[0] # cheapest full set (costs nothing)
+        ratios.append(-np.diff(emissions[hull])/np.diff(costs[hull]))
+        edge_costs.append(np.diff(costs[hull]))
+    order = np.argsort(-np.concatenate(ratios))
+    spent = np.minimum(np.cumsum(np.concatenate(edge_costs)[order]), budget)
+    bound -= np.sum(np.concatenate(ratios)[order]*np.diff(np.r_[0, spent]))
+    n_fractional = sum(np.sum((allocation > 1e-9) & (allocation < model.unit_cost*(1 - 1e-9))) for model, allocation in zip(models, allocations))
+    gap = (portfolio_emissions - bound)/(status_quo_emissions - bound)
+    assert sum(allocation.sum() for allocation in allocations) <= budget*(1 + 1e-9), 'Portfolio exceeds the budget'
+    assert n_fractional <= 1, 'More than one partially covered intervention in the portfolio'
+    assert bound <= portfolio_emissions*(1 + 1e-9) and gap <= 1e-3, 'Portfolio split of 128 facilities {:.3g} of the abatement away from its bound'.format(gap)
+    assert elapsed < 10, 'Portfolio split of 128 facilities took {:.1f} s'.format(elapsed)
+    print('Portfolio (128 facilities, budget ${:0,.0f}): {:0,.1f} vs relaxation bound {:0,.1f} ({:.2g} of the abatement), {:.2f} s'.format(budget, portfolio_emissions, bound, gap, elapsed))
+
+
+# Check the cost-emissions frontier against the MAC solver, and count the simulations confirming its breakpoints
+before = tracing.counters().get('simulations', 0)
+df_frontier, df_allocation = run_frontier(P, progset, start_year, facility_code)
+frontier_simulations = tracing.counters().get('simulations', 0) - before
+expected = [model.emissions_from_spending(solve_allocation(model, budget)) for budget in df_frontier['Budget']]
+assert np.allclose(df_frontier['Emissions (CO2e)'], expected), 'Frontier differs from the MAC solver'
+assert frontier_simulations == df_frontier['Breakpoint'].sum(), 'Frontier ran simulations besides its breakpoints'
+print('Frontier: {} budgets, {} simulations (one per breakpoint)'.format(len(df_frontier), frontier_simulations))
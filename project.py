@@ -1,14 +1,18 @@
 """
 Define atomica project based on input data spreadsheet.
 """
-import atomica as at
-import pandas as pd
-from books import generate_books
+from incremental import Session
+from inputs import InputData, InputDataError
 import streamlit as st
-import openpyxl
 import numpy as np
-from scenarios import coverage_scenario, budget_scenario, optimization
-import os
+from scenarios import coverage_scenario, budget_scenario, optimization, frontier
+from uncertainty import uncertainty_analysis
+from sensitivity import sensitivity_analysis
+from phasing import multi_year_optimization
+from bundles import bundle_analysis
+import utils as ut
+import tracing
+import json
 
 from datetime import datetime
 
@@ -16,125 +20,52 @@ from datetime import datetime
 # start_year = 2024 # MODIFY AS NEEDED
 # end_year = start_year + 5 # MODIFY AS NEEDED
 
-def delete_books(file_path):
-    if os.path.exists(file_path):
-        try:
-            os.remove(file_path)
-        except OSError as e:
-            print(f"Error: {e}")
-    else:
-        print(f"File '{file_path}' does not exist.")
-
-#need to create our own "input_data_example.xlsx" file based on user input
-def create_excel_file(file_path):
-    delete_books(file_path)
-    workbook = openpyxl.Workbook()
-    default_sheet = workbook.active
-    workbook.remove(default_sheet)
-    facility_sheet = workbook.create_sheet('facility')
-    facility_sheet.append(['Code Name', 'Display Name'])
-    interventions = workbook.create_sheet('interventions')
-    interventions.append(['Code Name', 'Display Name'])
-    emission_sources_sheet = workbook.create_sheet('emission sources')
-    emission_sources_sheet.append(['Code Name', 'Display Name'])
-    emission_data_sheet = workbook.create_sheet('emission data')
-    emission_data_sheet.append(['facilities', 'Grid_Electricity', 'Grid_Gas', 'Bottled_Gas', 'Liquid_Fuel', 'Vehicle_Fuel_Owned', 'Business_Travel', 'Anaesthetic_Gases', 'Refrigeration_Gases', 'Waste_Management', 'Medical_Inhalers'])    
-    interventions_sheet = workbook.create_sheet('interventions')
-    interventions_sheet.append(['Code Name', 'Display Name'])
-    emission_targets_sheet = workbook.create_sheet('emission targets')
-    emission_targets_sheet.append(['interventions','Grid_Electricity', 'Grid_Gas', 'Bottled_Gas', 'Liquid_Fuel', 'Vehicle_Fuel_Owned', 'Business_Travel', 'Anaesthetic_Gases', 'Refrigeration_Gases', 'Waste_Management', 'Medical_Inhalers'])
-    effect_sizes_sheet = workbook.create_sheet('effect sizes')
-    effect_sizes_sheet.append(['facilities', 'Recycling_WasteSegregation_effect', 'SolarSystem_Installation_effect', 'Efficient_Chillers_Upgrade_effect', 'Lighting_Efficiency_effect', 'LowGWP_Refrigerants_effect', 'Hybrid_Car_Use_effect', 'LowGWP_Inhalers_effect', 'LowGWP_AnaestheticGases_effect', 'Staff_Training_Awareness_effect'])
-    implementation_costs_sheet = workbook.create_sheet('implementation costs')
-    implementation_costs_sheet.append(['facilities', 'Recycling_WasteSegregation_cost', 'SolarSystem_Installation_cost', 'Efficient_Chillers_Upgrade_cost', 'Lighting_Efficiency_cost', 'LowGWP_Refrigerants_cost', 'Hybrid_Car_Use_cost', 'LowGWP_Inhalers_cost', 'LowGWP_AnaestheticGases_cost', 'Staff_Training_Awareness_cost'])
-    maintenance_costs_sheet = workbook.create_sheet('maintenance costs')
-    maintenance_costs_sheet.append(['facilities', 'Recycling_WasteSegregation_cost', 'SolarSystem_Installation_cost', 'Efficient_Chillers_Upgrade_cost', 'Lighting_Efficiency_cost', 'LowGWP_Refrigerants_cost', 'Hybrid_Car_Use_cost', 'LowGWP_Inhalers_cost', 'LowGWP_AnaestheticGases_cost', 'Staff_Training_Awareness_cost'])
-    emission_sources_data = [
-        ['Grid_Electricity', 'Grid Electricity'],
-        ['Grid_Gas', 'Grid gas'],
-        ['Bottled_Gas', 'Bottled gas (LPG)'],
-        ['Liquid_Fuel', 'Liquid fuel (Petrol or Diesel)'],
-        ['Vehicle_Fuel_Owned', 'Vehicle Fuel (Owned Vehicles)'],
-        ['Business_Travel', 'Business travel (Taxi, Car hires, Train, Air travel, Local bus)'],
-        ['Anaesthetic_Gases', 'Anaesthetic gases'],
-        ['Refrigeration_Gases', 'Refrigerants'],
-        ['Waste_Management', 'Waste'],
-        ['Medical_Inhalers', 'Inhalers'],
-    ]
-
-    # Populate the sheet with constant data
-    for row_data in emission_sources_data:
-        emission_sources_sheet.append(row_data)    
-
-    emission_targets_data = [
-        ['Recycling_WasteSegregation'   ,'','','','','','','','','y',''],
-        ['SolarSystem_Installation'     ,'y','','','','','','','','',''],
-        ['Efficient_Chillers_Upgrade'   ,'y','','','','','','','y','',''],
-        ['Lighting_Efficiency'          ,'y','','','','','','','','',''],
-        ['LowGWP_Refrigerants'          ,'','','','','','','','y','',''],
-        ['Hybrid_Car_Use'               ,'','','','','y','','','','',''],
-        ['LowGWP_Inhalers'              ,'','','','','','','','','','y'],
-        ['LowGWP_AnaestheticGases'      ,'','','','','','','y','','',''],
-        ['Staff_Training_Awareness'     ,'y','','','','','','','y','y','y'],
-    ]
-
-    # Populate the sheet with constant data
-    for row_data in emission_targets_data:
-        emission_targets_sheet.append(row_data)
-
-    workbook.save(file_path)
-
-def update_sheet(file_path, selected_facility, interventions, emission_data, effect_sizes, implementation_cost, maintenance_cost):
-    workbook = openpyxl.load_workbook(file_path)
-    facility_sheet = workbook['facility']
-    interventions_sheet = workbook['interventions']
-    emission_data_sheet = workbook['emission data']
-    emission_data_sheet.append(emission_data)
-    effect_sizes_sheet = workbook['effect sizes']
-    effect_sizes_sheet.append(effect_sizes)
-    implementation_costs_sheet = workbook['implementation costs']
-    implementation_costs_sheet.append(implementation_cost)
-    maintenance_costs_sheet = workbook['maintenance costs']
-    maintenance_costs_sheet.append(maintenance_cost)
-    formatted_data = []
-
-    for intervention in interventions:
-        formatted_name = intervention.replace(' ', '_')
-        # Additional formatting for Display Name
-        formatted_display_name = intervention.replace('_', ' ')
-        formatted_data.append([formatted_name, formatted_display_name])
-
-    # Assuming interventions_sheet is a pandas DataFrame
-    for row_data in formatted_data:
-        interventions_sheet.append(row_data)
-    
-    # Clear existing data in the sheet (excluding headers)
-    for row in facility_sheet.iter_rows(min_row=2, max_row=facility_sheet.max_row, max_col=facility_sheet.max_column):
-        for cell in row:
-            cell.value = None    
-    # Example data for selected facility (replace with your actual data)
-    facility_data = {
-        'AKHS_Mombasa': [['AKHS_Mombasa', 'Aga Khan Hospital, Mombasa']],
-    }
-
-    # Populate the sheet with data for the selected facility
-    for row_data in facility_data.get(selected_facility, []):
-        facility_sheet.append(row_data)    
-
-    workbook.save(file_path)
+# Facilities, emission sources and the emission sources targeted by each intervention of the input data sheet built by the UI
+FACILITIES = {'AKHS_Mombasa': 'Aga Khan Hospital, Mombasa'}
+SOURCES = {'Grid_Electricity': 'Grid Electricity',
+           'Grid_Gas': 'Grid gas',
+           'Bottled_Gas': 'Bottled gas (LPG)',
+           'Liquid_Fuel': 'Liquid fuel (Petrol or Diesel)',
+           'Vehicle_Fuel_Owned': 'Vehicle Fuel (Owned Vehicles)',
+           'Business_Travel': 'Business travel (Taxi, Car hires, Train, Air travel, Local bus)',
+           'Anaesthetic_Gases': 'Anaesthetic gases',
+           'Refrigeration_Gases': 'Refrigerants',
+           'Waste_Management': 'Waste',
+           'Medical_Inhalers': 'Inhalers'}
+TARGETS = {'Recycling_WasteSegregation': ['Waste_Management'],
+           'SolarSystem_Installation': ['Grid_Electricity'],
+           'Efficient_Chillers_Upgrade': ['Grid_Electricity', 'Refrigeration_Gases'],
+           'Lighting_Efficiency': ['Grid_Electricity'],
+           'LowGWP_Refrigerants': ['Refrigeration_Gases'],
+           'Hybrid_Car_Use': ['Vehicle_Fuel_Owned'],
+           'LowGWP_Inhalers': ['Medical_Inhalers'],
+           'LowGWP_AnaestheticGases': ['Anaesthetic_Gases'],
+           'Staff_Training_Awareness': ['Grid_Electricity', 'Refrigeration_Gases', 'Waste_Management', 'Medical_Inhalers']}
+
+def build_input_data(selected_facility, interventions, emission_data, effect_sizes, implementation_costs, maintenance_costs):
+    '''
+    Input data of the selected facility and interventions, from the values entered in the UI.
+    :param selected_facility: Facility code.
+    :param interventions: list of selected intervention names (code names with spaces instead of underscores).
+    :param emission_data: dict {emission source code: baseline emissions}.
+    :param effect_sizes: dict {intervention code: effect size}.
+    :param implementation_costs: dict {intervention code: implementation cost}.
+    :param maintenance_costs: dict {intervention code: annual maintenance cost}.
+    :return: validated InputData.
+    '''
+    input_data = InputData(sources=SOURCES, interventions={prog: prog.replace('_', ' ') for prog in TARGETS}, targets=TARGETS)
+    input_data.add_facility(selected_facility, FACILITIES[selected_facility], emission_data, effect_sizes, implementation_costs, maintenance_costs)
+    return input_data.select([intervention.replace(' ', '_') for intervention in interventions]).validate()
 
 if __name__ == "__main__":
-    # Specify the file path where you want to save the Excel file
+    # Specify the file path where the input data sheet is saved on request
     file_path = "input_data.xlsx"
-    # Create the Excel file initially
-    delete_books(file_path)
-    create_excel_file(file_path)
     # Streamlit UI
     with st.sidebar:
         (st.title("Facility Data Generator"))
 
         # Dropdown to select a facility
-        selected_facility = st.selectbox("Select Facility", ['AKHS_Mombasa'])
+        selected_facility = st.selectbox("Select Facility", list(FACILITIES))
         start_year = st.number_input("Starting year", value=datetime.now().year, max_value=datetime.now().year+10)
         end_year = st.number_input("Ending year", value=datetime.now().year+5, max_value=9999)
         st.header("Intervention")
@@ -162,7 +93,6 @@ if __name__ == "__main__":
         em_data_waste_management = st.number_input("Waste management", step=1000, value=186383)
         em_data_medical_inhalers = st.number_input("Medical inhalers", step=1000, value=42284)
         emission_data_list = [em_data_grid_electricity, em_data_grid_gas, em_data_bottled_gas, em_data_liquid_fuel, em_data_vehicle_fuel_owned, em_data_business_travel, em_data_anaesthetic_gases, em_data_refrigeration_gases, em_data_waste_management, em_data_medical_inhalers]
-        emission_data_list.insert(0, selected_facility)
 
         st.header("Effect sizes inputs")
         effect_sizes_list = [
@@ -176,7 +106,6 @@ if __name__ == "__main__":
             st.slider("LowGWP_AnaestheticGases_effect", min_value=0.0, max_value=1.0, step=0.1, value=0.987),
             st.slider("Staff_Training_Awareness_effect", min_value=0.0, max_value=1.0, step=0.1, value=0.75)
         ]
-        effect_sizes_list.insert(0, selected_facility)
 
         st.header("Implementation costs inputs")
         implementation_costs_list = [
@@ -190,7 +119,6 @@ if __name__ == "__main__":
             st.number_input("Eco-friendly Anesthetics cost", key="eco_friendly_anesthetics", step=10000, value=39374),
             st.number_input("Emissions Training & Conservation cost", key="emissions_training_conservation", step=10000, value=8000)
         ]
-        implementation_costs_list.insert(0, selected_facility)
 
         st.header("Maintenance costs inputs")
         maintenance_costs_list = [
@@ -204,49 +132,93 @@ if __name__ == "__main__":
             st.number_input("Eco-friendly Anesthetics cost", step=10000, value=3937),
             st.number_input("Emissions Training & Conservation cost", step=10000, value=800)
         ]
-        maintenance_costs_list.insert(0, selected_facility)
+        optimization_method = st.selectbox("Optimization method", ['pso-asd', 'surrogate', 'swarm', 'mac'])
+        run_frontier = st.checkbox("Compute cost-emissions frontier", value=False)
+        run_uncertainty = st.checkbox("Run uncertainty analysis", value=False)
+        run_sensitivity = st.checkbox("Run sensitivity analysis", value=False)
+        run_multi_year = st.checkbox("Optimize multi-year spending trajectory", value=False)
+        run_bundles = st.checkbox("Analyse intervention bundles", value=False)
+        show_diagnostics = st.checkbox("Show diagnostics (timing trace)", value=False)
+        save_input_data = st.checkbox("Save input data sheet ({})".format(file_path), value=False)
         generate_data = st.button("Generate Facility Data")
     
     col1, col2 = st.columns(spec=[1, 1], gap="large")
     # Button to update the facility sheet based on the selected facility
     if generate_data:
-        update_sheet(file_path, selected_facility, interventions, emission_data_list, effect_sizes_list, implementation_costs_list, maintenance_costs_list)
-        # Input data sheet file name (and path if applicable) and read facility code name
-        
-        input_data_sheet = file_path # MODIFY AS NEEDED
-        facility_code = pd.read_excel(input_data_sheet, sheet_name='facility', index_col='Code Name').index[0]
-        delete_books("books/carbomica_databook_{}.xlsx".format(facility_code))
-        delete_books("books/carbomica_framework_{}.xlsx".format(facility_code))
-        delete_books("books/carbomica_progbook_{}.xlsx".format(facility_code))
-
-        # Generate framework, databook and progbook and return facility code name
-        generate_books(input_data_sheet, start_year, end_year)
-
-        # Atomica project definition
-        P = at.Project(framework = 'books/carbomica_framework_{}.xlsx'.format(facility_code), 
-                    databook = 'books/carbomica_databook_{}.xlsx'.format(facility_code), 
-                    do_run = False)
-
-        # Projection settings
-        P.settings.sim_dt    = 1 # simulation timestep
-        P.settings.sim_start = start_year # simulation start year
-        P.settings.sim_end   = end_year # simulation end year
-
-        # Load program and define variables for program runs
-        progset = P.load_progbook('books/carbomica_progbook_{}.xlsx'.format(facility_code))
+        tracing.enable(show_diagnostics) # record timing spans and counters for the diagnostics panel
+        tracing.reset()
+        # Input data of the selected facility and interventions, checked before any book is built
+        try:
+            input_data_sheet = build_input_data(selected_facility, interventions, dict(zip(SOURCES, emission_data_list)), dict(zip(TARGETS, effect_sizes_list)),
+                                                dict(zip(TARGETS, implementation_costs_list)), dict(zip(TARGETS, maintenance_costs_list)))
+        except InputDataError as e:
+            st.error(str(e))
+            st.stop()
+        if save_input_data:
+            input_data_sheet.to_excel(file_path)
 
         # Set random seed
         np.random.seed(20232212) # MODIFY AS NEEDED
 
-        # Run full coverage scenario            
+        spending = 1e4 # spending on individual interventions in the budget scenario, MODIFY AS NEEDED
+        budgets = [20e3, 50e3, 100e3] # budgets to optimize, MODIFY AS NEEDED
+        workers = 1 # number of workers for per-intervention simulations (see scenarios.run_program_sims), MODIFY AS NEEDED
+
+        # Generate framework, databook and progbook and run the scenarios. On later runs with the same settings,
+        # only the results that depend on the edited inputs are recomputed (optimizations are warm-started)
+        settings = (start_year, end_year, spending, tuple(budgets), optimization_method)
+        if st.session_state.get('session_settings') != settings:
+            st.session_state['session'] = Session(input_data_sheet, start_year, end_year, spending, budgets, method=optimization_method, workers=workers)
+            st.session_state['session_settings'] = settings
+        else:
+            st.session_state['session'].update(input_data_sheet)
+        session = st.session_state['session']
+        P, progset, facility_code = session.P, session.progset, session.facility_code
+
+        # Full coverage scenario
         with col1:                    
             st.header("Coverage scenario for {}".format(facility_code))
-            coverage_scenario(P, progset, start_year, facility_code)
-            # Run budget scenario                    
+            coverage_scenario(P, progset, start_year, facility_code, results=session.coverage_results())
+            # Budget scenario                    
             st.header("Budget scenario for {}".format(facility_code))
-            spending = 1e4 # MODIFY AS NEEDED
-            budget_scenario(P, progset, start_year, facility_code, spending)
+            budget_scenario(P, progset, start_year, facility_code, spending, results=session.budget_results())
         with col2:
-            # Run optimization                    
-            budgets = [20e3, 50e3, 100e3] # MODIFY AS NEEDED
-            optimization(P, progset, start_year, facility_code, budgets)
\ No newline at end of file
+            # Optimization                    
+            optimization(P, progset, start_year, facility_code, budgets, method=optimization_method, results=session.optimization_results())
+            # Run cost-emissions frontier
+            if run_frontier:
+                frontier(P, progset, start_year, facility_code, n_budgets=100) # MODIFY AS NEEDED
+            # Run uncertainty analysis over effect sizes, baselines and costs
+            if run_uncertainty:
+                st.header("Uncertainty analysis")
+                df_bands, df_optimal = uncertainty_analysis(input_data_sheet, start_year, end_year, budgets, spending, facility_code, file_name='results/uncertainty_{}.xlsx'.format(facility_code),
+                                                            n_samples=10000, spread=0.2, seed=20232212) # MODIFY AS NEEDED
+                st.dataframe(df_bands)
+                st.dataframe(df_optimal)
+            # Run sensitivity analysis of the optimized emissions and allocation to every input
+            if run_sensitivity:
+                st.header("Sensitivity analysis")
+                df_tornado, df_sobol = sensitivity_analysis(input_data_sheet, start_year, end_year, budgets[0], facility_code, file_name='results/sensitivity_{}.xlsx'.format(facility_code),
+                                                            spread=0.2, n_base=1024) # MODIFY AS NEEDED
+                ut.plot_tornado(df_tornado, file_name='sensitivity_Tornado_{}'.format(facility_code), to_png=True, to_streamlit=True)
+                st.dataframe(df_sobol)
+            # Optimize the spending trajectory over the years, with implementation cost paid up-front
+            if run_multi_year:
+                st.header("Multi-year optimization")
+                df_summary, df_spending, df_coverage = multi_year_optimization(input_data_sheet, start_year, end_year, budgets[0], facility_code,
+                                                                               file_name='results/multi_year_{}.xlsx'.format(facility_code)) # MODIFY AS NEEDED
+                st.dataframe(df_summary)
+                st.dataframe(df_spending)
+            # Evaluate every bundle of fully covered interventions and their pairwise overlaps
+            if run_bundles:
+                st.header("Intervention bundles")
+                df_bundles, df_pairs = bundle_analysis(input_data_sheet, start_year, end_year, facility_code, file_name='results/bundles_{}.xlsx'.format(facility_code))
+                st.dataframe(df_bundles[df_bundles['Cost-efficient']])
+                st.dataframe(df_pairs)
+
+        # Diagnostics panel: time per stage, counters and Chrome trace download
+        if show_diagnostics:
+            with st.expander("Diagnostics", expanded=True):
+                st.dataframe(tracing.summary())
+                st.json(tracing.counters())
+                st.download_button("Download trace (chrome://tracing, ui.perfetto.dev)", json.dumps(tracing.chrome_trace()), file_name='carbomica_trace.json', mime='application/json')
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+'''
+Numeric results tables extracted from Atomica results, without any plotting or file export.
+
+An Atomica result holds the whole model it was run with, so the scenario functions keep a ResultSummary
+of each simulation instead (see summarize): the values of every parameter of the facility and the spending
+and coverage of every program, as NumPy arrays. The tables below accept either.
+'''
+
+class ResultSummary:
+    '''
+    Values of one simulation, extracted once from its Atomica result (see summarize).
+    :param name: Name of the result.
+    :param facility_code: Code of the facility.
+    :param t: Simulation years, shape (n_years,).
+    :param parameters: list of parameter code names of the facility, in the order of Result.par_names.
+    :param values: Values of the parameters, shape (n_parameters, n_years).
+    :param programs: list of program code names (empty for a simulation without a program set).
+    :param program_labels: list of program labels.
+    :param spending: Spending on each program, shape (n_programs, n_years).
+    :param coverage: Coverage fraction of each program, shape (n_programs, n_years).
+    '''
+    __slots__ = ('name', 'facility_code', 't', 'parameters', 'values', 'programs', 'program_labels', 'spending', 'coverage')
+
+    def __init__(self, name, facility_code, t, parameters, values, programs=(), program_labels=(), spending=None, coverage=None):
+        self.name = name
+        self.facility_code = facility_code
+        self.t = np.asarray(t, dtype=float)
+        self.parameters = list(parameters)
+        self.values = np.asarray(values, dtype=float)
+        self.programs = list(programs)
+        self.program_labels = list(program_labels)
+        self.spending = np.zeros((0, len(self.t))) if spending is None else np.asarray(spending, dtype=float)
+        self.coverage = np.zeros((0, len(self.t))) if coverage is None else np.asarray(coverage, dtype=float)
+
+    def __repr__(self):
+        return 'ResultSummary({!r}, {} parameters, {} programs, {} years)'.format(self.name, len(self.parameters), len(self.programs), len(self.t))
+
+    def variable(self, par):
+        '''
+        :param par: Parameter code name, e.g. 'co2e_emissions'.
+        :return: Values of the parameter in every simulation year.
+        '''
+        return self.values[self.parameters.index(par)]
+
+    def year_index(self, year):
+        return int(np.flatnonzero(self.t == year)[0])
+
+def summarize(result, facility_code=None):
+    '''
+    Extract the values of an Atomica result into a ResultSummary.
+    :param result: Atomica result object (a ResultSummary is returned as is).
+    :param facility_code: Code of the facility (defaults to the first population of the result).
+    :return: ResultSummary
+    '''
+    if isinstance(result, ResultSummary):
+        return result
+    pop = result.model.get_pop(facility_code or result.pop_names[0])
+    parameters = result.par_names(pop.name) # same order as the tables and plots built from Atomica results
+    values = np.array([pop.par_lookup[par].vals for par in parameters], dtype=float)
+    progset = result.model.progset
+    if progset is None:
+        return ResultSummary(result.name, pop.name, result.t, parameters, values)
+    programs = list(progset.programs.keys())
+    spending, coverage = result.get_alloc(), result.get_coverage('fraction')
+    return ResultSummary(result.name, pop.name, result.t, parameters, values, programs, [progset.programs[prog].label for prog in programs],
+                         [spending[prog] for prog in programs], [coverage[prog] for prog in programs])
+
+def emission_parameters(result):
+    '''
+    Emission source parameters of a result (excluding baselines, multipliers and total emissions) and their labels.
+    :param result: Atomica result object or ResultSummary.
+    :return: list of parameter code names, list of labels.
+    '''
+    parameters = [par for par in summarize(result).parameters if '_mult' not in par and '_emissions' not in par and '_baseline' not in par]
+    return parameters, [par.replace('_', ' ').title() for par in parameters]
+
+def emissions_table(results, start_year, facility_code):
+    '''
+    Emissions per source in the start year for each result.
+    :param results: list of Atomica result objects or ResultSummary.
+    :param start_year: Start year of simulations.
+    :param facility_code: Code of the facility.
+    :return: DataFrame of emissions (float), one row per result and one column per emission source.
+    '''
+    summaries = [summarize(res, facility_code) for res in results]
+    parameters, par_labels = emission_parameters(summaries[0])
+    start_i = summaries[0].year_index(start_year)
+    data = [[summary.variable(par)[start_i] for par in parameters] for summary in summaries]
+    return pd.DataFrame(data, index=[summary.name for summary in summaries], columns=par_labels, dtype=float)
+
+def allocation_table(results, start_year, quantity='spending'):
+    '''
+    Spending or coverage of each program in the start year for each result.
+    :param results: list of Atomica result objects (run with a program set) or ResultSummary.
+    :param start_year: Start year of simulations.
+    :param quantity: 'spending' or 'coverage'.
+    :return: DataFrame (float), one row per result and one column per program label.
+    '''
+    summaries = [summarize(res) for res in results]
+    start_i = summaries[0].year_index(start_year)
+    data = [(summary.spending if quantity == 'spending' else summary.coverage)[:, start_i] for summary in summaries]
+    return pd.DataFrame(data, index=[summary.name for summary in summaries], columns=summaries[0].program_labels, dtype=float)
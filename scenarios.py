@@ -1,32 +1,174 @@
-import atomica as at
-import utils as ut
+import numpy as np
+import pandas as pd
+from engine import compile_project
+from mac import _best_emissions, _full_sets, solve_allocation
+from results import summarize
+import tracing
 import os
-if not os.path.exists('results'): os.makedirs('results')
-if not os.path.exists('figs'): os.makedirs('figs')
-import streamlit as st
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+_worker_project = None # project held by each process-pool worker, set once by _init_worker
+_MIN_PROCESS_SIMS = 50 # simulations per worker below which a process pool is slower than running serially
 
-def coverage_scenario(P, progset, start_year, facility_code):
+def _init_worker(P):
+    global _worker_project
+    _worker_project = P
+
+def _run_worker_sim(args):
+    instructions, result_name, full_results = args
+    result = _worker_project.run_sim(parset='default', progset=_worker_project.progsets[0], progset_instructions=instructions, result_name=result_name)
+    return _keep(result, full_results) # a summary is far cheaper to send back to the parent process
+
+def _run_sim(P, instructions=None, result_name=None):
+    '''
+    Run one simulation, with the program set if program instructions are given, traced as a 'run_sim' span.
+    '''
+    with tracing.span('run_sim', result=result_name):
+        tracing.count('simulations')
+        if instructions is None:
+            return P.run_sim(parset='default', result_name=result_name)
+        return P.run_sim(parset='default', progset=P.progsets[0], progset_instructions=instructions, result_name=result_name)
+
+def _keep(result, full_results):
+    '''
+    The Atomica result itself if full_results, otherwise its ResultSummary (see results.summarize).
+    '''
+    return result if full_results else summarize(result)
+
+_measurable_class = None # _TracedMeasurable, defined on first use so that importing this module does not load Atomica
+
+def _traced_measurable(measurable_name, t, stage):
+    '''
+    Emissions objective that records the objective value of every optimizer evaluation (see tracing.py).
+    '''
+    global _measurable_class
+    if _measurable_class is None:
+        import atomica as at
+
+        class _TracedMeasurable(at.MinimizeMeasurable):
+            def __init__(self, measurable_name, t, stage):
+                super().__init__(measurable_name, t)
+                self.stage = stage
+
+            def eval(self, model, baseline):
+                value = super().eval(model, baseline)
+                tracing.count('objective evaluations')
+                tracing.instant('objective', stage=self.stage, value=value)
+                return value
+
+        _measurable_class = _TracedMeasurable
+    return _measurable_class(measurable_name, t, stage)
+
+def run_status_quo(P, full_results=False):
+    '''
+    Run the status-quo simulation (no program instructions).
+    The result can be shared between coverage_scenario, budget_scenario and optimization.
+    :param P: Atomica project.
+    :param full_results: If True, return the Atomica result rather than its ResultSummary.
+    :return: ResultSummary (or Atomica result) named 'Status-quo'.
+    '''
+    return _keep(_run_sim(P, result_name='Status-quo'), full_results)
+
+def run_program_sims(P, instructions, result_names, workers=1, executor='process', full_results=False):
+    '''
+    Run one simulation per set of program instructions, optionally on a pool of workers.
+    With a process pool, the project is sent once to each worker rather than once per simulation.
+    Starting the pool (forking the workers and unpickling the project in each of them) takes about 0.2 s,
+    while one simulation of the example facility takes 6-10 ms, almost independently of the number of
+    years. A process pool therefore only pays off above about 50 simulations per worker, on as many cores
+    as workers: below _MIN_PROCESS_SIMS simulations per worker the simulations run serially. E.g. the 9
+    coverage simulations of the example take 0.06 s serially but 0.23 s on 2 processes. Threads start
+    instantly but simulations hold the GIL, so they run no faster than serially.
+    :param P: Atomica project.
+    :param instructions: list of Atomica ProgramInstructions.
+    :param result_names: list of result names (same length as instructions).
+    :param workers: Number of workers. 1 runs the simulations serially.
+    :param executor: 'process' or 'thread'.
+    :param full_results: If True, return the Atomica results rather than their ResultSummary.
+    :return: list of ResultSummary (or Atomica results), in the same order as instructions.
+    '''
+    if executor == 'process' and workers is not None:
+        workers = min(workers, len(instructions)//_MIN_PROCESS_SIMS)
+    if workers is None or workers <= 1 or len(instructions) <= 1:
+        return [_keep(_run_sim(P, ins, name), full_results) for ins, name in zip(instructions, result_names)]
+    workers = min(workers, len(instructions))
+    if executor == 'process':
+        with tracing.span('run_program_sims', workers=workers, simulations=len(instructions)), ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(P,)) as pool:
+            tracing.count('simulations', len(instructions))
+            return list(pool.map(_run_worker_sim, [(ins, name, full_results) for ins, name in zip(instructions, result_names)]))
+    elif executor == 'thread':
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(lambda args: _keep(_run_sim(P, *args), full_results), zip(instructions, result_names)))
+    else:
+        raise ValueError('Unknown executor "{}" (expected "process" or "thread")'.format(executor))
+
+def run_coverage_scenario(P, progset, start_year, status_quo=None, workers=1, executor='process', programs=None, full_results=False):
+    '''
+    Run the simulations of a scenario where interventions are individually fully covered.
+    :param P: Atomica project.
+    :param start_year: Start year of simulations.
+    :param status_quo: Status-quo result from run_status_quo (run here if not provided).
+    :param workers: Number of workers for the per-intervention simulations.
+    :param executor: 'process' or 'thread' pool when workers > 1.
+    :param programs: list of program code names to run (defaults to every program).
+    :param full_results: If True, return the Atomica results rather than their ResultSummary.
+    :return: list of ResultSummary (or Atomica results), status-quo first, then one per intervention.
+    '''
+    import atomica as at
+    programs = list(progset.programs.keys()) if programs is None else programs
+    instructions = []
+    for prog in programs:
+        coverage_scenario = {prog_all: 0 for prog_all in progset.programs}
+        coverage_scenario[prog] = 1
+        instructions.append(at.ProgramInstructions(start_year=start_year, coverage=coverage_scenario)) # define program instructions
+    result_names = [progset.programs[prog].label for prog in programs]
+    status_quo = run_status_quo(P, full_results) if status_quo is None else status_quo # run status-quo
+    return [status_quo] + run_program_sims(P, instructions, result_names, workers, executor, full_results) # run coverage scenarios
+
+def coverage_scenario(P, progset, start_year, facility_code, status_quo=None, workers=1, executor='process', results=None):
     '''
     Run a scenario where interventions are individually fully covered.
     Results on emission reductions are saved in an excel sheet.
     :param P: Atomica project.
     :param start_year: Start year of simulations.
     :param facility_code: Code of the facility.
+    :param status_quo: Status-quo result from run_status_quo (run here if not provided).
+    :param workers: Number of workers for the per-intervention simulations.
+    :param executor: 'process' or 'thread' pool when workers > 1.
+    :param results: Results of run_coverage_scenario (run here if not provided).
     :return: 
     '''
-    results_scenario = [P.run_sim(parset='default',result_name='Status-quo')] # run status-quo
-    for prog in progset.programs:
-        coverage_scenario = {prog_all: 0 for prog_all in progset.programs}
-        coverage_scenario[prog] = 1
-        instructions = at.ProgramInstructions(start_year=start_year, coverage=coverage_scenario) # define program instructions
-        result_coverage = P.run_sim(parset='default',progset=P.progsets[0], progset_instructions=instructions, result_name=progset.programs[prog].label) # run budget scenario
-        results_scenario.append(result_coverage)
+    import utils as ut
+    results_scenario = run_coverage_scenario(P, progset, start_year, status_quo, workers, executor) if results is None else results
         
     # Calculate emissions 
-    ut.calc_emissions(results_scenario,start_year,facility_code,file_name='coverage_scenario_Emissions_{}'.format(facility_code),title='CO2e emissions - full coverage')
+    ut.calc_emissions(results_scenario,start_year,facility_code,file_name='coverage_scenario_Emissions_{}'.format(facility_code),title='CO2e emissions - full coverage',to_excel=True,to_png=True,to_streamlit=True)
 
-def budget_scenario(P, progset, start_year, facility_code, spending:int):
+def run_budget_scenario(P, progset, start_year, spending:int, status_quo=None, workers=1, executor='process', programs=None, full_results=False):
+    '''
+    Run the simulations of a scenario where spending on interventions are individually specified.
+    :param P: Atomica project.
+    :param start_year: Start year of simulations.
+    :param spending: Spending on individual interventions.
+    :param status_quo: Status-quo result from run_status_quo (run here if not provided).
+    :param workers: Number of workers for the per-intervention simulations.
+    :param executor: 'process' or 'thread' pool when workers > 1.
+    :param programs: list of program code names to run (defaults to every program).
+    :param full_results: If True, return the Atomica results rather than their ResultSummary.
+    :return: list of ResultSummary (or Atomica results), status-quo first, then one per intervention.
+    '''
+    import atomica as at
+    programs = list(progset.programs.keys()) if programs is None else programs
+    instructions = []
+    for prog in programs:
+        budget_scenario = {prog_all: 0 for prog_all in progset.programs}
+        budget_scenario[prog] = spending
+        instructions.append(at.ProgramInstructions(start_year=start_year, alloc=budget_scenario)) # define program instructions
+    result_names = [progset.programs[prog].label for prog in programs]
+    status_quo = run_status_quo(P, full_results) if status_quo is None else status_quo # run status-quo
+    return [status_quo] + run_program_sims(P, instructions, result_names, workers, executor, full_results) # run budget scenarios
+
+def budget_scenario(P, progset, start_year, facility_code, spending:int, status_quo=None, workers=1, executor='process', results=None):
     '''
     Run a scenario where spending on interventions are individually specified.
     Results on emission reductions are saved in an excel sheet.
@@ -34,21 +176,189 @@ def budget_scenario(P, progset, start_year, facility_code, spending:int):
     :param start_year: Start year of simulations.
     :param facility_code: Code of the facility.
     :param spending: Spending on individual interventions.
+    :param status_quo: Status-quo result from run_status_quo (run here if not provided).
+    :param workers: Number of workers for the per-intervention simulations.
+    :param executor: 'process' or 'thread' pool when workers > 1.
+    :param results: Results of run_budget_scenario (run here if not provided).
     :return: 
     '''
-    results_scenario = [P.run_sim(parset='default',result_name='Status-quo')] # run status-quo
-    
-    for prog in progset.programs:
-        budget_scenario = {prog_all: 0 for prog_all in progset.programs}
-        budget_scenario[prog] = spending
-        instructions = at.ProgramInstructions(start_year=start_year, alloc=budget_scenario) # define program instructions
-        result_budget = P.run_sim(parset='default',progset=P.progsets[0], progset_instructions=instructions, result_name=progset.programs[prog].label) # run budget scenario
-        results_scenario.append(result_budget)
+    import utils as ut
+    results_scenario = run_budget_scenario(P, progset, start_year, spending, status_quo, workers, executor) if results is None else results
         
     # Calculate emissions 
-    ut.calc_emissions(results_scenario,start_year,facility_code,file_name='budget_scenario_Emissions_{}'.format(facility_code),title='CO2e emissions - fixed budget (${:0,.0f})'.format(spending))
+    ut.calc_emissions(results_scenario,start_year,facility_code,file_name='budget_scenario_Emissions_{}'.format(facility_code),title='CO2e emissions - fixed budget (${:0,.0f})'.format(spending),to_excel=True,to_png=True,to_streamlit=True)
+
+def _optimize_instructions(P, programs, start_year, budget, initial=None):
+    '''
+    Optimize spending allocation for a single budget.
+    Without an initial allocation, PSO is followed by an ASD refinement started from the PSO allocation.
+    With an initial allocation (e.g. the optimum of a neighbouring budget), only the ASD refinement is run.
+    :param P: Atomica project.
+    :param programs: list of program code names.
+    :param start_year: Start year of simulations.
+    :param budget: Total budget.
+    :param initial: dict of initial spending {prog: spending} for warm-starting ASD.
+    :return: Optimized Atomica ProgramInstructions.
+    '''
+    import atomica as at
+    instructions = at.ProgramInstructions(alloc=P.progsets[0], start_year=start_year) # Baseline spending
+    measurables = [_traced_measurable('co2e_emissions', start_year, 'pso')] # Measurables (objective function: minimize total emissions)
+    constraints = at.TotalSpendConstraint(total_spend=budget, t=start_year) # constraint on total spending
+
+    # Initialize with PSO
+    if initial is None:
+        adjustments = [at.SpendingAdjustment(prog, start_year, 'abs', 0.0, 10e6) for prog in programs] # Adjustments (no spending constraint on any intervention)
+        optimization = at.Optimization(name='default', method='pso', 
+                                       adjustments=adjustments, measurables=measurables, constraints=constraints)
+        with tracing.span('optimize', method='pso', budget=budget):
+            optimized_instructions = at.optimize(P, optimization, P.parsets[0],P.progsets[0], instructions=instructions, optim_args={"maxiter": 10})
+        initial = {prog: optimized_instructions.alloc[prog].interpolate(start_year)[0] for prog in programs}
+
+    # Refine with ASD, starting from the initial allocation
+    adjustments = [at.SpendingAdjustment(prog, start_year, initial=initial[prog]) for prog in programs]
+    measurables = [_traced_measurable('co2e_emissions', start_year, 'asd')]
+    optimization = at.Optimization(name='default', method='asd', 
+                                   adjustments=adjustments, measurables=measurables, constraints=constraints)
+    with tracing.span('optimize', method='asd', budget=budget):
+        return at.optimize(P, optimization, P.parsets[0],P.progsets[0], instructions=instructions)
 
-def optimization(P, progset, start_year, facility_code, budgets:list):
+def _optimize_budget(P, programs, start_year, budget, name, initial=None):
+    '''
+    Optimize spending allocation for a single budget with the PSO -> ASD pipeline.
+    :param P: Atomica project.
+    :param programs: list of program code names.
+    :param start_year: Start year of simulations.
+    :param budget: Total budget.
+    :param name: Name given to the optimized result.
+    :param initial: dict of initial spending {prog: spending} for warm-starting ASD (skips PSO).
+    :return: Atomica result of the optimized allocation.
+    '''
+    optimized_instructions = _optimize_instructions(P, programs, start_year, budget, initial)
+    result_optimized = _run_sim(P, optimized_instructions, name)
+    return result_optimized
+
+def _optimize_budget_surrogate(P, programs, start_year, budget, name):
+    '''
+    Optimize spending allocation for a single budget with the surrogate-assisted optimizer (see surrogate.py).
+    Every surrogate proposal is confirmed by a simulation, and the number of simulations is reported.
+    :param P: Atomica project.
+    :param programs: list of program code names.
+    :param start_year: Start year of simulations.
+    :param budget: Total budget.
+    :param name: Name given to the optimized result.
+    :return: Atomica result of the optimized allocation.
+    '''
+    import atomica as at
+    from surrogate import surrogate_optimize
+    caps = np.array([P.progsets[0].programs[prog].unit_cost.interpolate(start_year)[0] for prog in programs]) # spending for full coverage
+
+    def evaluate(spending):
+        result = _run_sim(P, at.ProgramInstructions(start_year=start_year, alloc=dict(zip(programs, spending))))
+        value = result.get_variable('co2e_emissions')[0].vals[list(result.t).index(start_year)]
+        tracing.count('objective evaluations')
+        tracing.instant('objective', stage='surrogate', value=value)
+        return value
+
+    with tracing.span('optimize', method='surrogate', budget=budget):
+        spending, _, n_evaluations = surrogate_optimize(evaluate, caps, budget)
+    tracing.instant('surrogate', budget=budget, evaluations=n_evaluations)
+    return _run_sim(P, at.ProgramInstructions(start_year=start_year, alloc=dict(zip(programs, spending))), name)
+
+def _optimize_budget_swarm(P, programs, start_year, budget, name, swarm_size=40, maxiter=100, restarts=4, seed=None):
+    '''
+    Optimize spending allocation for a single budget with the batched particle swarm (see swarm.py).
+    Every generation of every restart is evaluated in one call of the compiled model of the project (see
+    engine.py), and only the best allocation across restarts is simulated.
+    :param P: Atomica project.
+    :param programs: list of program code names.
+    :param start_year: Start year of simulations.
+    :param budget: Total budget.
+    :param name: Name given to the optimized result.
+    :param swarm_size: Number of particles of each swarm.
+    :param maxiter: Number of generations.
+    :param restarts: Number of independent swarms.
+    :param seed: Random seed (defaults to swarm.SEED, the seed of project.py).
+    :return: Atomica result of the optimized allocation.
+    '''
+    import atomica as at
+    from swarm import SEED, swarm_optimize
+    model = compile_project(P, P.progsets[0], start_year, next(iter(P.data.pops)))
+    order = [model.programs.index(prog) for prog in programs]
+
+    def evaluate(spending):
+        values = model.emissions_from_spending(spending[..., np.argsort(order)])
+        tracing.count('objective evaluations', values.size)
+        tracing.instant('objective', stage='swarm', value=float(values.min()))
+        return values
+
+    with tracing.span('optimize', method='swarm', budget=budget):
+        spending, _, n_evaluations = swarm_optimize(evaluate, model.unit_cost[order], budget, swarm_size, maxiter, restarts, SEED if seed is None else seed)
+    tracing.instant('swarm', budget=budget, evaluations=n_evaluations)
+    return _run_sim(P, at.ProgramInstructions(start_year=start_year, alloc=dict(zip(programs, spending))), name)
+
+_OPTIMIZERS = {'pso-asd': _optimize_budget, 'surrogate': _optimize_budget_surrogate, 'swarm': _optimize_budget_swarm}
+
+def _run_optimization_task(P, task):
+    method, programs, start_year, budget, name, full_results, options = task
+    return _keep(_OPTIMIZERS[method](P, programs, start_year, budget, name, **options), full_results)
+
+def _run_worker_optimization(task):
+    return _run_optimization_task(_worker_project, task)
+
+def _optimize_budgets_mac(P, progset, start_year, facility_code, budgets, result_names, full_results=False):
+    '''
+    Optimize spending allocation for each budget with the deterministic MAC solver (see mac.py), then
+    run a single simulation per budget to produce the optimized results.
+    '''
+    import atomica as at
+    model = compile_project(P, progset, start_year, facility_code)
+    results_budgets = []
+    for budget, name in zip(budgets, result_names):
+        allocation = solve_allocation(model, budget)
+        instructions = at.ProgramInstructions(start_year=start_year, alloc=dict(zip(model.programs, allocation)))
+        results_budgets.append(_keep(_run_sim(P, instructions, name), full_results))
+    return results_budgets
+
+def run_optimization(P, progset, start_year, facility_code, budgets:list, status_quo=None, workers=1, executor='process', method='pso-asd', full_results=False, options=None):
+    '''
+    Optimize spending allocation on interventions by minizing emissions for each total budget.
+    Each budget runs as its own PSO -> ASD pipeline, so with workers > 1 the ASD refinement for a
+    budget starts as soon as its PSO stage finishes.
+    :param P: Atomica project.
+    :param start_year: Start year of simulations.
+    :param facility_code: Code of the facility.
+    :param budgets: List of budgets to optimize.
+    :param status_quo: Status-quo result from run_status_quo (run here if not provided).
+    :param workers: Number of budgets optimized concurrently.
+    :param executor: 'process' or 'thread' pool when workers > 1.
+    :param method: 'pso-asd' (PSO followed by ASD refinement), 'surrogate' (surrogate-assisted, far fewer simulations),
+        'swarm' (particle swarm evaluated one generation at a time on the compiled model) or 'mac' (exact marginal abatement cost solver).
+    :param full_results: If True, return the Atomica results rather than their ResultSummary.
+    :param options: dict of options of the method, e.g. {'swarm_size': 100, 'maxiter': 200, 'restarts': 8, 'seed': 1} for 'swarm'.
+    :return: list of ResultSummary (or Atomica results), status-quo first, then one per budget.
+    '''
+    programs = list(progset.programs.keys())
+    result_names = ['${:0,.0f}'.format(budget) for budget in budgets]
+    tasks = [(method, programs, start_year, budget, name, full_results, options or {}) for budget, name in zip(budgets, result_names)]
+
+    # Run optimization
+    if method == 'mac':
+        results_budgets = _optimize_budgets_mac(P, progset, start_year, facility_code, budgets, result_names, full_results)
+    elif method not in _OPTIMIZERS:
+        raise ValueError('Unknown method "{}" (expected "pso-asd", "surrogate", "swarm" or "mac")'.format(method))
+    elif workers is None or workers <= 1 or len(tasks) <= 1:
+        results_budgets = [_run_optimization_task(P, task) for task in tasks]
+    elif executor == 'process':
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=_init_worker, initargs=(P,)) as pool:
+            results_budgets = list(pool.map(_run_worker_optimization, tasks))
+    elif executor == 'thread':
+        with ThreadPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            results_budgets = list(pool.map(lambda task: _run_optimization_task(P, task), tasks))
+    else:
+        raise ValueError('Unknown executor "{}" (expected "process" or "thread")'.format(executor))
+    return [run_status_quo(P, full_results) if status_quo is None else status_quo] + results_budgets
+
+def optimization(P, progset, start_year, facility_code, budgets:list, status_quo=None, workers=1, executor='process', method='pso-asd', results=None, options=None):
     print("running optimization")
     '''
     Optimize spending allocation on interventions by minizing emissions for a set total budget.
@@ -57,57 +367,112 @@ def optimization(P, progset, start_year, facility_code, budgets:list):
     :param start_year: Start year of simulations.
     :param facility_code: Code of the facility.
     :param budgets: List of budgets to optimize.
+    :param status_quo: Status-quo result from run_status_quo (run here if not provided).
+    :param workers: Number of budgets optimized concurrently.
+    :param executor: 'process' or 'thread' pool when workers > 1.
+    :param method: 'pso-asd' (PSO followed by ASD refinement), 'surrogate' (surrogate-assisted, far fewer simulations),
+        'swarm' (particle swarm evaluated one generation at a time on the compiled model) or 'mac' (exact marginal abatement cost solver).
+    :param results: Results of run_optimization (run here if not provided).
+    :param options: dict of options of the method (see run_optimization).
     :return: 
     '''
-    instructions = at.ProgramInstructions(alloc=P.progsets[0], start_year=start_year) # Baseline spending
-    adjustments = [at.SpendingAdjustment(prog, start_year, 'abs', 0.0, 10e6) for prog in progset.programs] # Adjustments (no spending constraint on any intervention)
-    measurables = [at.MinimizeMeasurable('co2e_emissions',start_year)] # Measurables (objective function: minimize total emissions)
-    
-    # Run optimization
-    # Initialize with PSO
-    result_names = []
-    for budget in budgets:
-        result_names.append('${:0,.0f}'.format(budget))
-        
-    results_optimized = []
-    for budget, name in zip(budgets, result_names):
-        constraints = at.TotalSpendConstraint(total_spend=budget, t=start_year) # constraint on total spending
-        # Run optimization
-        optimization = at.Optimization(name='default', method='pso', 
-                                       adjustments=adjustments, measurables=measurables, constraints=constraints)
-        optimized_instructions = at.optimize(P, optimization, P.parsets[0],P.progsets[0], instructions=instructions, optim_args={"maxiter": 10})
-        result_optimized = P.run_sim(P.parsets[0],P.progsets[0], progset_instructions=optimized_instructions)
-        
-        # Compile results
-        result_optimized.name = name
-        results_optimized.append(result_optimized)
-    
-    # Extract spending to use as initial conditions in ASD loop
-    allocation_initial, _ = ut.write_alloc_excel(progset, results_optimized, start_year, print_results=False)
-    
-    # Refine optimization with ASD
-    results_optimized = [P.run_sim(parset='default',result_name='Status-quo')]
-    for budget, name in zip(budgets, result_names):
-        constraints = at.TotalSpendConstraint(total_spend=budget, t=start_year) # constraint on total spending
-        adjustments = [at.SpendingAdjustment(prog, start_year, initial=allocation_initial[name][progset.programs[prog].label]) for prog in progset.programs.keys()]
-        
-        # Run optimization
-        optimization = at.Optimization(name='default', method='asd', 
-                                       adjustments=adjustments, measurables=measurables, constraints=constraints)
-        optimized_instructions = at.optimize(P, optimization, P.parsets[0],P.progsets[0], instructions=instructions)
-        result_optimized = P.run_sim(P.parsets[0],P.progsets[0], progset_instructions=optimized_instructions)
-        
-        # Compile results
-        result_optimized.name = name
-        results_optimized.append(result_optimized)
+    import streamlit as st
+    import utils as ut
+    results_optimized = run_optimization(P, progset, start_year, facility_code, budgets, status_quo, workers, executor, method, options=options) if results is None else results
         
     # Plot and save emissions
     st.header("Optimization Budget Allocation")
-    ut.calc_emissions(results_optimized,start_year,facility_code,file_name='optimization_Emissions_{}'.format(facility_code))
+    ut.calc_emissions(results_optimized,start_year,facility_code,file_name='optimization_Emissions_{}'.format(facility_code),to_excel=True,to_png=True,to_streamlit=True)
     
     # Plot budget allocation (exclude status-quo result)
     st.header("Optiomization Emissioms")
-    ut.plot_allocation(results_optimized[1:],file_name='optimization_Budget_Allocation_{}'.format(facility_code)) # allocation
+    ut.plot_allocation(results_optimized[1:],file_name='optimization_Budget_Allocation_{}'.format(facility_code),to_png=True,to_streamlit=True) # allocation
     
     # Save budget allocation and interventions coverage (exclude status-quo result)
-    ut.write_alloc_excel(progset, results_optimized[1:], start_year,file_name='results/optimization_Budget_Allocation_{}.xlsx'.format(facility_code))
\ No newline at end of file
+    ut.write_alloc_excel(progset, results_optimized[1:], start_year,file_name='results/optimization_Budget_Allocation_{}.xlsx'.format(facility_code))
+
+def run_frontier(P, progset, start_year, facility_code, n_budgets=100, max_budget=None, rel_tol=1e-4, patience=3, rtol=1e-6):
+    '''
+    Trace the cost-emissions frontier over a dense grid of budgets from 0 to max_budget.
+    The frontier is traced with the compiled model of the project (see mac.solve_allocation), which is
+    exact and runs no simulation. It is piecewise linear: along each piece the leftover budget buys
+    coverage of one intervention, between sets of fully covered interventions that are optimal at their
+    own cost. Only these breakpoints are confirmed with run_sim (7 simulations for input_data_example.xlsx,
+    against about 1270 for a single PSO -> ASD optimization).
+    The grid stops once emissions improve by less than rel_tol (relative to status-quo emissions)
+    for patience consecutive budgets, since the frontier is flat beyond that point.
+    :param P: Atomica project.
+    :param progset: Atomica program set.
+    :param start_year: Start year of simulations.
+    :param facility_code: Code of the facility.
+    :param n_budgets: Number of budgets in the grid (including zero).
+    :param max_budget: Largest budget (defaults to the cost of full coverage of all interventions).
+    :param rel_tol: Relative improvement in emissions below which a budget step counts as saturated.
+    :param patience: Number of consecutive saturated steps before stopping.
+    :param rtol: Relative tolerance between the simulated and compiled emissions at the breakpoints.
+    :raises ValueError: if a simulated breakpoint differs from the compiled model.
+    :return: DataFrame of emissions per budget (grid budgets and breakpoints, sorted), DataFrame of
+             allocations per budget.
+    '''
+    import atomica as at
+    model = compile_project(P, progset, start_year, facility_code)
+    programs = model.programs
+    if max_budget is None:
+        max_budget = model.unit_cost.sum() # cost of full coverage
+    budgets = np.linspace(0, max_budget, n_budgets)
+    emissions = _best_emissions(model, budgets)
+    saturated = np.r_[False, emissions[:-1] - emissions[1:] < rel_tol*emissions[0]]
+    stalled = np.flatnonzero(np.convolve(saturated, np.ones(patience), 'valid') >= patience)
+    if len(stalled):
+        budgets, emissions = budgets[:stalled[0] + patience], emissions[:stalled[0] + patience]
+
+    # Breakpoints: sets of fully covered interventions that are optimal at their cost, confirmed by simulation
+    costs, set_emissions, sets = _full_sets(model, budgets[-1])
+    breakpoint = set_emissions <= _best_emissions(model, costs) + rtol*emissions[0]
+    start_i = None
+    for cost, coverage, expected in zip(costs[breakpoint], sets[breakpoint], set_emissions[breakpoint]):
+        result = _run_sim(P, at.ProgramInstructions(start_year=start_year, alloc=dict(zip(programs, coverage*model.unit_cost))), '${:0,.0f}'.format(cost))
+        start_i = list(result.t).index(start_year) if start_i is None else start_i
+        simulated = result.get_variable('co2e_emissions', facility_code)[0].vals[start_i]
+        if abs(simulated - expected) > rtol*max(abs(simulated), 1):
+            raise ValueError('Compiled frontier differs from run_sim at budget {:0,.0f}: {:0,.1f} vs {:0,.1f}'.format(cost, expected, simulated))
+
+    df_frontier = pd.DataFrame({'Budget': np.r_[budgets, costs[breakpoint]],
+                                'Emissions (CO2e)': np.r_[emissions, set_emissions[breakpoint]],
+                                'Breakpoint': np.r_[np.zeros(len(budgets), dtype=bool), np.ones(breakpoint.sum(), dtype=bool)]})
+    df_frontier = df_frontier.sort_values(['Budget', 'Breakpoint'], kind='stable').drop_duplicates('Budget', keep='last').reset_index(drop=True)
+    df_allocation = pd.DataFrame([solve_allocation(model, budget) for budget in df_frontier['Budget']], index=df_frontier['Budget'].to_numpy(), columns=model.program_labels)
+    df_allocation.index.name = 'Budget'
+
+    return df_frontier, df_allocation
+
+def frontier(P, progset, start_year, facility_code, n_budgets=100, max_budget=None, rel_tol=1e-4, patience=3):
+    '''
+    Trace the cost-emissions frontier (see run_frontier).
+    Results on emissions and optimized budget allocations are saved in an excel sheet.
+    :param P: Atomica project.
+    :param progset: Atomica program set.
+    :param start_year: Start year of simulations.
+    :param facility_code: Code of the facility.
+    :param n_budgets: Number of budgets in the grid (including zero).
+    :param max_budget: Largest budget (defaults to the cost of full coverage of all interventions).
+    :param rel_tol: Relative improvement in emissions below which a budget step counts as saturated.
+    :param patience: Number of consecutive saturated steps before stopping.
+    :return: DataFrame of emissions per budget, DataFrame of allocations per budget.
+    '''
+    import streamlit as st
+    import utils as ut
+    df_frontier, df_allocation = run_frontier(P, progset, start_year, facility_code, n_budgets, max_budget, rel_tol, patience)
+
+    # Save frontier and allocations
+    file_name = 'results/frontier_{}.xlsx'.format(facility_code)
+    if not os.path.exists(os.path.dirname(file_name)): os.makedirs(os.path.dirname(file_name))
+    with pd.ExcelWriter(file_name, engine='xlsxwriter') as writer:
+        df_frontier.to_excel(writer, sheet_name='Frontier', index=False)
+        df_allocation.to_excel(writer, sheet_name='Budgets')
+    print('Excel file saved: {}'.format(file_name))
+
+    # Plot frontier
+    st.header("Cost-emissions frontier")
+    ut.plot_frontier(df_frontier, df_allocation, file_name='frontier_{}'.format(facility_code), to_png=True, to_streamlit=True)
+    return df_frontier, df_allocation
\ No newline at end of file
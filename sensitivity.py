@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+import os
+from engine import compile_model, model_inputs
+from uncertainty import SEED, from_inputs, solve_allocations
+'''
+Sensitivity of emissions and optimal allocations to every input of the input data sheet: one-at-a-time
+(tornado) and global (Sobol indices).
+
+Every perturbed set of inputs is a sample of a SampledModel (see uncertainty.py), so all perturbations
+are evaluated and re-optimized in one batch. The outputs are the emissions of the optimal allocation for
+a budget, and the allocation shift: the budget moved between interventions relative to the optimal
+allocation of the nominal inputs.
+'''
+
+def input_bounds(model, spread=0.2, bounds=None):
+    '''
+    Low and high value of every input of a CompiledModel.
+    :param model: Nominal CompiledModel.
+    :param spread: Relative perturbation of inputs without bounds: (1-spread) to (1+spread) times their nominal value.
+    :param bounds: dict {sheet: {column: (low, high)}}, using the sheet and column names of the input data sheet.
+    :return: DataFrame of engine.model_inputs with 'Low' and 'High' columns.
+    '''
+    bounds = bounds or {}
+    inputs = model_inputs(model)
+    low_high = [bounds.get(row['Sheet'], {}).get(row['Column'], (row['Value']*(1 - spread), row['Value']*(1 + spread))) for _, row in inputs.iterrows()]
+    inputs['Low'], inputs['High'] = np.array(low_high, dtype=float).reshape(-1, 2).T
+    if len(inputs):
+        inputs.loc[inputs['Attribute'] == 'effects', 'High'] = inputs.loc[inputs['Attribute'] == 'effects', 'High'].clip(upper=1)
+    return inputs
+
+def _evaluate(model, values, budget, nominal_spending):
+    '''
+    Optimal emissions and allocation shift for each set of input values, shape (n_samples,) each.
+    '''
+    sampled = from_inputs(model, values)
+    coverage = solve_allocations(sampled, [budget])[0]
+    shift = np.abs(coverage*sampled.unit_cost - nominal_spending).sum(axis=1)/2
+    return sampled.emissions(coverage), shift
+
+def tornado(model, budget, spread=0.2, bounds=None):
+    '''
+    One-at-a-time sensitivity: set each input to its low and high value, holding the others at their
+    nominal value, and re-optimize the allocation.
+    :param model: Nominal CompiledModel.
+    :param budget: Total budget.
+    :param spread: Relative perturbation of inputs without bounds (see input_bounds).
+    :param bounds: Input bounds (see input_bounds).
+    :return: DataFrame with one row per input, ordered by decreasing swing of emissions.
+    '''
+    inputs = input_bounds(model, spread, bounds)
+    nominal = inputs['Value'].to_numpy(dtype=float)
+    values = np.repeat(nominal[None], 2*len(inputs) + 1, axis=0) # nominal, then low and high of each input
+    values[1 + 2*np.arange(len(inputs)), np.arange(len(inputs))] = inputs['Low']
+    values[2 + 2*np.arange(len(inputs)), np.arange(len(inputs))] = inputs['High']
+
+    nominal_spending = solve_allocations(from_inputs(model, nominal), [budget])[0, 0]*model.unit_cost
+    emissions, shift = _evaluate(model, values, budget, nominal_spending)
+    df_tornado = inputs[['Sheet', 'Column', 'Value', 'Low', 'High']].rename(columns={'Value': 'Nominal'})
+    df_tornado['Emissions at low'], df_tornado['Emissions at high'] = emissions[1::2], emissions[2::2]
+    df_tornado['Swing (CO2e)'] = np.abs(emissions[2::2] - emissions[1::2])
+    df_tornado['Allocation shift at low'], df_tornado['Allocation shift at high'] = shift[1::2], shift[2::2]
+    df_tornado.attrs['Nominal emissions'] = emissions[0]
+    return df_tornado.sort_values('Swing (CO2e)', ascending=False, kind='stable').reset_index(drop=True)
+
+def sobol(model, budget, n_base=1024, spread=0.2, bounds=None, seed=SEED):
+    '''
+    Global sensitivity: first-order and total Sobol indices of every input, with inputs uniform between
+    their low and high values. Uses the Saltelli sampling scheme (n_base*(n_inputs+2) evaluations) on a
+    scrambled Sobol sequence, with the Saltelli (first-order) and Jansen (total) estimators.
+    :param model: Nominal CompiledModel.
+    :param budget: Total budget.
+    :param n_base: Number of base samples (a power of 2).
+    :param spread: Relative perturbation of inputs without bounds (see input_bounds).
+    :param bounds: Input bounds (see input_bounds).
+    :param seed: Random seed.
+    :return: DataFrame with one row per input, ordered by decreasing total index of emissions.
+    '''
+    from scipy.stats import qmc
+    inputs = input_bounds(model, spread, bounds)
+    k = len(inputs)
+    low, high = inputs['Low'].to_numpy(dtype=float), inputs['High'].to_numpy(dtype=float)
+    base = np.tile(low, 2) + np.tile(high - low, 2)*qmc.Sobol(2*k, scramble=True, seed=seed).random(n_base)
+    A, B = base[:, :k], base[:, k:]
+    AB = np.repeat(A[None], k, axis=0)
+    AB[np.arange(k), :, np.arange(k)] = B.T # AB[i] is A with input i taken from B
+
+    nominal_spending = solve_allocations(from_inputs(model, inputs['Value'].to_numpy(dtype=float)), [budget])[0, 0]*model.unit_cost
+    outputs = _evaluate(model, np.vstack([A, B, AB.reshape(-1, k)]), budget, nominal_spending)
+    df_sobol = inputs[['Sheet', 'Column', 'Value', 'Low', 'High']].rename(columns={'Value': 'Nominal'})
+    for output, values in zip(['emissions', 'allocation shift'], outputs):
+        f_A, f_B, f_AB = values[:n_base], values[n_base:2*n_base], values[2*n_base:].reshape(k, n_base)
+        variance = np.var(np.concatenate([f_A, f_B]))
+        variance = variance if variance > 0 else np.inf # constant output: every index is 0
+        df_sobol['S1 ({})'.format(output)] = np.mean(f_B*(f_AB - f_A), axis=1)/variance
+        df_sobol['ST ({})'.format(output)] = np.mean((f_A - f_AB)**2, axis=1)/(2*variance)
+    return df_sobol.sort_values('ST (emissions)', ascending=False, kind='stable').reset_index(drop=True)
+
+def sensitivity_analysis(input_data_sheet, start_year, end_year, budget, facility_code=None, spread=0.2, bounds=None, n_base=1024, seed=SEED, file_name=None):
+    '''
+    Run the one-at-a-time and Sobol sensitivity analyses for a facility of the input data sheet.
+    Results are saved in an excel sheet.
+    :param input_data_sheet: file name of input data sheet (or a dict of DataFrames from engine.read_input_data).
+    :param start_year: Start year of simulations.
+    :param end_year: End year of simulations.
+    :param budget: Total budget.
+    :param facility_code: Code of the facility (defaults to the first facility in the sheet).
+    :param spread: Relative perturbation of inputs without bounds (see input_bounds).
+    :param bounds: Input bounds (see input_bounds).
+    :param n_base: Number of base samples for the Sobol indices (skipped if None).
+    :param seed: Random seed.
+    :param file_name: Excel file name for saving (no file is written if None).
+    :return: DataFrame of the tornado, DataFrame of Sobol indices (None if skipped).
+    '''
+    model = compile_model(input_data_sheet, start_year, end_year, facility_code)
+    df_tornado = tornado(model, budget, spread, bounds)
+    df_sobol = sobol(model, budget, n_base, spread, bounds, seed) if n_base else None
+
+    if file_name is not None:
+        if not os.path.exists(os.path.dirname(file_name) or '.'): os.makedirs(os.path.dirname(file_name))
+        with pd.ExcelWriter(file_name, engine='xlsxwriter') as writer:
+            df_tornado.to_excel(writer, sheet_name='Tornado')
+            if df_sobol is not None:
+                df_sobol.to_excel(writer, sheet_name='Sobol')
+        print('Excel file saved: {}'.format(file_name))
+    return df_tornado, df_sobol
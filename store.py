@@ -0,0 +1,139 @@
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from results import summarize
+'''
+Columnar store of simulation results.
+
+Every run appended to the store becomes one Parquet file of long-format rows (run, scenario, facility,
+budget, program, year, variable, value), partitioned by scenario and facility (hive layout), and one line
+in manifest.jsonl. Queries read the dataset with the filters pushed down to the partitions and the
+Parquet row groups, so thousands of runs can be aggregated without opening every file. Excel workbooks are
+only a view of a query (see ResultsStore.to_excel).
+'''
+
+SCHEMA = pa.schema([('run', pa.string()), ('name', pa.string()), ('budget', pa.float64()), ('program', pa.string()),
+                    ('year', pa.float64()), ('variable', pa.string()), ('value', pa.float64())])
+PARTITIONS = pa.schema([('scenario', pa.string()), ('facility', pa.string())])
+
+def result_records(result, facility_code):
+    '''
+    Long-format rows of every parameter of a facility in a result, and the spending and coverage of every
+    program if the result was run with a program set.
+    :param result: Atomica result object or ResultSummary.
+    :param facility_code: Code of the facility.
+    :return: DataFrame with columns year, variable, value.
+    '''
+    summary = summarize(result, facility_code)
+    variables = summary.parameters + [prog + '_spending' for prog in summary.programs] + [prog + '_coverage' for prog in summary.programs]
+    return pd.DataFrame({'year': np.tile(summary.t, len(variables)),
+                         'variable': np.repeat(variables, len(summary.t)),
+                         'value': np.concatenate([summary.values, summary.spending, summary.coverage]).ravel()})
+
+def _expression(filters):
+    '''
+    Dataset filter expression from a dict {column: value or list of values}.
+    '''
+    expression = None
+    for column, value in (filters or {}).items():
+        condition = ds.field(column).isin(list(value)) if isinstance(value, (list, tuple, set)) else ds.field(column) == value
+        expression = condition if expression is None else expression & condition
+    return expression
+
+class ResultsStore:
+    '''
+    Partitioned Parquet dataset of results, with a manifest of the runs.
+    :param root: Directory of the dataset (created on the first append).
+    '''
+    def __init__(self, root='results/store'):
+        self.root = root
+        self.manifest_file = os.path.join(root, 'manifest.jsonl')
+
+    def manifest(self):
+        '''
+        :return: DataFrame of the runs in the store, one row per run.
+        '''
+        if not os.path.exists(self.manifest_file):
+            return pd.DataFrame(columns=['run', 'name', 'scenario', 'facility', 'budget', 'program', 'rows', 'file'])
+        with open(self.manifest_file) as f:
+            return pd.DataFrame([json.loads(line) for line in f])
+
+    def clear(self):
+        '''
+        Delete every run of the store (its directory is removed).
+        '''
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+
+    def append(self, results, scenario, facility_code, budgets=None, programs=None, **metadata):
+        '''
+        Append results to the store.
+        :param results: Atomica result object or ResultSummary, or a list of them.
+        :param scenario: Scenario type, e.g. 'status-quo', 'coverage', 'budget' or 'optimization'.
+        :param facility_code: Code of the facility.
+        :param budgets: Budget (or spending) of each result, or a single value for every result.
+        :param programs: Program of each result (e.g. the scaled-up intervention), or a single value for every result.
+        :param metadata: Other values recorded in the manifest entry of every run (e.g. start_year).
+        :return: list of run ids.
+        '''
+        results = results if isinstance(results, list) else [results]
+        budgets = budgets if isinstance(budgets, (list, tuple, np.ndarray)) else [budgets]*len(results)
+        programs = programs if isinstance(programs, (list, tuple)) else [programs]*len(results)
+        directory = os.path.join(self.root, 'scenario={}'.format(scenario), 'facility={}'.format(facility_code))
+        if not os.path.exists(directory): os.makedirs(directory)
+
+        entries = []
+        for result, budget, program in zip(results, budgets, programs):
+            run = uuid.uuid4().hex
+            df = result_records(result, facility_code)
+            df.insert(0, 'run', run)
+            df.insert(1, 'name', result.name)
+            df.insert(2, 'budget', np.nan if budget is None else float(budget))
+            df.insert(3, 'program', program)
+            path = os.path.join(directory, 'part-{}.parquet'.format(run))
+            pq.write_table(pa.Table.from_pandas(df, schema=SCHEMA, preserve_index=False), path)
+            entries.append(dict(metadata, run=run, name=result.name, scenario=scenario, facility=facility_code,
+                                budget=budget, program=program, rows=len(df), file=os.path.relpath(path, self.root)))
+
+        with open(self.manifest_file, 'a') as f:
+            f.writelines(json.dumps(entry, default=str) + '\n' for entry in entries)
+        return [entry['run'] for entry in entries]
+
+    def query(self, filters=None, columns=None):
+        '''
+        Read rows of the store. Filters on scenario and facility only open the matching partitions, and
+        filters on the other columns are applied to the Parquet row groups while reading.
+        :param filters: dict {column: value or list of values}, e.g. {'scenario': 'optimization', 'variable': 'co2e_emissions'}.
+        :param columns: list of columns to read (defaults to every column).
+        :return: DataFrame
+        '''
+        if not os.path.exists(self.manifest_file):
+            return pd.DataFrame(columns=columns or SCHEMA.names + PARTITIONS.names)
+        files = [os.path.join(self.root, file) for file in self.manifest()['file']] # no directory listing
+        dataset = ds.dataset(files, format='parquet', schema=pa.unify_schemas([SCHEMA, PARTITIONS]),
+                             partitioning=ds.partitioning(PARTITIONS, flavor='hive'), partition_base_dir=self.root)
+        return dataset.to_table(columns=columns, filter=_expression(filters)).to_pandas()
+
+    def to_excel(self, file_name, filters=None, year=None):
+        '''
+        Excel view of a query: one sheet per scenario, one row per run and one column per variable.
+        :param file_name: Excel file name.
+        :param filters: Query filters (see query).
+        :param year: Year of the values (defaults to every year, as rows of (run, year)).
+        :return: dict of DataFrames written, keyed by scenario.
+        '''
+        df = self.query(dict(filters or {}, **({'year': float(year)} if year is not None else {})))
+        views = {scenario: df_scenario.pivot_table(index=['facility', 'name', 'run', 'year'], columns='variable', values='value', sort=False)
+                 for scenario, df_scenario in df.groupby('scenario', sort=False)}
+        if not os.path.exists(os.path.dirname(file_name) or '.'): os.makedirs(os.path.dirname(file_name))
+        with pd.ExcelWriter(file_name, engine='xlsxwriter') as writer:
+            for scenario, view in views.items():
+                view.to_excel(writer, sheet_name=scenario[:31])
+        print('Excel file saved: {}'.format(file_name))
+        return views
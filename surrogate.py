@@ -0,0 +1,112 @@
+import numpy as np
+from scipy.optimize import minimize
+'''
+Surrogate-assisted optimization of the spending allocation for a total budget.
+
+Every true objective evaluation is a full simulation, so instead of the hundreds of evaluations of
+PSO -> ASD, a quadratic model of the emissions over the coverage vector (a constant, a linear term and
+the products of pairs of coverages) is fitted to the simulations run so far. The fit is weighted towards
+the allocations with the lowest emissions, where the surrogate matters. The minimum of the surrogate over
+the feasible set (spending between 0 and the cost of full coverage of each intervention, summing to the
+budget) is then simulated to confirm it, and added to the fit. The multiplier of an emission source is a
+polynomial in the coverages of the interventions targeting it, of degree equal to their number, so the
+quadratic model is only exact when at most two interventions target each source. Otherwise (e.g. the four
+interventions on Grid_Electricity in the example data) it is a heuristic approximation, refitted around the
+best allocations as simulations accumulate, and the search stops after a number of simulations without
+improvement.
+'''
+
+def project_allocation(spending, caps, budget):
+    '''
+    Euclidean projection of spending onto {0 <= spending <= caps, sum(spending) = budget}.
+    :param spending: Spending, shape (..., n_programs).
+    :param caps: Largest useful spending of each intervention (cost of full coverage), shape (n_programs,).
+    :param budget: Total budget (at most sum(caps)).
+    :return: Projected spending, same shape as spending.
+    '''
+    spending = np.asarray(spending, dtype=float)
+    low = (spending - caps).min(axis=-1, keepdims=True)
+    high = spending.max(axis=-1, keepdims=True)
+    for _ in range(100): # bisection on the shift, sum(clip(spending - shift, 0, caps)) is decreasing in shift
+        shift = (low + high)/2
+        over = np.clip(spending - shift, 0, caps).sum(axis=-1, keepdims=True) > budget
+        low, high = np.where(over, shift, low), np.where(over, high, shift)
+    return np.clip(spending - (low + high)/2, 0, caps)
+
+def _fill(order, caps, budget):
+    '''
+    Allocation covering the interventions fully in the given order until the budget runs out.
+    '''
+    spending = np.zeros(len(caps))
+    spending[order] = np.clip(budget - np.r_[0, np.cumsum(caps[order])[:-1]], 0, caps[order])
+    return spending
+
+def _features(coverage):
+    '''
+    Constant, coverages and products of pairs of coverages, shape (n_points, 1 + n + n*(n-1)/2).
+    '''
+    i, j = np.triu_indices(coverage.shape[1], 1)
+    return np.hstack([np.ones((len(coverage), 1)), coverage, coverage[:, i]*coverage[:, j]])
+
+def surrogate_optimize(evaluate, caps, budget, initial=None, max_evaluations=None, weight=10.0, patience=20, rtol=1e-6, seed=0):
+    '''
+    Minimize evaluate(spending) over {0 <= spending <= caps, sum(spending) = budget}.
+    :param evaluate: True objective, a callable taking a spending vector (one simulation per call).
+    :param caps: Cost of full coverage of each intervention; spending above it has no effect.
+    :param budget: Total budget.
+    :param initial: list of spending vectors to evaluate first (e.g. the optimum of a neighbouring budget).
+    :param max_evaluations: Largest number of calls of evaluate (defaults to twice the number of surrogate coefficients, plus 20).
+    :param weight: Sharpness of the weighting of the fit towards the lowest objective values (0 for an unweighted fit).
+    :param patience: Number of consecutive simulations without improvement before stopping.
+    :param rtol: Relative improvement of the best objective below which a simulation counts as no improvement.
+    :param seed: Random seed.
+    :return: Best spending, its objective value, number of calls of evaluate.
+    '''
+    caps = np.asarray(caps, dtype=float)
+    n = len(caps)
+    if budget >= caps.sum():
+        return caps.copy(), evaluate(caps), 1
+    rng = np.random.default_rng(seed)
+    safe_caps = np.where(caps > 0, caps, 1.0)
+    n_coefficients = 1 + n + n*(n - 1)//2
+    max_evaluations = max_evaluations or 2*n_coefficients + 20
+
+    # Initial design: half full-coverage fills in random order (the optimum fully covers a set of
+    # interventions and partially covers at most one), half random interior allocations
+    n_initial = min(n_coefficients + 1, max_evaluations//2)
+    points = [project_allocation(x, caps, budget) for x in (initial or [])]
+    points += [_fill(rng.permutation(n), caps, budget) for _ in range(n_initial//2)]
+    points += list(project_allocation(rng.dirichlet(np.full(n, 0.5), max(n_initial - len(points), 0))*1.5*budget, caps, budget))
+    X = np.array(points)
+    y = np.array([evaluate(x) for x in X])
+
+    constraint = {'type': 'eq', 'fun': lambda c: (caps @ c) - budget, 'jac': lambda c: caps}
+    stalled = 0
+    while len(y) < max_evaluations and stalled < patience:
+        # Weighted least-squares fit of the standardized objective
+        F = _features(X/safe_caps)
+        w = np.sqrt(np.exp(-weight*(y - y.min())/(np.median(y) - y.min() + 1e-12)))
+        scale = y.std() or 1.0
+        coefficients = np.linalg.lstsq(np.vstack([F*w[:, None], 1e-4*np.eye(F.shape[1])]), np.r_[(y - y.mean())/scale*w, np.zeros(F.shape[1])], rcond=None)[0]
+        linear, Q = coefficients[1:n + 1], np.zeros((n, n))
+        Q[np.triu_indices(n, 1)] = coefficients[n + 1:]
+        H = Q + Q.T
+
+        # Minimize the surrogate from the best simulated allocations and random fills
+        starts = [x/safe_caps for x in X[np.argsort(y)[:5]]] + [_fill(rng.permutation(n), caps, budget)/safe_caps for _ in range(20)]
+        best, best_value = None, np.inf
+        for start in starts:
+            step = minimize(lambda c: linear @ c + c @ Q @ c, start, jac=lambda c: linear + H @ c, method='SLSQP', bounds=[(0, 1)]*n, constraints=[constraint])
+            c = project_allocation(np.clip(step.x, 0, 1)*caps, caps, budget)/safe_caps
+            if linear @ c + c @ Q @ c < best_value:
+                best, best_value = c, linear @ c + c @ Q @ c
+        x = best*caps
+        if np.abs(X - x).sum(axis=1).min() < 1e-6*budget: # already simulated: perturb the best allocation instead
+            x = project_allocation(X[np.argmin(y)] + rng.normal(0, 0.05*budget/n, n), caps, budget)
+
+        value = evaluate(x)
+        stalled = stalled + 1 if value >= y.min()*(1 - rtol) else 0
+        X, y = np.vstack([X, x]), np.append(y, value)
+
+    i = np.argmin(y)
+    return X[i], y[i], len(y)
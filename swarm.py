@@ -0,0 +1,58 @@
+import numpy as np
+from surrogate import project_allocation
+'''
+Particle swarm optimization of the spending allocation for a total budget, one batch per generation.
+
+Atomica's PSO evaluates its particles one simulation at a time. Here the objective takes the positions
+of every particle of every restart at once (shape (n_restarts, swarm_size, n_programs)), so a whole
+generation is a single batched evaluation, e.g. of engine.CompiledModel.emissions_from_spending. Particles
+move in spending space and are projected back onto the feasible set (spending between 0 and the cost of
+full coverage of each intervention, summing to the budget) after every step. Each restart is an
+independent swarm with its own random stream, spawned from the seed, and the best allocation across
+restarts is returned.
+'''
+
+SEED = 20232212 # same seed as project.py
+_INERTIA, _COGNITIVE, _SOCIAL = 0.7298, 1.49618, 1.49618 # constriction coefficients of Clerc and Kennedy
+
+def swarm_optimize(evaluate, caps, budget, swarm_size=40, maxiter=100, restarts=4, seed=SEED):
+    '''
+    Minimize evaluate(spending) over {0 <= spending <= caps, sum(spending) = budget}.
+    :param evaluate: Batched objective, a callable taking spending of shape (..., n_programs) and returning shape (...).
+    :param caps: Cost of full coverage of each intervention; spending above it has no effect.
+    :param budget: Total budget.
+    :param swarm_size: Number of particles of each swarm.
+    :param maxiter: Number of generations.
+    :param restarts: Number of independent swarms.
+    :param seed: Random seed; restart k always uses the k-th stream spawned from it.
+    :return: Best spending, its objective value, number of objective evaluations (particles evaluated).
+    '''
+    caps = np.asarray(caps, dtype=float)
+    n = len(caps)
+    if budget >= caps.sum():
+        return caps.copy(), float(evaluate(caps)), 1
+    rngs = [np.random.default_rng(child) for child in np.random.SeedSequence(seed).spawn(restarts)]
+
+    def draw(f):
+        return np.stack([f(rng) for rng in rngs])
+
+    # Random feasible initial positions, velocities of the order of the spread of the swarm
+    position = project_allocation(draw(lambda rng: rng.dirichlet(np.ones(n), swarm_size))*1.5*budget, caps, budget)
+    velocity = draw(lambda rng: rng.normal(0, 0.1*budget/n, (swarm_size, n)))
+    value = evaluate(position)
+    best_position, best_value = position.copy(), value.copy()
+    n_evaluations = value.size
+
+    for _ in range(maxiter):
+        leader = best_position[np.arange(restarts), np.argmin(best_value, axis=1)][:, None, :] # best particle of each swarm
+        r_cognitive, r_social = draw(lambda rng: rng.random((2, swarm_size, n))).transpose(1, 0, 2, 3)
+        velocity = _INERTIA*velocity + _COGNITIVE*r_cognitive*(best_position - position) + _SOCIAL*r_social*(leader - position)
+        new_position = project_allocation(position + velocity, caps, budget)
+        velocity, position = new_position - position, new_position
+        value = evaluate(position)
+        n_evaluations += value.size
+        improved = value < best_value
+        best_position[improved], best_value[improved] = position[improved], value[improved]
+
+    restart, particle = np.unravel_index(np.argmin(best_value), best_value.shape)
+    return best_position[restart, particle], float(best_value[restart, particle]), n_evaluations
@@ -0,0 +1,234 @@
+import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from mac import solve_allocation
+'''
+Multi-process sweeps over the compiled models of one or more facilities.
+
+Pickling an Atomica project (or even a CompiledModel) into every task would dominate a sweep of many
+small evaluations. SharedModels instead compiles the arrays of every facility (baseline emissions,
+target matrix, effect sizes and costs) into one multiprocessing.shared_memory block, once. Workers
+attach to the block by name when they start and rebuild each CompiledModel on read-only views of it,
+without copying, so a task only carries a facility index and a chunk of spending, coverage or budgets
+(or a seed for Monte Carlo samples). SweepExecutor splits a sweep into such chunks and maps them over a
+process pool; with workers=1 the same kernels run in the calling process.
+'''
+
+_ARRAYS = [('baseline', np.float64), ('targets', np.bool_), ('effects', np.float64), ('implementation_cost', np.float64), ('maintenance_cost', np.float64)]
+_ALIGN = 64 # byte alignment of every array in the shared block
+
+def _layout(models):
+    '''
+    Byte offset, dtype and shape of every array of every model in the shared block.
+    :return: list (one per model) of dicts {attribute: (offset, dtype string, shape)}, total size in bytes.
+    '''
+    layout, size = [], 0
+    for model in models:
+        arrays = {}
+        for attribute, dtype in _ARRAYS:
+            shape = getattr(model, attribute).shape
+            arrays[attribute] = (size, np.dtype(dtype).str, shape)
+            size += -(-int(np.prod(shape))*np.dtype(dtype).itemsize//_ALIGN)*_ALIGN
+        layout.append(arrays)
+    return layout, max(size, 1)
+
+def _metadata(model):
+    return {'facility_code': model.facility_code, 'facility_label': model.facility_label, 'sources': model.sources, 'source_labels': model.source_labels,
+            'programs': model.programs, 'program_labels': model.program_labels, 'years': model.years}
+
+def _views(buffer, layout, metadata):
+    '''
+    Rebuild CompiledModels on read-only views of a shared buffer.
+    '''
+    from engine import CompiledModel
+    models = []
+    for arrays, meta in zip(layout, metadata):
+        views = {}
+        for attribute, (offset, dtype, shape) in arrays.items():
+            views[attribute] = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+            views[attribute].flags.writeable = False
+        models.append(CompiledModel(**meta, **views))
+    return models
+
+class SharedModels:
+    '''
+    CompiledModels of several facilities published in one shared memory block.
+    The creating process owns the block: call close() (or use the object as a context manager) when the
+    sweep is done, which also unlinks the block.
+    :param models: list of CompiledModel (e.g. from portfolio.build_models).
+    '''
+    def __init__(self, models):
+        self.layout, size = _layout(models)
+        self.metadata = [_metadata(model) for model in models]
+        self._shm = shared_memory.SharedMemory(create=True, size=size)
+        for model, arrays in zip(models, self.layout):
+            for attribute, (offset, dtype, shape) in arrays.items():
+                np.ndarray(shape, dtype=dtype, buffer=self._shm.buf, offset=offset)[...] = getattr(model, attribute)
+        self.models = _views(self._shm.buf, self.layout, self.metadata)
+
+    @property
+    def handle(self):
+        '''
+        Picklable reference to the block, passed once to every worker (see attach).
+        '''
+        return self._shm.name, self.layout, self.metadata
+
+    def close(self):
+        if self._shm is not None:
+            self.models = []
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Models of a worker process, attached once by _init_worker
+_shm = None
+_models = []
+
+def attach(handle):
+    '''
+    Attach to the shared block of a SharedModels from another process.
+    :param handle: SharedModels.handle
+    :return: SharedMemory (keep a reference for as long as the models are used), list of CompiledModel.
+    '''
+    name, layout, metadata = handle
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, _views(shm.buf, layout, metadata)
+
+def _init_worker(handle):
+    global _shm, _models
+    _shm, _models = attach(handle)
+
+def _emissions_kernel(model, coverage):
+    return model.emissions(coverage)
+
+def _spending_kernel(model, spending):
+    return model.emissions_from_spending(spending)
+
+def _optimum_kernel(model, budgets):
+    allocations = np.array([solve_allocation(model, budget) for budget in budgets]).reshape(len(budgets), len(model.programs))
+    return np.column_stack([model.emissions_from_spending(allocations), allocations])
+
+def _monte_carlo_kernel(model, task):
+    from uncertainty import sample_model
+    spending, n_samples, seed, distributions, spread = task
+    sampled = sample_model(model, n_samples, distributions, spread, seed)
+    return sampled.emissions_from_spending(sampled.shared(spending))
+
+_KERNELS = {'emissions': _emissions_kernel, 'spending': _spending_kernel, 'optimum': _optimum_kernel, 'monte_carlo': _monte_carlo_kernel}
+
+def _run_task(task):
+    kernel, facility, chunk = task
+    return _KERNELS[kernel](_models[facility], chunk)
+
+class SweepExecutor:
+    '''
+    Process pool sharing the compiled models of several facilities (see SharedModels).
+    :param models: list of CompiledModel.
+    :param workers: Number of worker processes (defaults to the number of CPUs). 1 runs every task in the calling process.
+    :param chunk_size: Number of points (allocations, budgets or samples) per task.
+    '''
+    def __init__(self, models, workers=None, chunk_size=1000):
+        self.workers = workers or os.cpu_count()
+        self.chunk_size = chunk_size
+        self.facilities = [model.facility_code for model in models]
+        self.shared = SharedModels(models)
+        self._pool = None
+        if self.workers > 1:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(self.shared.handle,))
+
+    def _index(self, facility):
+        return facility if isinstance(facility, (int, np.integer)) else self.facilities.index(facility)
+
+    def map(self, kernel, tasks):
+        '''
+        Run kernel on every (facility, chunk) task.
+        :param kernel: 'emissions', 'spending', 'optimum' or 'monte_carlo'.
+        :param tasks: list of (facility code or index, chunk).
+        :return: list of kernel results, in task order.
+        '''
+        tasks = [(kernel, self._index(facility), chunk) for facility, chunk in tasks]
+        if self._pool is None:
+            return [_KERNELS[kernel](self.shared.models[facility], chunk) for kernel, facility, chunk in tasks]
+        return list(self._pool.map(_run_task, tasks))
+
+    def _chunks(self, values):
+        return [values[start:start + self.chunk_size] for start in range(0, len(values), self.chunk_size)]
+
+    def emissions(self, facility, coverage):
+        '''
+        Total emissions of a facility for many coverage vectors.
+        :param facility: Facility code (or index).
+        :param coverage: Array of coverage, shape (n_points, n_programs).
+        :return: Array of emissions, shape (n_points,).
+        '''
+        coverage = np.asarray(coverage, dtype=float)
+        return np.concatenate([np.zeros(0)] + self.map('emissions', [(facility, chunk) for chunk in self._chunks(coverage)]))
+
+    def emissions_from_spending(self, facility, spending):
+        '''
+        Total emissions of a facility for many spending vectors.
+        :param facility: Facility code (or index).
+        :param spending: Array of spending, shape (n_points, n_programs).
+        :return: Array of emissions, shape (n_points,).
+        '''
+        spending = np.asarray(spending, dtype=float)
+        return np.concatenate([np.zeros(0)] + self.map('spending', [(facility, chunk) for chunk in self._chunks(spending)]))
+
+    def optimize(self, budgets, facilities=None):
+        '''
+        Optimal allocation of each budget in each facility (see mac.solve_allocation).
+        :param budgets: List of budgets.
+        :param facilities: list of facility codes (defaults to every facility).
+        :return: dict {facility code: (emissions, shape (n_budgets,), allocations, shape (n_budgets, n_programs))}.
+        '''
+        facilities = self.facilities if facilities is None else facilities
+        budgets = list(budgets)
+        tasks = [(facility, chunk) for facility in facilities for chunk in self._chunks(budgets)]
+        results = self.map('optimum', tasks)
+        optima = {}
+        for facility in facilities:
+            rows = np.vstack([result for (task_facility, _), result in zip(tasks, results) if task_facility == facility])
+            optima[facility] = (rows[:, 0], rows[:, 1:])
+        return optima
+
+    def monte_carlo(self, facility, spending, n_samples=10000, distributions=None, spread=0.2, seed=None):
+        '''
+        Emissions of spending allocations across samples of the inputs of a facility (see uncertainty.sample_model).
+        Every chunk of samples is drawn in its worker from its own seed, spawned from seed, so the samples
+        only depend on seed and chunk_size, not on the number of workers.
+        :param facility: Facility code (or index).
+        :param spending: Array of spending, shape (n_allocations, n_programs).
+        :param n_samples: Number of samples.
+        :param distributions: Input distributions (see uncertainty.sample_model).
+        :param spread: Relative half-width of the default triangular distribution.
+        :param seed: Random seed (defaults to uncertainty.SEED).
+        :return: Array of emissions, shape (n_samples, n_allocations).
+        '''
+        from uncertainty import SEED
+        spending = np.atleast_2d(np.asarray(spending, dtype=float))
+        sizes = [min(self.chunk_size, n_samples - start) for start in range(0, n_samples, self.chunk_size)]
+        seeds = np.random.SeedSequence(SEED if seed is None else seed).spawn(len(sizes))
+        tasks = [(facility, (spending, size, child, distributions, spread)) for size, child in zip(sizes, seeds)]
+        return np.vstack([np.zeros((0, len(spending)))] + self.map('monte_carlo', tasks))
+
+    def close(self):
+        '''
+        Stop the workers and release the shared block.
+        '''
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        self.shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
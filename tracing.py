@@ -0,0 +1,180 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+from functools import wraps
+'''
+Timing spans and counters for the hot paths (book generation, simulations, optimizer iterations, rendering).
+
+Tracing is off by default (set CARBOMICA_TRACE=1 or call enable()). While off, span() returns a shared
+no-op context manager and count()/instant() return immediately, so the instrumented code only pays a
+global flag check. While on, every span is recorded as a Chrome trace event (load the file from
+export_chrome_trace in chrome://tracing or https://ui.perfetto.dev). Work done in process-pool workers is
+not recorded, only the span of the pool in the parent process. Listeners (see add_listener) receive the
+counter and point events as they happen, which is how jobs.py reports progress.
+'''
+
+_enabled = os.environ.get('CARBOMICA_TRACE', '') not in ('', '0')
+_listeners = [] # callables receiving every counter and point event, even while tracing is off
+_active = _enabled # True if counters and point events are recorded or listened to
+_events = []
+_counters = Counter()
+_lock = threading.Lock()
+_origin = time.perf_counter_ns()
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+class _Span:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        event = {'name': self.name, 'ph': 'X', 'ts': (self.start - _origin)/1e3, 'dur': (end - self.start)/1e3,
+                 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': self.args}
+        with _lock:
+            _events.append(event)
+        return False
+
+def enable(flag=True):
+    '''
+    Turn tracing on or off. Recorded events are kept (see reset).
+    '''
+    global _enabled, _active
+    _enabled = flag
+    _active = _enabled or bool(_listeners)
+
+def enabled():
+    return _enabled
+
+def add_listener(listener):
+    '''
+    Call listener(event) on every counter and point event of this process (e.g. to report the progress of
+    a job), whether or not tracing is enabled. Exceptions raised by the listener propagate to the
+    instrumented code, which can be used to interrupt it.
+    :param listener: Callable taking a Chrome trace event (dict).
+    '''
+    global _active
+    _listeners.append(listener)
+    _active = True
+
+def remove_listener(listener):
+    global _active
+    _listeners.remove(listener)
+    _active = _enabled or bool(_listeners)
+
+def reset():
+    '''
+    Clear the recorded events and counters.
+    '''
+    with _lock:
+        _events.clear()
+        _counters.clear()
+
+def span(name, **args):
+    '''
+    Context manager timing a block of code.
+    :param name: Name of the span, e.g. 'run_sim'.
+    :param args: Values recorded with the span (shown in the trace viewer).
+    '''
+    return _Span(name, args) if _enabled else _NO_SPAN
+
+def traced(name=None):
+    '''
+    Decorator timing every call of a function as a span (named after the function by default).
+    '''
+    def decorator(function):
+        span_name = name or function.__qualname__
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Span(span_name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    '''
+    Increment a counter, e.g. 'simulations' or 'cache hits'.
+    '''
+    if not _active:
+        return
+    with _lock:
+        _counters[name] += n
+        event = {'name': name, 'ph': 'C', 'ts': (time.perf_counter_ns() - _origin)/1e3, 'pid': os.getpid(),
+                 'tid': threading.get_ident(), 'args': {name: _counters[name]}}
+        if _enabled:
+            _events.append(event)
+    _notify(event)
+
+def instant(name, **args):
+    '''
+    Record a point event with values, e.g. the objective value of an optimizer iteration.
+    '''
+    if not _active:
+        return
+    event = {'name': name, 'ph': 'i', 's': 't', 'ts': (time.perf_counter_ns() - _origin)/1e3, 'pid': os.getpid(),
+             'tid': threading.get_ident(), 'args': args}
+    if _enabled:
+        with _lock:
+            _events.append(event)
+    _notify(event)
+
+def _notify(event):
+    for listener in list(_listeners):
+        listener(event)
+
+def counters():
+    '''
+    :return: dict of counter values.
+    '''
+    with _lock:
+        return dict(_counters)
+
+def events():
+    '''
+    :return: list of recorded events in Chrome trace event format.
+    '''
+    with _lock:
+        return list(_events)
+
+def summary():
+    '''
+    Total, mean and maximum time of every span name, slowest first.
+    :return: DataFrame with one row per span name.
+    '''
+    import pandas as pd
+    spans = pd.DataFrame([event for event in events() if event['ph'] == 'X'], columns=['name', 'dur'])
+    df = spans.groupby('name')['dur'].agg(['count', 'sum', 'mean', 'max'])/[1, 1e6, 1e6, 1e6] # microseconds to seconds
+    df.columns = ['Calls', 'Total (s)', 'Mean (s)', 'Max (s)']
+    return df.sort_values('Total (s)', ascending=False)
+
+def chrome_trace():
+    '''
+    :return: dict in Chrome trace format (JSON object format).
+    '''
+    return {'traceEvents': events(), 'displayTimeUnit': 'ms', 'otherData': {'counters': counters()}}
+
+def export_chrome_trace(file_name):
+    '''
+    Save the recorded events as a Chrome trace file.
+    :param file_name: JSON file name.
+    '''
+    if not os.path.exists(os.path.dirname(file_name) or '.'): os.makedirs(os.path.dirname(file_name))
+    with open(file_name, 'w') as f:
+        json.dump(chrome_trace(), f)
+    print('Trace saved: {}'.format(file_name))
@@ -0,0 +1,272 @@
+import numpy as np
+import pandas as pd
+import os
+from engine import CompiledModel, compile_model, model_inputs
+from mac import _MAX_EXACT, _subsets, _set_emissions, solve_allocation
+'''
+Monte Carlo uncertainty analysis over baseline emissions, effect sizes and costs.
+
+Every input of the input data sheet (see engine.model_inputs) is drawn from its own distribution, and
+the samples are held in a SampledModel, which evaluates coverage or spending for all samples in one
+batched NumPy operation. Samples are drawn from a NumPy Generator, so results are reproducible from the
+seed.
+'''
+
+SEED = 20232212 # same seed as project.py
+
+def _draw(rng, spec, nominal, n_samples):
+    '''
+    Draw samples of a single input.
+    :param rng: NumPy Generator.
+    :param spec: dict with 'dist' ('triangular', 'uniform', 'normal', 'lognormal' or 'fixed') and its parameters.
+    :param nominal: Nominal value of the input (default mode/mean, and median of 'lognormal').
+    :param n_samples: Number of samples.
+    :return: Array of samples, shape (n_samples,).
+    '''
+    dist = spec.get('dist', 'triangular')
+    if dist == 'fixed':
+        return np.full(n_samples, float(nominal))
+    elif dist == 'triangular':
+        low, mode, high = spec['low'], spec.get('mode', nominal), spec['high']
+        return np.full(n_samples, float(mode)) if low == high else rng.triangular(low, mode, high, n_samples)
+    elif dist == 'uniform':
+        return rng.uniform(spec['low'], spec['high'], n_samples)
+    elif dist == 'normal':
+        return rng.normal(spec.get('mean', nominal), spec['sd'], n_samples)
+    elif dist == 'lognormal':
+        return nominal*rng.lognormal(0.0, spec['sigma'], n_samples)
+    raise ValueError('Unknown distribution "{}" (expected "triangular", "uniform", "normal", "lognormal" or "fixed")'.format(dist))
+
+class SampledModel(CompiledModel):
+    '''
+    CompiledModel holding one set of baseline emissions, effect sizes and costs per sample.
+    Input arrays have a leading sample axis, and so do the coverage and spending arrays passed to its
+    methods and the arrays they return (use shared() to evaluate the same coverage or spending in
+    every sample).
+    :param model: Nominal CompiledModel.
+    :param baseline: Baseline emissions, shape (n_samples, n_sources).
+    :param effects: Effect sizes, shape (n_samples, n_programs).
+    :param implementation_cost: Implementation costs, shape (n_samples, n_programs).
+    :param maintenance_cost: Maintenance costs, shape (n_samples, n_programs).
+    '''
+    def __init__(self, model, baseline, effects, implementation_cost, maintenance_cost):
+        super().__init__(model.facility_code, model.facility_label, model.sources, model.source_labels,
+                         model.programs, model.program_labels, model.years, baseline, model.targets,
+                         effects, implementation_cost, maintenance_cost)
+
+    @property
+    def n_samples(self):
+        return self.baseline.shape[0]
+
+    def update(self):
+        '''
+        Recompute the per-source ordering of interventions in every sample (see CompiledModel.update).
+        '''
+        n_sources = len(self.sources)
+        max_progs = max(1, int(self.targets.sum(axis=1).max())) if n_sources else 1
+        idx = np.zeros((n_sources, max_progs), dtype=int)
+        self._mask = np.zeros((n_sources, max_progs), dtype=bool)
+        for i in range(n_sources):
+            progs = np.flatnonzero(self.targets[i])
+            idx[i, :len(progs)] = progs
+            self._mask[i, :len(progs)] = True
+        key = np.where(self._mask, -np.abs(self.effects[:, idx]), np.inf) # untargeted slots sort last
+        self._order = np.take_along_axis(np.broadcast_to(idx, key.shape), np.argsort(key, axis=-1, kind='stable'), axis=-1)
+        self._sorted_effects = np.where(self._mask, self.effects[np.arange(self.n_samples)[:, None, None], self._order], 0.0)
+
+    def _expand(self, values, ndim):
+        '''
+        Reshape per-sample values (n_samples, k) to broadcast against an array with ndim dimensions.
+        '''
+        return values.reshape((values.shape[0],) + (1,)*(ndim - 2) + (values.shape[-1],))
+
+    def shared(self, values):
+        '''
+        Repeat coverage or spending (..., n_programs) for every sample.
+        :return: Read-only array of shape (n_samples, ..., n_programs).
+        '''
+        values = np.asarray(values, dtype=float)
+        return np.broadcast_to(values, (self.n_samples,) + values.shape)
+
+    def sample(self, i):
+        '''
+        Return sample i as a CompiledModel.
+        '''
+        return CompiledModel(self.facility_code, self.facility_label, self.sources, self.source_labels,
+                             self.programs, self.program_labels, self.years, self.baseline[i], self.targets,
+                             self.effects[i], self.implementation_cost[i], self.maintenance_cost[i])
+
+    def coverage_from_spending(self, spending):
+        spending = np.asarray(spending, dtype=float)
+        return np.clip(spending/self._expand(self.unit_cost, spending.ndim), 0.0, 1.0)
+
+    def multipliers(self, coverage):
+        coverage = np.clip(np.asarray(coverage, dtype=float), 0.0, 1.0)
+        flat = coverage.reshape(self.n_samples, -1, coverage.shape[-1])
+        samples = np.arange(self.n_samples)[:, None, None, None]
+        points = np.arange(flat.shape[1])[None, :, None, None]
+        cov = np.where(self._mask, flat[samples, points, self._order[:, None]], 0.0) # (n_samples, n_points, n_sources, max_progs)
+        uncovered = np.cumprod(1 - cov, axis=-1)
+        uncovered = np.concatenate([np.ones_like(uncovered[..., :1]), uncovered[..., :-1]], axis=-1)
+        mult = np.sum(self._sorted_effects[:, None]*cov*uncovered, axis=-1)
+        return np.clip(mult, 0.0, 1.0).reshape(coverage.shape[:-1] + (len(self.sources),))
+
+    def source_emissions(self, coverage):
+        mult = self.multipliers(coverage)
+        return self._expand(self.baseline, mult.ndim)*(1 - mult)
+
+def from_inputs(model, values):
+    '''
+    Build a SampledModel from sampled values of the inputs of a CompiledModel.
+    Effect sizes are clipped to [0, 1], and emissions and costs to be non-negative.
+    :param model: Nominal CompiledModel.
+    :param values: Array of input values, shape (n_samples, n_inputs), in the order of engine.model_inputs.
+    :return: SampledModel
+    '''
+    values = np.atleast_2d(values)
+    samples = {attribute: np.empty((len(values), len(getattr(model, attribute)))) for attribute in ['baseline', 'effects', 'implementation_cost', 'maintenance_cost']}
+    for k, row in model_inputs(model).iterrows():
+        samples[row['Attribute']][:, row['Index']] = np.clip(values[:, k], 0.0, 1.0 if row['Attribute'] == 'effects' else np.inf)
+    return SampledModel(model, **samples)
+
+def sample_model(model, n_samples=10000, distributions=None, spread=0.2, seed=SEED):
+    '''
+    Draw samples of every input of a CompiledModel.
+    Inputs without a distribution follow a triangular distribution from (1-spread) to (1+spread) times
+    their nominal value.
+    :param model: Nominal CompiledModel.
+    :param n_samples: Number of samples.
+    :param distributions: dict {sheet: {column: spec}} of input distributions (see _draw), using the sheet
+                          and column names of the input data sheet, e.g.
+                          {'effect sizes': {'LowGWP_Inhalers_effect': {'dist': 'uniform', 'low': 0.9, 'high': 1}}}.
+    :param spread: Relative half-width of the default triangular distribution.
+    :param seed: Random seed.
+    :return: SampledModel
+    '''
+    distributions = distributions or {}
+    rng = np.random.default_rng(seed)
+    inputs = model_inputs(model)
+    values = np.empty((n_samples, len(inputs)))
+    for k, row in inputs.iterrows():
+        spec = distributions.get(row['Sheet'], {}).get(row['Column'], {'dist': 'triangular', 'low': row['Value']*(1 - spread), 'high': row['Value']*(1 + spread)})
+        values[:, k] = _draw(rng, spec, row['Value'], n_samples)
+    return from_inputs(model, values)
+
+_CHUNK = 2**22 # number of (sample, set, intervention) candidates evaluated per batch by solve_allocations
+
+def solve_allocations(model, budgets):
+    '''
+    Find the coverage that minimizes emissions for each budget in every sample.
+    As in mac.py, an optimal allocation covers a set of interventions fully and at most one further
+    intervention partially. Emissions are linear in the coverage of a single intervention, so every such
+    candidate is interpolated between the emissions of two sets of fully covered interventions, which
+    are computed once per sample for all budgets. Above 16 interventions, each sample is solved
+    separately with the greedy MAC solver.
+    :param model: SampledModel.
+    :param budgets: List of budgets.
+    :return: Array of coverage, shape (n_budgets, n_samples, n_programs).
+    '''
+    unit_cost = model.unit_cost
+    n_samples, n = unit_cost.shape
+    if n > _MAX_EXACT:
+        return np.array([[solve_allocation(model.sample(i), budget, method='greedy')/unit_cost[i] for i in range(n_samples)] for budget in budgets])
+
+    sets = _subsets(n)
+    with_j = np.arange(2**n)[:, None] | (1 << np.arange(n))[None, :] # set extended with each intervention
+    best_coverage = np.zeros((len(budgets), n_samples, n))
+    chunk = max(1, _CHUNK//(2**n*n))
+    for start in range(0, n_samples, chunk):
+        samples = np.arange(start, min(start + chunk, n_samples))
+        emissions = _set_emissions(model.baseline[samples], model.effects[samples], model.targets)
+        costs = unit_cost[samples] @ sets.T # (n_samples, n_sets)
+        for b, budget in enumerate(budgets):
+            leftover = budget*(1 + 1e-12) - costs
+            feasible = np.flatnonzero((leftover >= 0).any(axis=0)) # sets within budget in any sample
+            leftover = leftover[:, feasible]
+            fractional = np.clip(np.divide(leftover[:, :, None], unit_cost[samples][:, None, :], out=np.ones((len(samples), len(feasible), n)), where=unit_cost[samples][:, None, :] > 0), 0.0, 1.0) * ~sets[feasible]
+            base = emissions[:, feasible, None]
+            candidates = base + fractional*(emissions[:, with_j[feasible]] - base) # (n_samples, n_sets, n_programs)
+            candidates[leftover < 0] = np.inf
+            best_set, best_j = np.unravel_index(np.argmin(candidates.reshape(len(samples), -1), axis=1), (len(feasible), n))
+            best_coverage[b, samples] = sets[feasible[best_set]]
+            best_coverage[b, samples, best_j] += fractional[np.arange(len(samples)), best_set, best_j]
+    return best_coverage
+
+def run_uncertainty(model, budgets=(), spending=None, n_samples=10000, distributions=None, spread=0.2, seed=SEED, percentiles=(5, 50, 95)):
+    '''
+    Evaluate the coverage scenario, the budget scenario and the optimized allocations across samples of
+    the inputs.
+    The optimized allocations are those of the nominal inputs (see mac.py). An allocation stays optimal
+    in a sample if the optimal allocation of that sample funds the same interventions; the regret is the
+    extra emissions of the nominal allocation over the optimum of the sample.
+    :param model: Nominal CompiledModel.
+    :param budgets: List of budgets to optimize.
+    :param spending: Spending on individual interventions for the budget scenario (skipped if None).
+    :param n_samples: Number of samples.
+    :param distributions: Input distributions (see sample_model).
+    :param spread: Relative half-width of the default triangular distribution (see sample_model).
+    :param seed: Random seed.
+    :param percentiles: Percentiles of emissions to report.
+    :return: DataFrame of emissions bands (one row per scenario and result), DataFrame of the probability
+             that each optimized allocation stays optimal (one row per budget).
+    '''
+    sampled = sample_model(model, n_samples, distributions, spread, seed)
+    n = len(model.programs)
+
+    # Status-quo and coverage scenario
+    coverage = np.vstack([np.zeros(n), np.eye(n)])
+    emissions = [sampled.emissions(sampled.shared(coverage))]
+    nominal = [model.emissions(coverage)]
+    index = [('status-quo', 'Status-quo')] + [('coverage', label) for label in model.program_labels]
+
+    # Budget scenario
+    if spending is not None:
+        emissions.append(sampled.emissions_from_spending(sampled.shared(spending*np.eye(n))))
+        nominal.append(model.emissions_from_spending(spending*np.eye(n)))
+        index += [('budget', label) for label in model.program_labels]
+
+    # Optimized allocations, and the optimum of every sample
+    optimal = []
+    if len(budgets):
+        allocations = np.array([solve_allocation(model, budget) for budget in budgets])
+        emissions.append(sampled.emissions_from_spending(sampled.shared(allocations)))
+        nominal.append(model.emissions_from_spending(allocations))
+        names = ['${:0,.0f}'.format(budget) for budget in budgets]
+        index += [('optimization', name) for name in names]
+        for allocation, best_coverage, budget, optimized in zip(allocations, solve_allocations(sampled, budgets), budgets, emissions[-1].T):
+            regret = np.maximum(optimized - sampled.emissions(best_coverage), 0.0)
+            same = np.all((best_coverage > 0) == (allocation > 0), axis=1) | (regret <= 1e-9*optimized)
+            optimal.append({'Budget': budget, 'Probability optimal': same.mean(), 'Mean regret (CO2e)': regret.mean(),
+                            **{'P{:g} regret (CO2e)'.format(p): np.percentile(regret, p) for p in percentiles}})
+
+    emissions, nominal = np.hstack(emissions), np.concatenate(nominal)
+    df_bands = pd.DataFrame({'Nominal': nominal, 'Mean': emissions.mean(axis=0)}, index=pd.MultiIndex.from_tuples(index, names=['Scenario', 'Result']))
+    for p, band in zip(percentiles, np.percentile(emissions, percentiles, axis=0)):
+        df_bands['P{:g}'.format(p)] = band
+    df_optimal = pd.DataFrame(optimal, index=pd.Index(names if optimal else [], name='Result'))
+    return df_bands, df_optimal
+
+def uncertainty_analysis(input_data_sheet, start_year, end_year, budgets=(), spending=None, facility_code=None, file_name=None, **kwargs):
+    '''
+    Run the uncertainty analysis for a facility of the input data sheet.
+    Emissions bands and the probability that optimized allocations stay optimal are saved in an excel sheet.
+    :param input_data_sheet: file name of input data sheet (or a dict of DataFrames from engine.read_input_data).
+    :param start_year: Start year of simulations.
+    :param end_year: End year of simulations.
+    :param budgets: List of budgets to optimize.
+    :param spending: Spending on individual interventions for the budget scenario (skipped if None).
+    :param facility_code: Code of the facility (defaults to the first facility in the sheet).
+    :param file_name: Excel file name for saving (no file is written if None).
+    :param kwargs: n_samples, distributions, spread, seed and percentiles (see run_uncertainty).
+    :return: DataFrame of emissions bands, DataFrame of the probability that each allocation stays optimal.
+    '''
+    model = compile_model(input_data_sheet, start_year, end_year, facility_code)
+    df_bands, df_optimal = run_uncertainty(model, budgets, spending, **kwargs)
+
+    if file_name is not None:
+        if not os.path.exists(os.path.dirname(file_name) or '.'): os.makedirs(os.path.dirname(file_name))
+        with pd.ExcelWriter(file_name, engine='xlsxwriter') as writer:
+            df_bands.to_excel(writer, sheet_name='Emissions')
+            df_optimal.to_excel(writer, sheet_name='Optimality')
+        print('Excel file saved: {}'.format(file_name))
+    return df_bands, df_optimal
@@ -1,171 +1,205 @@
-import matplotlib.pyplot as plt
-import matplotlib as mpl
+import os
 import pandas as pd
-import atomica as at
-import streamlit as st
+from results import emissions_table, allocation_table
+import tracing
 
-def calc_emissions(results, start_year, facility_code, file_name, title=None):
+@tracing.traced()
+def plot_emissions(df_emissions, title=None):
     '''
-    Calculate emissions before and after program implementation, export results to Excel, and generate bar plots.
-    :param results: list of Atomica result objects.
-    :param start_year: Start year of simulations.
-    :param facility_code: Code of the facility.
-    :param file_name: Specify Excel file name for saving.
+    Render the stacked bar plot of emissions per source.
+    :param df_emissions: DataFrame of emissions, one row per result and one column per emission source.
     :param title: Title for the plot.
-    :return: DataFrame of emissions results.
+    :return: Matplotlib figure.
     '''
-    # Extract relevant parameter names for plotting
-    pop = results[0].pop_names[0]
-    pars = results[0].par_names(pop)
-    parameters = [par for par in pars if '_mult' not in par and '_emissions' not in par and '_baseline' not in par]
-    par_labels = [par.replace('_', ' ').title() for par in parameters]
-    
-    # Set up DataFrame for emissions
-    rows = [res.name for res in results]
-    df_emissions = pd.DataFrame(index=rows, columns=par_labels)
-    start_i = list(results[0].t).index(start_year)
-    
-    # Populate the DataFrame with emissions data
-    for par, par_label in zip(parameters, par_labels):
-        for res in results:
-            df_emissions.loc[res.name, par_label] = res.get_variable(par, facility_code)[0].vals[start_i]
-    
-    # Export the DataFrame to Excel
-    writer_emissions = pd.ExcelWriter(f'results/{file_name}.xlsx', engine='xlsxwriter')
-    df_emissions.to_excel(writer_emissions, sheet_name=facility_code)
-    
-    # Generate the bar plot
-    fig_width = max(15, len(par_labels) * 1.5)
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+    fig_width = max(15, len(df_emissions.columns) * 1.5)
     fig_height = 10
     font_size = 22
-    ax = df_emissions.plot(figsize=(fig_width, fig_height), kind='bar', stacked=True, fontsize=font_size)
-    
-    # Set plot title
-    plt.title(title or 'Total CO2e Emissions', fontsize=font_size + 2)
-    
-    # Adjust legend
-    ax.legend(title='Emission Sources', bbox_to_anchor=(1.0, 1.0), loc='upper left', fontsize=font_size-2, title_fontsize=font_size)
-    
-    # Format the y-axis
-    ax.yaxis.set_major_formatter(mpl.ticker.StrMethodFormatter('{x:,.0f}'))
-    
-    # Adjust x-axis labels
-    plt.xticks(rotation=90, ha='center')
-    plt.ylabel('Emissions (CO2e)', fontsize=font_size)
-    
-    # Tight layout and save figure
-    plt.tight_layout()
-    plt.savefig(f'figs/{file_name}.png', bbox_inches='tight')
-    plt.show()
-    
-    # Close the writer and release Excel file
-    writer_emissions.close()
-    
-    print(f'Emissions results saved: results/{file_name}.xlsx')
-    print(f'Emissions bar plots saved: figs/{file_name}.png')
-
     fig, ax = plt.subplots(figsize=(fig_width, fig_height))
     df_emissions.plot(ax=ax, kind='bar', stacked=True, fontsize=font_size)
 
     # Customize plot
-    plt.title(title or 'Total CO2e Emissions', fontsize=font_size + 2)
+    ax.set_title(title or 'Total CO2e Emissions', fontsize=font_size + 2)
     ax.legend(title='Emission Sources', bbox_to_anchor=(1.0, 1.0), loc='upper left', fontsize=font_size-2, title_fontsize=font_size)
     ax.yaxis.set_major_formatter(mpl.ticker.StrMethodFormatter('{x:,.0f}'))
-    plt.xticks(rotation=90, ha='center')
-    plt.ylabel('Emissions (CO2e)', fontsize=font_size)
-    plt.tight_layout()
-
-    # Return the Matplotlib plot as a Streamlit component
-    return st.pyplot(fig)
+    ax.tick_params(axis='x', labelrotation=90)
+    ax.set_ylabel('Emissions (CO2e)', fontsize=font_size)
+    fig.tight_layout()
+    return fig
 
-    
-def plot_allocation(results,file_name):
+@tracing.traced()
+def plot_spending(df_spending):
     '''
-    Prints allocation to excel
-    :param results: list of atomica result objects
-    :param file_name: specify excel file name for saving
+    Render the stacked bar plot of budget allocations.
+    :param df_spending: DataFrame of spending, one row per result and one column per intervention.
+    :return: Matplotlib figure.
     '''
-    prog_codes = results[0].model.progset.programs
-    prog_labels = [results[0].model.progset.programs[prog].label for prog in prog_codes]
-    res_names = [res.name for res in results]
-    df_spending_optimized = pd.DataFrame(index=res_names, columns=prog_labels)
-    
-    for res in results:
-        for prog_code, prog_name in zip(prog_codes,prog_labels):
-            df_spending_optimized.loc[res.name,prog_name] = res.get_alloc()[prog_code][0]
-    
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
     # https://matplotlib.org/stable/users/explain/colors/colormaps.html#qualitative
     colormap = plt.cm.tab20
-    colors = [colormap(i) for i in range(len(df_spending_optimized.columns))]
-    
-    plt.figure()
-    ax = df_spending_optimized.plot.bar(stacked=True, color=colors, figsize=(15,10), fontsize=22)
-    ax.legend(loc='upper left', bbox_to_anchor=(1.05,1), title='Interventions', fontsize=20, title_fontsize=22)
-    ax.yaxis.set_major_formatter(mpl.ticker.StrMethodFormatter('${x:,.0f}'))
-    plt.title('Budget allocation', fontsize=25)
-    plt.xticks(rotation=0)
-    plt.tight_layout()
-    plt.savefig('figs/{}.png'.format(file_name))
-    plt.show()
-    plt.close()
-    
-    print('Allocation bar plots saved: figs/{}.png'.format(file_name))
+    colors = [colormap(i) for i in range(len(df_spending.columns))]
 
     fig, ax = plt.subplots(figsize=(15, 10))
-    df_spending_optimized.plot.bar(stacked=True, color=colors, ax=ax, fontsize=22)
+    df_spending.plot.bar(stacked=True, color=colors, ax=ax, fontsize=22)
 
     # Customize plot
     ax.legend(loc='upper left', bbox_to_anchor=(1.05, 1), title='Interventions', fontsize=20, title_fontsize=22)
     ax.yaxis.set_major_formatter(mpl.ticker.StrMethodFormatter('${x:,.0f}'))
-    plt.title('Budget allocation', fontsize=25)
-    plt.xticks(rotation=0)
-    plt.tight_layout()
+    ax.set_title('Budget allocation', fontsize=25)
+    ax.tick_params(axis='x', labelrotation=0)
+    fig.tight_layout()
+    return fig
+
+def render_figure(fig, file_name=None, to_streamlit=False, **kwargs):
+    '''
+    Send a figure to the requested sinks (png file and/or Streamlit), then close it.
+    :param fig: matplotlib figure (e.g. from plot_emissions or plot_spending).
+    :param file_name: png file name (no file is written if None).
+    :param to_streamlit: If True, show the figure in the Streamlit app.
+    :param kwargs: Keyword arguments of fig.savefig.
+    '''
+    import matplotlib.pyplot as plt
+    with tracing.span('render', file=file_name, streamlit=to_streamlit):
+        if file_name is not None:
+            if not os.path.exists(os.path.dirname(file_name) or '.'): os.makedirs(os.path.dirname(file_name))
+            fig.savefig(file_name, **kwargs)
+        if to_streamlit:
+            import streamlit as st
+            st.pyplot(fig)
+        plt.close(fig)
+
+def calc_emissions(results, start_year, facility_code, file_name=None, title=None, to_excel=False, to_png=False, to_streamlit=False):
+    '''
+    Calculate emissions before and after program implementation, and optionally export results to Excel
+    and render bar plots. The plot is only rendered if it is sent to a sink, and is rendered once for all sinks.
+    :param results: list of Atomica result objects.
+    :param start_year: Start year of simulations.
+    :param facility_code: Code of the facility.
+    :param file_name: Specify Excel and figure file name for saving.
+    :param title: Title for the plot.
+    :param to_excel: If True, save the emissions to results/<file_name>.xlsx.
+    :param to_png: If True, save the bar plot to figs/<file_name>.png.
+    :param to_streamlit: If True, show the bar plot in Streamlit.
+    :return: DataFrame of emissions results.
+    '''
+    df_emissions = emissions_table(results, start_year, facility_code)
+
+    # Export the DataFrame to Excel
+    if to_excel:
+        if not os.path.exists('results'): os.makedirs('results')
+        with tracing.span('write excel', file=f'results/{file_name}.xlsx'), pd.ExcelWriter(f'results/{file_name}.xlsx', engine='xlsxwriter') as writer_emissions:
+            df_emissions.to_excel(writer_emissions, sheet_name=facility_code)
+        print(f'Emissions results saved: results/{file_name}.xlsx')
+
+    # Generate the bar plot
+    if to_png or to_streamlit:
+        render_figure(plot_emissions(df_emissions, title), f'figs/{file_name}.png' if to_png else None, to_streamlit, bbox_inches='tight')
+        if to_png:
+            print(f'Emissions bar plots saved: figs/{file_name}.png')
+    return df_emissions
 
-    # Return the Matplotlib plot as a Streamlit component
-    return st.pyplot(fig)
     
+def plot_allocation(results, file_name=None, to_png=False, to_streamlit=False):
+    '''
+    Plot budget allocation
+    :param results: list of atomica result objects
+    :param file_name: specify figure file name for saving
+    :param to_png: If True, save the bar plot to figs/<file_name>.png.
+    :param to_streamlit: If True, show the bar plot in Streamlit.
+    :return: DataFrame of spending per intervention.
+    '''
+    df_spending_optimized = allocation_table(results, results[0].t[0])
+    if to_png or to_streamlit:
+        render_figure(plot_spending(df_spending_optimized), 'figs/{}.png'.format(file_name) if to_png else None, to_streamlit)
+        if to_png:
+            print('Allocation bar plots saved: figs/{}.png'.format(file_name))
+    return df_spending_optimized
+    
+
+def plot_frontier(df_frontier, df_allocation, file_name=None, to_png=False, to_streamlit=False):
+    '''
+    Plot the cost-emissions frontier and the optimized allocation along it.
+    :param df_frontier: DataFrame with 'Budget' and 'Emissions (CO2e)' columns.
+    :param df_allocation: DataFrame of allocations indexed by budget, one column per intervention.
+    :param file_name: specify figure file name for saving
+    :param to_png: If True, save the plot to figs/<file_name>.png.
+    :param to_streamlit: If True, show the plot in Streamlit.
+    '''
+    if not (to_png or to_streamlit):
+        return
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+    colormap = plt.cm.tab20
+    colors = [colormap(i) for i in range(len(df_allocation.columns))]
+
+    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(15, 16), sharex=True)
+    ax1.plot(df_frontier['Budget'], df_frontier['Emissions (CO2e)'], marker='o', color='k')
+    ax1.set_ylabel('Emissions (CO2e)', fontsize=22)
+    ax1.set_title('Cost-emissions frontier', fontsize=25)
+    ax1.yaxis.set_major_formatter(mpl.ticker.StrMethodFormatter('{x:,.0f}'))
+    ax1.tick_params(labelsize=18)
+    ax2.stackplot(df_allocation.index, df_allocation.T.values, labels=df_allocation.columns, colors=colors)
+    ax2.legend(loc='upper left', bbox_to_anchor=(1.05, 1), title='Interventions', fontsize=20, title_fontsize=22)
+    ax2.set_xlabel('Budget', fontsize=22)
+    ax2.set_ylabel('Allocation', fontsize=22)
+    ax2.xaxis.set_major_formatter(mpl.ticker.StrMethodFormatter('${x:,.0f}'))
+    ax2.yaxis.set_major_formatter(mpl.ticker.StrMethodFormatter('${x:,.0f}'))
+    ax2.tick_params(labelsize=18)
+    fig.tight_layout()
+    render_figure(fig, 'figs/{}.png'.format(file_name) if to_png else None, to_streamlit, bbox_inches='tight')
+    if to_png:
+        print('Frontier plots saved: figs/{}.png'.format(file_name))
+    
+
+def plot_tornado(df_tornado, file_name=None, n_inputs=15, to_png=False, to_streamlit=False):
+    '''
+    Plot the tornado chart of a one-at-a-time sensitivity analysis (see sensitivity.tornado).
+    :param df_tornado: DataFrame from sensitivity.tornado, ordered by decreasing swing.
+    :param file_name: specify figure file name for saving
+    :param n_inputs: Number of inputs shown (largest swings first).
+    :param to_png: If True, save the plot to figs/<file_name>.png.
+    :param to_streamlit: If True, show the plot in Streamlit.
+    '''
+    if not (to_png or to_streamlit):
+        return
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+    df = df_tornado.head(n_inputs).iloc[::-1]
+    nominal = df_tornado.attrs.get('Nominal emissions', 0)
+    labels = ['{} ({})'.format(column, sheet) for sheet, column in zip(df['Sheet'], df['Column'])]
+
+    fig, ax = plt.subplots(figsize=(15, max(6, 0.6*len(df))))
+    ax.barh(labels, df['Emissions at low'] - nominal, left=nominal, color='tab:blue', label='Low value')
+    ax.barh(labels, df['Emissions at high'] - nominal, left=nominal, color='tab:orange', label='High value')
+    ax.axvline(nominal, color='k', linewidth=1)
+    ax.xaxis.set_major_formatter(mpl.ticker.StrMethodFormatter('{x:,.0f}'))
+    ax.set_xlabel('Emissions (CO2e)', fontsize=18)
+    ax.set_title('Sensitivity of optimized emissions', fontsize=22)
+    ax.legend(fontsize=16)
+    ax.tick_params(labelsize=14)
+    fig.tight_layout()
+    render_figure(fig, 'figs/{}.png'.format(file_name) if to_png else None, to_streamlit, bbox_inches='tight')
+    if to_png:
+        print('Tornado plot saved: figs/{}.png'.format(file_name))
+
 
 def write_alloc_excel(progset, results, year, print_results=True,file_name=None):
     """Write optimized budget allocations onto an excel file
-        :param: P: atomica project
-        :param: results: results from optimization runs
-        :param: save_dir: path for saving the plot
+        :param: progset: atomica program set
+        :param: results: results from optimization runs (Atomica results or ResultSummary)
+        :param: year: year of the allocations
         :param: name to be given to excel file (string)
         """
-        
-    progname = []
-    prog_labels = []
-    for prog in progset.programs:
-        progname += [prog]
-        prog_labels += [progset.programs[prog].label]
-        
-    bars = []
-    for i in range(0, len(results)):
-         bar_name = results[i].name
-         bars.append(bar_name)
-         
-    d1 = at.PlotData.programs(results, quantity='spending')
-    d1.interpolate(year)
-    spending_raw_data = {(x.result, x.output): x.vals[0] for x in d1.series}
-    spending_data = {res: {prog:0 for prog in progname} for res in bars}
-    
-    d2 = at.PlotData.programs(results, quantity='coverage_fraction')
-    d2.interpolate(year)
-    cov_raw_data = {(x.result, x.output): x.vals[0] for x in d2.series}
-    cov_data = {res: {prog:0 for prog in progname} for res in bars}
-    for br in bars:
-        for prog in progname:
-            spending_data[br][prog] = spending_raw_data[(br, prog)]
-            cov_data[br][prog] = cov_raw_data[(br, prog)]
-    df1 = pd.DataFrame(spending_data)
-    df2 = pd.DataFrame(cov_data)
-    df1.index = prog_labels
-    df2.index = prog_labels
+    df1 = allocation_table(results, year).T
+    df2 = allocation_table(results, year, quantity='coverage').T
     
     if print_results:
-        writer = pd.ExcelWriter(file_name, engine='xlsxwriter')
-        df1.to_excel(writer, sheet_name="Budgets")
-        df2.to_excel(writer, sheet_name="Coverages")
+        if not os.path.exists(os.path.dirname(file_name) or '.'): os.makedirs(os.path.dirname(file_name))
+        with tracing.span('write excel', file=file_name), pd.ExcelWriter(file_name, engine='xlsxwriter') as writer:
+            df1.to_excel(writer, sheet_name="Budgets")
+            df2.to_excel(writer, sheet_name="Coverages")
         print('Excel file saved: {}'.format(file_name))
     
     return df1, df2
\ No newline at end of file